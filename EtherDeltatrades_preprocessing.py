@@ -31,26 +31,100 @@
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import sys
 import getopt
 
+from token_amounts import decode_amounts
+from trade_files import close_trades_writer, read_trades, to_pandas, write_trades
+
+
+# raw amount columns are read as strings, they can have up to 55 digits
+AMOUNT_COLUMNS = {'amountGet': pa.string(), 'amountGive': pa.string()}
+
+# types of all columns of the export, so that every chunk is read with the same types
+COLUMN_TYPES = {'transaction_hash': pa.string(), 'block_number': pa.int64(), 'timestamp': pa.int64(),
+                'tokenGet': pa.string(), 'tokenGive': pa.string(), 'get': pa.string(), 'give': pa.string(),
+                **AMOUNT_COLUMNS}
+
+
+def preprocess_trades(trades, token_decimals_map):
+
+  ### TRANSFORM
+  # 
+  # Challenges:
+  # - safely convert the amount columns, which can have very large amounts (up to 55 digits)
+  # - transform values according to decimals
+  # 
+  # Steps
+  # 1. look up decimals of tokens, 18 if unknown
+  # 2. divide amounts by decimals, exactly on the digit strings (see token_amounts.py)
+
+  trades_real = to_pandas(trades.drop_columns(list(AMOUNT_COLUMNS)))
+
+  ### TOKENGET
+
+  decimals = trades_real['tokenGet'].map(token_decimals_map).fillna(18)
+
+  trades_real['amountBoughtReal'] = decode_amounts(trades.column('amountGet'), decimals)
+
+  ### TOKENGIVE
+
+  decimals = trades_real['tokenGive'].map(token_decimals_map).fillna(18)
+
+  trades_real['amountSoldReal'] = decode_amounts(trades.column('amountGive'), decimals)
+
+  ### PRICE
+
+  # divide tokenGive by tokenGet to get the price of tokenGet in units of tokenGive
+  # (1 tokenGet = <price> tokenGive)
+  trades_real['price'] = trades_real['amountSoldReal'].divide(trades_real['amountBoughtReal'])
+
+  ### EXPORT
+
+  # rename some columns
+  trades_real = trades_real.rename(columns={'transaction_hash':'transactionHash',
+                                            'block_number':'blockNumber',
+                                            'tokenGet':'tokenBuy',
+                                            'tokenGive':'tokenSell',
+                                            'get':'maker',
+                                            'give':'taker'
+                                           })
+
+  trades_real = trades_real[['blockNumber',
+                             'timestamp',
+                             'transactionHash',
+                             'maker',
+                             'taker',
+                             'tokenBuy',
+                             'tokenSell',
+                             'amountBoughtReal',
+                             'amountSoldReal',
+                             'price']]
+
+  return trades_real
+
+
 def main(argv):
 
   # get input arguments
   etherdeltafile = ''
   decimalsfile = ''
   outputfile = ''
-  short_options = "hi:d:o:"
-  long_options = ["help", "etherdeltafile=", "decimalsfile=" "outputfile="]
+  outputformat = 'csv'
+  chunkrows = None
+  short_options = "hi:d:o:f:c:"
+  long_options = ["help", "etherdeltafile=", "decimalsfile=" "outputfile=", "format=", "chunk-rows="]
   
   try:
     opts, args = getopt.getopt(argv, short_options, long_options)
   except getopt.GetoptError:
-    print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile>')
+    print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
     sys.exit(2)
   for opt, arg in opts:
     if opt == '-h':
-      print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile>')
+      print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
       sys.exit()
     elif opt in ("-i", "--etherdeltafile"):
       etherdeltafile = arg
@@ -58,22 +132,24 @@ def main(argv):
       decimalsfile = arg
     elif opt in ("-o", "--outputfile"):
       outputfile = arg
+    elif opt in ("-f", "--format"):
+      outputformat = arg
+    elif opt in ("-c", "--chunk-rows"):
+      chunkrows = int(arg)
   # if any argument is missing, stop
   if (etherdeltafile == '' or decimalsfile == '' or outputfile == ''):
     print('Warning: missing arguments. Arguments need to be supplied as follows:')
-    print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile>')
+    print('EtherDeltatrades_preprocessing.py -i <etherdeltafile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
+    sys.exit(2)
+  if outputformat not in ('csv', 'parquet', 'arrow'):
+    print('Warning: unknown output format', outputformat + ", must be one of 'csv', 'parquet' or 'arrow'.")
     sys.exit(2)
 
   print("Input file for EtherDelta trades is ", etherdeltafile)
   print("Decimals file for token decimals is ", decimalsfile)
-  print("Output file for preprocessed EtherDelta trades is ", outputfile)
-
-  # read EtherDelta trades
-  trades = pd.read_csv(etherdeltafile, header=0)
-
-  orig_len = len(trades)
-
-  print("Info: read", orig_len, "rows from EtherDelta file.")
+  print("Output file for preprocessed EtherDelta trades is ", outputfile, "(" + outputformat + ")")
+  if chunkrows is not None:
+    print("Info: streaming trades in chunks of", chunkrows, "rows.")
 
   ### DECIMALS
 
@@ -84,110 +160,47 @@ def main(argv):
 
   print("Info: read decimal information for", len(token_decimals), "tokens from Decimals file.")
 
-  ## Merge with tokens in EtherDelta data and fill missing decimals with 18
-  EtherDelta_tokens = pd.DataFrame(pd.unique(pd.concat([trades['tokenGet'], trades['tokenGive']], axis=0)), columns = ['address'])
-  # check if EtherDelta tokens are missing in decimals file
-  missing_EtherDelta_tokens = set(EtherDelta_tokens['address'].values) - set(token_decimals['address'].values)
-
-  if(len(missing_EtherDelta_tokens) > 0):
-    print("Warning:", len(missing_EtherDelta_tokens), "tokens in EtherDelta data have no decimal information in respective file. " +
-      "As a default, 18 will be taken as their decimal.")
-
-  token_decimals_all = pd.merge(token_decimals, EtherDelta_tokens,
-                                how = 'right') # keep only EtherDelta tokens
-
-  # replace NaN decimals with 18
-  token_decimals_all[['decimals']] = token_decimals_all[['decimals']].fillna(value = 18)
-  
-  ### TRANSFORM AND MERGE
-  # 
-  # Challenges:
-  # - safely convert the amount columns, which can have very large amounts (up to 55 digits)
-  # - transform values according to decimals
-  # 
-  # Steps
-  # 1. merge with decimals
-  # 2. convert amounts to float using astype
-  # 3. divide amounts by decimals
-  
-  ### TOKENGET
-
-  # left-merge trades with token_decimals on tokenGet, preserving key order of trades_real
-  trades_real = trades.merge(token_decimals_all, how="left", left_on="tokenGet", right_on="address")
+  # decimals are looked up per token, missing decimals are replaced with 18
+  token_decimals_map = dict(zip(token_decimals['address'], token_decimals['decimals']))
 
-  # drop now duplicated column
-  trades_real.drop(labels=["address"], axis=1, inplace=True)
+  ### READ, TRANSFORM AND WRITE
 
-  # convert to float & divide amount by decimals:
-  # copy columns
-  trades_real['amountBoughtReal'] = trades_real['amountGet']
-  # convert to float
-  trades_real = trades_real.astype({'amountBoughtReal': float})
-  # divide
-  trades_real['amountBoughtReal'] = trades_real['amountBoughtReal'].divide(10**trades_real['decimals'])
+  orig_len = 0
+  new_len = 0
+  EtherDelta_tokens = set()
+  writer = None
 
-  # drop decimal column
-  trades_real.drop(labels=['decimals'], axis=1, inplace=True)
+  # read EtherDelta trades
+  for trades in read_trades(etherdeltafile, COLUMN_TYPES, chunkrows):
+    orig_len += trades.num_rows
+    EtherDelta_tokens.update(pc.unique(trades.column('tokenGet')).to_pylist())
+    EtherDelta_tokens.update(pc.unique(trades.column('tokenGive')).to_pylist())
 
-  print("Info: converted column 'amountGet' to 'amountBoughtReal' as the trade amount of 'tokenGet', according to token decimals.")
+    trades_real = preprocess_trades(trades, token_decimals_map)
+    new_len += len(trades_real)
 
-  ### TOKENGIVE
+    # save in output format
+    writer = write_trades(trades_real, outputfile, outputformat, writer)
 
-  # left-merge trades with token_decimals on tokenGive, preserving key order of trades
-  trades_real = trades_real.merge(token_decimals_all, how="left", left_on="tokenGive", right_on="address")
+  close_trades_writer(writer)
 
-  # drop now duplicated column
-  trades_real.drop(labels=["address"], axis=1, inplace=True)
+  print("Info: read", orig_len, "rows from EtherDelta file.")
 
-  # convert to float & divide amount by decimals:
-  # copy columns
-  trades_real['amountSoldReal'] = trades_real['amountGive']
-  # convert to float
-  trades_real = trades_real.astype({'amountSoldReal': float})
-  # divide
-  trades_real['amountSoldReal'] = trades_real['amountSoldReal'].divide(10**trades_real['decimals'])
+  # check if EtherDelta tokens are missing in decimals file
+  missing_EtherDelta_tokens = EtherDelta_tokens - set(token_decimals['address'].values)
 
-  # drop decimal column
-  trades_real.drop(labels=['decimals'], axis=1, inplace=True)
+  if(len(missing_EtherDelta_tokens) > 0):
+    print("Warning:", len(missing_EtherDelta_tokens), "tokens in EtherDelta data have no decimal information in respective file. " +
+      "As a default, 18 was taken as their decimal.")
 
+  print("Info: converted column 'amountGet' to 'amountBoughtReal' as the trade amount of 'tokenGet', according to token decimals.")
   print("Info: converted column 'amountGive' to 'amountSoldReal' as the trade amount of 'tokenGive', according to token decimals.")
-
-  ### PRICE
-
-  # divide tokenGive by tokenGet to get the price of tokenGet in units of tokenGive
-  # (1 tokenGet = <price> tokenGive)
-  trades_real['price'] = trades_real['amountSoldReal'].divide(trades_real['amountBoughtReal'])
-
   print("Info: computed new column 'price' as price of tokenGet in units of tokenGive.")
 
-  ### EXPORT
-
-  # rename some columns
-  trades_real = trades_real.rename(columns={'transaction_hash':'transactionHash',
-                                            'block_number':'blockNumber',
-                                            'tokenGet':'tokenBuy',
-                                            'tokenGive':'tokenSell',
-                                            'get':'maker',
-                                            'give':'taker'
-                                           })
-
-  trades_real = trades_real[['blockNumber',
-                             'timestamp',
-                             'transactionHash',
-                             'maker',
-                             'taker',
-                             'tokenBuy',
-                             'tokenSell',
-                             'amountBoughtReal',
-                             'amountSoldReal',
-                             'price']]
-
   # still same number of rows
-  if len(trades_real) != orig_len:
-    print("Warning: dropped", orig_len - len(trades_real), "rows during Preprocessing.")
+  if new_len != orig_len:
+    print("Warning: dropped", orig_len - new_len, "rows during Preprocessing.")
 
-  # save as csv
-  trades_real.to_csv(outputfile, index=False)
   print("Info: saved file to " + outputfile)
 
 
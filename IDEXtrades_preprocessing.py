@@ -40,132 +40,52 @@
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import sys
 import getopt
 
-def main(argv):
-
-  # get input arguments
-  idexfile = ''
-  decimalsfile = ''
-  outputfile = ''
-  short_options = "hi:d:o:"
-  long_options = ["help", "idexfile=", "decimalsfile=" "outputfile="]
-  
-  try:
-    opts, args = getopt.getopt(argv, short_options, long_options)
-  except getopt.GetoptError:
-    print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile>')
-    sys.exit(2)
-  for opt, arg in opts:
-    if opt == '-h':
-      print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile>')
-      sys.exit()
-    elif opt in ("-i", "--idexfile"):
-      idexfile = arg
-    elif opt in ("-d", "--decimalsfile"):
-      decimalsfile = arg
-    elif opt in ("-o", "--outputfile"):
-      outputfile = arg
-  # if any argument is missing, stop
-  if (idexfile == '' or decimalsfile == '' or outputfile == ''):
-    print('Warning: missing arguments. Arguments need to be supplied as follows:')
-    print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile>')
-    sys.exit(2)
-
-  print("Input file for IDEX trades is ", idexfile)
-  print("Decimals file for token decimals is ", decimalsfile)
-  print("Output file for preprocessed IDEX trades is ", outputfile)
-
-  # read IDEX trades
-  trades = pd.read_csv(idexfile, header=0)
-
-  orig_len = len(trades)
+from token_amounts import decode_amounts
+from trade_files import close_trades_writer, read_trades, to_pandas, write_trades
 
-  print("Info: read", orig_len, "rows from IDEX file.")
 
-  ### DECIMALS
+# raw amount columns are read as strings, they can have up to 55 digits
+AMOUNT_COLUMNS = {'amountBuy': pa.string(), 'amountSell': pa.string(), 'amount': pa.string()}
 
-  # read token decimals file
-  token_decimals = pd.read_json(decimalsfile, orient="index")
-  token_decimals.reset_index(inplace=True)
-  token_decimals.drop(labels=["index", "name", "slug"], axis=1, inplace=True)
+# types of all columns of the export, so that every chunk is read with the same types
+COLUMN_TYPES = {'transaction_hash': pa.string(), 'status': pa.int64(), 'block_number': pa.int64(),
+                'gas': pa.int64(), 'gas_price': pa.int64(), 'timestamp': pa.int64(), 'expires': pa.int64(),
+                'nonce': pa.int64(), 'tradeNonce': pa.int64(), 'feeMake': pa.int64(), 'feeTake': pa.int64(),
+                'tokenBuy': pa.string(), 'tokenSell': pa.string(), 'maker': pa.string(), 'taker': pa.string(),
+                **AMOUNT_COLUMNS}
 
-  print("Info: read decimal information for", len(token_decimals), "tokens from Decimals file.")
 
-  ## Merge with tokens in IDEX data and fill missing decimals with 18
-  IDEX_tokens = pd.DataFrame(pd.unique(pd.concat([trades['tokenBuy'], trades['tokenSell']], axis=0)),
-                             columns = ['address'])
-  # check if IDEX tokens are missing in decimals file
-  missing_IDEX_tokens = set(IDEX_tokens['address'].values) - set(token_decimals['address'].values)
+def preprocess_trades(trades, token_decimals_map):
 
-  if(len(missing_IDEX_tokens) > 0):
-    print("Warning:", len(missing_IDEX_tokens), "tokens in IDEX data have no decimal information in respective file. " +
-      "As a default, 18 will be taken as their decimal.")
-
-  token_decimals_all = pd.merge(token_decimals, IDEX_tokens,
-                                how = 'right') # keep only IDEX tokens
-
-  # replace NaN decimals with 18
-  token_decimals_all[['decimals']] = token_decimals_all[['decimals']].fillna(value = 18)
-  
-  ### TRANSFORM AND MERGE
+  ### TRANSFORM
   # 
   # Challenges:
   # - safely convert the amount columns, which can have very large amounts (up to 55 digits)
   # - transform values according to decimals
   # 
   # Steps
-  # 1. merge with decimals
-  # 2. convert amounts to float using astype
-  # 3. divide amounts by decimals
-  
-  ### TOKENBUY
+  # 1. look up decimals of tokens, 18 if unknown
+  # 2. divide amounts by decimals, exactly on the digit strings (see token_amounts.py)
 
-  # left-merge trades with token_decimals on tokenBuy, preserving key order of trades_real
-  trades_real = trades.merge(token_decimals_all, how="left", left_on="tokenBuy", right_on="address")
+  trades_real = to_pandas(trades.drop_columns(list(AMOUNT_COLUMNS)))
 
-  # drop now duplicated column
-  trades_real.drop(labels=["address"], axis=1, inplace=True)
-
-  # convert to float & divide amount by decimals:
-  # copy columns
-  trades_real['amountBuyReal'] = trades_real['amountBuy']
-  trades_real['amountBoughtReal'] = trades_real['amount']
-  # convert to float
-  trades_real = trades_real.astype({'amountBuyReal': float, 'amountBoughtReal': float})
-  # divide
-  trades_real['amountBuyReal'] = trades_real['amountBuyReal'].divide(10**trades_real['decimals'])
-  trades_real['amountBoughtReal'] = trades_real['amountBoughtReal'].divide(10**trades_real['decimals'])
+  ### TOKENBUY
 
-  # drop decimal column
-  trades_real.drop(labels=['decimals'],
-                  axis=1, inplace=True)
+  decimals = trades_real['tokenBuy'].map(token_decimals_map).fillna(18)
 
-  print("Info: converted column 'amountBuy' to 'amountBuyReal' as the order amount of 'tokenBuy', " +
-    "and 'amount' to 'amountBoughtReal' as the trade amount of 'tokenBuy', according to token decimals.")
+  trades_real['amountBuyReal'] = decode_amounts(trades.column('amountBuy'), decimals)
+  trades_real['amountBoughtReal'] = decode_amounts(trades.column('amount'), decimals)
 
   ### TOKENSELL
 
-  # left-merge trades with token_decimals on tokenSell, preserving key order of trades
-  trades_real = trades_real.merge(token_decimals_all, how="left", left_on="tokenSell", right_on="address")
+  decimals = trades_real['tokenSell'].map(token_decimals_map).fillna(18)
 
-  # drop now duplicated column
-  trades_real.drop(labels=["address"], axis=1, inplace=True)
-
-  # convert to float & divide amount by decimals:
-  # copy columns
-  trades_real['amountSellReal'] = trades_real['amountSell']
-  # convert to float
-  trades_real = trades_real.astype({'amountSellReal': float})
-  # divide
-  trades_real['amountSellReal'] = trades_real['amountSellReal'].divide(10**trades_real['decimals'])
-
-  # drop decimal column
-  trades_real.drop(labels=['decimals'],
-                  axis=1, inplace=True)
-
-  print("Info: converted column 'amountSell' to 'amountSellReal' as the order amount of 'tokenSell', according to token decimals.")
+  trades_real['amountSellReal'] = decode_amounts(trades.column('amountSell'), decimals)
 
   ### PRICE AND AMOUNTSOLD
 
@@ -176,8 +96,6 @@ def main(argv):
   # price * actual amount bought = actual amount sold
   trades_real['amountSoldReal'] = trades_real['amountBoughtReal'].mul(trades_real['price'])
 
-  print("Info: computed new column 'price' as price of tokenBuy in units of tokenSell, and column 'amountSoldReal' as the trade amount of 'tokenSell'.")
-
   ### FEES
   # assumption: feeMake and feeTake are a percentage, represented as a number with 18 decimals
   # (source: https://gist.github.com/raypulver/2f318db5dc497cab8019d3ae391af1d2)
@@ -187,9 +105,6 @@ def main(argv):
   trades_real['feeMake'] = trades_real['feeMake'].divide(10**18)
   trades_real['feeTake'] = trades_real['feeTake'].divide(10**18)
 
-  print("Info: divided columns 'feeMake' and 'feeTake' by 10^18. " +
-    "For more information, see https://gist.github.com/raypulver/2f318db5dc497cab8019d3ae391af1d2.")
-
   ### EXPORT
 
   # rename some columns
@@ -220,12 +135,107 @@ def main(argv):
                              'tradeNonce',
                              'expires']]
 
+  return trades_real
+
+
+def main(argv):
+
+  # get input arguments
+  idexfile = ''
+  decimalsfile = ''
+  outputfile = ''
+  outputformat = 'csv'
+  chunkrows = None
+  short_options = "hi:d:o:f:c:"
+  long_options = ["help", "idexfile=", "decimalsfile=" "outputfile=", "format=", "chunk-rows="]
+  
+  try:
+    opts, args = getopt.getopt(argv, short_options, long_options)
+  except getopt.GetoptError:
+    print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt == '-h':
+      print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
+      sys.exit()
+    elif opt in ("-i", "--idexfile"):
+      idexfile = arg
+    elif opt in ("-d", "--decimalsfile"):
+      decimalsfile = arg
+    elif opt in ("-o", "--outputfile"):
+      outputfile = arg
+    elif opt in ("-f", "--format"):
+      outputformat = arg
+    elif opt in ("-c", "--chunk-rows"):
+      chunkrows = int(arg)
+  # if any argument is missing, stop
+  if (idexfile == '' or decimalsfile == '' or outputfile == ''):
+    print('Warning: missing arguments. Arguments need to be supplied as follows:')
+    print('IDEXtrades_preprocessing.py -i <idexfile> -d <decimalsfile> -o <outputfile> [-f <csv|parquet|arrow>] [-c <chunkrows>]')
+    sys.exit(2)
+  if outputformat not in ('csv', 'parquet', 'arrow'):
+    print('Warning: unknown output format', outputformat + ", must be one of 'csv', 'parquet' or 'arrow'.")
+    sys.exit(2)
+
+  print("Input file for IDEX trades is ", idexfile)
+  print("Decimals file for token decimals is ", decimalsfile)
+  print("Output file for preprocessed IDEX trades is ", outputfile, "(" + outputformat + ")")
+  if chunkrows is not None:
+    print("Info: streaming trades in chunks of", chunkrows, "rows.")
+
+  ### DECIMALS
+
+  # read token decimals file
+  token_decimals = pd.read_json(decimalsfile, orient="index")
+  token_decimals.reset_index(inplace=True)
+  token_decimals.drop(labels=["index", "name", "slug"], axis=1, inplace=True)
+
+  print("Info: read decimal information for", len(token_decimals), "tokens from Decimals file.")
+
+  # decimals are looked up per token, missing decimals are replaced with 18
+  token_decimals_map = dict(zip(token_decimals['address'], token_decimals['decimals']))
+
+  ### READ, TRANSFORM AND WRITE
+
+  orig_len = 0
+  new_len = 0
+  IDEX_tokens = set()
+  writer = None
+
+  # read IDEX trades
+  for trades in read_trades(idexfile, COLUMN_TYPES, chunkrows):
+    orig_len += trades.num_rows
+    IDEX_tokens.update(pc.unique(trades.column('tokenBuy')).to_pylist())
+    IDEX_tokens.update(pc.unique(trades.column('tokenSell')).to_pylist())
+
+    trades_real = preprocess_trades(trades, token_decimals_map)
+    new_len += len(trades_real)
+
+    # save in output format
+    writer = write_trades(trades_real, outputfile, outputformat, writer)
+
+  close_trades_writer(writer)
+
+  print("Info: read", orig_len, "rows from IDEX file.")
+
+  # check if IDEX tokens are missing in decimals file
+  missing_IDEX_tokens = IDEX_tokens - set(token_decimals['address'].values)
+
+  if(len(missing_IDEX_tokens) > 0):
+    print("Warning:", len(missing_IDEX_tokens), "tokens in IDEX data have no decimal information in respective file. " +
+      "As a default, 18 was taken as their decimal.")
+
+  print("Info: converted column 'amountBuy' to 'amountBuyReal' as the order amount of 'tokenBuy', " +
+    "and 'amount' to 'amountBoughtReal' as the trade amount of 'tokenBuy', according to token decimals.")
+  print("Info: converted column 'amountSell' to 'amountSellReal' as the order amount of 'tokenSell', according to token decimals.")
+  print("Info: computed new column 'price' as price of tokenBuy in units of tokenSell, and column 'amountSoldReal' as the trade amount of 'tokenSell'.")
+  print("Info: divided columns 'feeMake' and 'feeTake' by 10^18. " +
+    "For more information, see https://gist.github.com/raypulver/2f318db5dc497cab8019d3ae391af1d2.")
+
   # still same number of rows
-  if len(trades_real) != orig_len:
-    print("Warning: dropped", orig_len - len(trades_real), "rows during Preprocessing.")
+  if new_len != orig_len:
+    print("Warning: dropped", orig_len - new_len, "rows during Preprocessing.")
 
-  # save as csv
-  trades_real.to_csv(outputfile, index=False)
   print("Info: saved file to " + outputfile)
 
 
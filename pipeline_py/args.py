@@ -1,5 +1,13 @@
 import argparse
 
+def positive_int(value):
+    # type of options that must be an integer of at least 1
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run the pipeline for detecting wash trades.")
     
@@ -23,5 +31,146 @@ def parse_arguments():
                         help="Wash trade detection window size for second pass in seconds [default=None]")
     parser.add_argument('--washwindowsizesecondspass3', type=int, default=None,
                         help="Wash trade detection window size for third pass in seconds [default=None]")
+    parser.add_argument('--window-stride', type=positive_int, default=None,
+                        help="Stride of sliding wash trade detection windows in seconds. Windows larger than the "
+                             "stride are moved by the stride instead of their size, so that wash trades across "
+                             "window boundaries are found [default=None]")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes for SCC and wash trade detection [default=1]")
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet', 'arrow'],
+                        help="File format of the output tables, the trades file format is taken from its extension [default=csv]")
+    parser.add_argument('--graph-backend', type=str, default='networkx', choices=['networkx', 'csr'],
+                        help="Graph backend for SCC detection, either 'networkx' or 'csr' (SciPy) [default=networkx]")
+    parser.add_argument('--front-end', type=str, default='pandas', choices=['pandas', 'polars'],
+                        help="Library that loads, filters and prices the trades. 'polars' runs these steps as one lazy "
+                             "plan that only reads the needed rows and columns of the trades file, and passes polars "
+                             "trades to SCC and wash trade detection [default=pandas]")
+    parser.add_argument('--state', type=str, default=None,
+                        help="Folder with the state of the previous run. Only tokens and windows with new trades are "
+                             "recomputed, and the state is updated for the next run [default=None]")
+    parser.add_argument('--trader-registry', type=str, default=None,
+                        help="Folder with a persistent trader registry, trader ids stay the same across runs and DEXs "
+                             "and new traders are appended. Without it, trader ids are ranks of the sorted addresses "
+                             "[default=None]")
+    parser.add_argument('--store', type=str, default=None,
+                        help="Folder of an on-disk trade store. The prepared trades are written to it, partitioned by "
+                             "token, and SCC and wash trade detection read one token at a time, so that memory is "
+                             "bounded by the largest token instead of all trades [default=None]")
+    parser.add_argument('--store-by-month', action='store_true', default=False,
+                        help="Also partition the trade store by month (default=False)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Folder of the stage cache. Loading and preparing the trades, and SCC detection, are "
+                             "skipped if their inputs, parameters and code did not change [default=None]")
+    parser.add_argument('--cache-size-gb', type=float, default=10.0,
+                        help="Maximum size of the stage cache in GB, least recently used entries are removed "
+                             "[default=10]")
+    parser.add_argument('--shard', type=str, default=None,
+                        help="Shard i/N of a run on N processes: only the tokens hashed to shard i are processed and "
+                             "partial results are written to <output>/shard-<i>-of-<N>. Shards wait for the SCCs of "
+                             "each other, merge_shards.py combines their results [default=None]")
+    parser.add_argument('--shard-timeout', type=float, default=24*60*60,
+                        help="Seconds a shard waits for the SCCs of the other shards before it fails with the "
+                             "missing shards [default=86400]")
+    parser.add_argument('--profile', type=str, default=None,
+                        help="File for the wall time, CPU time, peak memory and row counts of every stage, token and "
+                             "SCC; a .json file is written as Chrome trace, any other as JSON lines [default=None]")
+
+    return parser.parse_args()
+
+
+def parse_merge_shards_arguments():
+    parser = argparse.ArgumentParser(description="Merge the results of the shards of a run.")
+
+    parser.add_argument('-o', '--output', type=str, default='output_IDEX',
+                        help="Output folder of the sharded run, with the shard folders; the merged results are "
+                             "written to it [default=output_IDEX]")
+
+    return parser.parse_args()
+
+def parse_sweep_arguments():
+    parser = argparse.ArgumentParser(description="Detect wash trades for a grid of parameters, sharing the trades and SCCs.")
+
+    parser.add_argument('-d', '--dex', type=str, default='IDEX',
+                        help="Name of DEX, must be either 'IDEX' or 'EtherDelta' [default=IDEX]")
+    parser.add_argument('-t', '--trades', type=str, default='data/IDEXTrades-preprocessed.csv',
+                        help="Trade dataset file name [default=data/IDEXTrades-preprocessed.csv]")
+    parser.add_argument('-p', '--prices', type=str, default='data/EtherDollarPrice.csv',
+                        help="Ether-Dollar-Price file name [default=data/EtherDollarPrice.csv]")
+    parser.add_argument('-o', '--output', type=str, default='output_sweep_IDEX',
+                        help="Output folder name [default=output_sweep_IDEX]")
+    parser.add_argument('--sccthresholdranks', type=int, nargs='+', default=[100],
+                        help="Thresholds for relevant SCC: rank [default=100]")
+    parser.add_argument('--margins', type=float, nargs='+', default=[0.1],
+                        help="Margins of mean left trader position for wash trade detection [default=0.1]")
+    parser.add_argument('--window-schedules', type=str, nargs='+', default=['604800'],
+                        help="Window schedules, each a comma-separated list of window sizes in seconds, one per pass, "
+                             "e.g. 3600,86400,604800 [default=604800]")
+    parser.add_argument('--washdetectionether', action='store_true', default=False,
+                        help="Should wash trades be detected for Ether amounts (default=False)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes for SCC detection and the parameter combinations [default=1]")
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet', 'arrow'],
+                        help="File format of the output tables, the trades file format is taken from its extension [default=csv]")
+    parser.add_argument('--graph-backend', type=str, default='networkx', choices=['networkx', 'csr'],
+                        help="Graph backend for SCC detection, either 'networkx' or 'csr' (SciPy) [default=networkx]")
+
+    return parser.parse_args()
+
+
+def parse_synthetic_arguments():
+    parser = argparse.ArgumentParser(description="Generate synthetic IDEX trades and Ether-Dollar prices.")
+
+    parser.add_argument('-n', '--n-trades', type=int, default=100000,
+                        help="Number of trades [default=100000]")
+    parser.add_argument('-t', '--trades', type=str, default='data/SyntheticTrades.parquet',
+                        help="Trades file name, the format is taken from its extension [default=data/SyntheticTrades.parquet]")
+    parser.add_argument('-p', '--prices', type=str, default='data/SyntheticEtherDollarPrice.csv',
+                        help="Ether-Dollar-Price file name [default=data/SyntheticEtherDollarPrice.csv]")
+    parser.add_argument('--traders', type=int, default=10000,
+                        help="Number of traders [default=10000]")
+    parser.add_argument('--tokens', type=int, default=100,
+                        help="Number of tokens [default=100]")
+    parser.add_argument('--wash-share', type=float, default=0.2,
+                        help="Share of trades in wash cycles [default=0.2]")
+    parser.add_argument('--tail-exponent', type=float, default=1.5,
+                        help="Pareto exponent of trader and token activity, smaller is more heavy-tailed [default=1.5]")
+    parser.add_argument('--days', type=int, default=365,
+                        help="Number of days covered by the trades [default=365]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed [default=0]")
+
+    return parser.parse_args()
+
+
+def parse_benchmark_arguments():
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic trades.")
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000],
+                        help="Numbers of trades to benchmark [default=10000 1000000 10000000]")
+    parser.add_argument('--data', type=str, default='benchmark_data',
+                        help="Folder of the generated trades, which are reused by later runs [default=benchmark_data]")
+    parser.add_argument('-r', '--results', type=str, default='benchmark_results.json',
+                        help="JSON file of the timings [default=benchmark_results.json]")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Runs per size, the minimum time per stage is reported [default=1]")
+    parser.add_argument('--traders', type=int, default=None,
+                        help="Number of traders [default=number of trades / 50]")
+    parser.add_argument('--tokens', type=int, default=None,
+                        help="Number of tokens [default=number of trades / 10000]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed of the generated trades [default=0]")
+    parser.add_argument('--sccthresholdrank', type=int, default=100,
+                        help="Threshold for relevant SCC: rank [default=100]")
+    parser.add_argument('-m', '--margin', type=float, default=0.01,
+                        help="Margin of mean left trader position for wash trade detection [default=0.01]")
+    parser.add_argument('--window-sizes', type=str, default='3600,86400,604800',
+                        help="Comma-separated wash trade detection window sizes in seconds, one per pass "
+                             "[default=3600,86400,604800]")
+    parser.add_argument('--washdetectionether', action='store_true', default=False,
+                        help="Should wash trades be detected for Ether amounts (default=False)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes for SCC and wash trade detection [default=1]")
+    parser.add_argument('--graph-backend', type=str, default='networkx', choices=['networkx', 'csr'],
+                        help="Graph backend for SCC detection, either 'networkx' or 'csr' (SciPy) [default=networkx]")
 
-    return parser.parse_args()
\ No newline at end of file
+    return parser.parse_args()
@@ -0,0 +1,3 @@
+# Synthetic trade sets and timings of the pipeline stages, run from pipeline_py:
+#   python -m benchmark.synthetic -n 100000 -t trades.parquet -p prices.csv
+#   python -m benchmark --sizes 10000 1000000 10000000 -r results.json
@@ -0,0 +1,142 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+# utils imports main, so it has to be imported first
+import utils
+import scc_registry
+from args import parse_benchmark_arguments
+from benchmark.synthetic import write_synthetic_data
+from scc import detect_scc_for_tokens_layered, get_relevant_scc_by_threshold
+from wtd import (detect_and_label_wash_trades_for_scc_using_multiple_passes, get_summary_of_wash_trades_per_scc_and_timewindow,
+                 get_windows_per_window_size)
+
+
+# Times the pipeline stages on synthetic trade sets of the given sizes and saves the timings as JSON.
+# Generated trade sets are kept in the data folder and reused, so that versions are compared on the same
+# trades. Every size is run repeat times, the JSON holds all timings and the minimum per stage.
+
+STAGES = ['load', 'filter', 'price_merge', 'self_trade_filter', 'add_trader_hashes', 'scc', 'wash_detection',
+          'summary']
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': sys.version.split()[0], 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'polars': pl.__version__}
+
+
+def run_stages(trades_file, prices_file, scc_threshold_rank=100, margin=0.01,
+               wash_window_sizes_seconds=[3600, 86400, 604800], ether=False, workers=1, graph_backend="networkx"):
+    timings = {}
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        result = function()
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    trades = timed('load', lambda: utils.load_trades(trades_file, utils.IDEX_TRADES_COLUMNS))
+    trades = timed('filter', lambda: utils.get_ether_token_trades(
+        utils.get_successful_and_complete_trades(trades, 'status', 1), 'tokenBuy', 'tokenSell'))
+    trades = timed('price_merge', lambda: utils.merge_trades_with_daily_usd_price(trades, prices_file))
+
+    def filter_self_trades():
+        l = utils.filter_self_trades(trades, False)
+        utils.summarize_self_trades(l['self_trades'], False)
+        return l['non_self_trades']
+    trades = timed('self_trade_filter', filter_self_trades)
+
+    trades, _ = timed('add_trader_hashes', lambda: utils.add_trader_hashes(
+        trades, pd.DataFrame(columns=['trader_address', 'trader_id'])))
+
+    registry = scc_registry.new_registry()
+    scc_dt = timed('scc', lambda: detect_scc_for_tokens_layered(trades, registry, workers=workers,
+                                                                graph_backend=graph_backend, save=False))
+    relevant_scc_ids = get_relevant_scc_by_threshold(scc_dt, scc_threshold_rank)
+
+    windows_per_window_size = get_windows_per_window_size(trades, wash_window_sizes_seconds)
+    wash_trades, trades_labeled = timed('wash_detection', lambda: detect_and_label_wash_trades_for_scc_using_multiple_passes(
+        trades, registry, relevant_scc_ids, wash_window_sizes_seconds, ether=ether, margin=margin,
+        workers=workers, save=False, windows_per_window_size=windows_per_window_size))
+    summary = timed('summary', lambda: get_summary_of_wash_trades_per_scc_and_timewindow(
+        wash_trades, 'multiple_windows', multiple_passes=True, save=False,
+        windows_per_window_size=windows_per_window_size))
+
+    counts = {'trades': len(trades), 'sccs': len(scc_dt), 'relevant_sccs': len(relevant_scc_ids),
+              'wash_trades': int(trades_labeled['wash_label'].sum()), 'summary_rows': len(summary)}
+    return timings, counts
+
+
+def benchmark(sizes=[10000, 1000000, 10000000],
+              data_folder="benchmark_data",
+              results_file="benchmark_results.json",
+              repeat=1,
+              n_traders=None,
+              n_tokens=None,
+              seed=0,
+              **pipeline_options):
+
+    os.makedirs(data_folder, exist_ok=True)
+    results = {'environment': get_environment(), 'options': dict(pipeline_options, repeat=repeat, seed=seed),
+               'sizes': []}
+
+    for n_trades in sizes:
+        # trader and token counts grow with the number of trades unless given
+        traders = n_traders or max(100, n_trades // 50)
+        tokens = n_tokens or max(10, n_trades // 10000)
+        trades_file = os.path.join(data_folder, f"trades-n{n_trades}-t{traders}-k{tokens}-s{seed}.parquet")
+        prices_file = os.path.join(data_folder, f"prices-s{seed}.csv")
+        if not os.path.exists(trades_file) or not os.path.exists(prices_file):
+            write_synthetic_data(trades_file, prices_file, n_trades, seed=seed, n_traders=traders, n_tokens=tokens)
+
+        runs = []
+        for _ in range(repeat):
+            timings, counts = run_stages(trades_file, prices_file, **pipeline_options)
+            runs.append(timings)
+
+        best = {stage: min(run[stage] for run in runs) for stage in STAGES}
+        results['sizes'].append({'n_trades': n_trades, 'n_traders': traders, 'n_tokens': tokens, 'counts': counts,
+                                 'seconds': best, 'total_seconds': sum(best.values()), 'runs': runs})
+        print(f"Info: {n_trades} trades: " + ", ".join(f"{stage} {best[stage]:.3f}s" for stage in STAGES))
+
+        # saved after every size, so that the results of smaller sizes survive an aborted large run
+        with open(results_file, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+    print(f"Info: saved benchmark results to {results_file}.")
+    return results
+
+
+def main():
+
+    args = parse_benchmark_arguments()
+
+    benchmark(sizes=args.sizes,
+              data_folder=args.data,
+              results_file=args.results,
+              repeat=args.repeat,
+              n_traders=args.traders,
+              n_tokens=args.tokens,
+              seed=args.seed,
+              scc_threshold_rank=args.sccthresholdrank,
+              margin=args.margin,
+              wash_window_sizes_seconds=[int(window_size) for window_size in args.window_sizes.split(',')],
+              ether=args.washdetectionether,
+              workers=args.workers,
+              graph_backend=args.graph_backend)
+
+
+if __name__ == "__main__":
+    main()
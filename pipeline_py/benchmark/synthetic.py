@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import table_io
+import utils
+from args import parse_synthetic_arguments
+
+
+# Synthetic IDEX trades with the columns of the preprocessed trades:
+# - background trades between traders of Pareto-distributed activity, so that few trader pairs trade
+#   very often and edge weights are heavy-tailed
+# - wash cycles: rings of 2 to 4 traders passing the same token amount around within minutes, with a
+#   Pareto-distributed number of cycles per ring
+# - a small share of self-trades and failed trades
+# All draws are vectorized, the generated trades only depend on the arguments and the seed.
+
+START_TIMESTAMP = 1514764800  # 2018-01-01
+SECONDS_PER_BLOCK = 15
+
+
+def get_addresses(prefix, n):
+    return np.array([f"0x{prefix}{i:038x}" for i in range(1, n + 1)], dtype=object)
+
+
+def get_heavy_tailed_probabilities(rng, n, tail_exponent):
+    weights = rng.pareto(tail_exponent, n) + 1
+    return weights / weights.sum()
+
+
+def generate_trades(n_trades, n_traders=10000, n_tokens=100, wash_share=0.2, n_rings=None, tail_exponent=1.5,
+                    self_trade_share=0.005, failed_share=0.01, days=365, seed=0):
+    rng = np.random.default_rng(seed)
+    traders = get_addresses("aa", n_traders)
+    tokens = get_addresses("70", n_tokens)
+    trader_p = get_heavy_tailed_probabilities(rng, n_traders, tail_exponent)
+    token_p = get_heavy_tailed_probabilities(rng, n_tokens, tail_exponent)
+
+    # wash cycles, each ring of 2 to 4 traders trades one token
+    n_rings = n_rings if n_rings is not None else max(1, n_traders // 100)
+    ring_sizes = rng.integers(2, 5, n_rings)
+    ring_members = np.stack([rng.choice(n_traders, 4, replace=False) for _ in range(n_rings)])
+    ring_tokens = rng.choice(n_tokens, n_rings, p=token_p)
+    cycle_rings = rng.choice(n_rings, int(wash_share * n_trades) // 2 + 1,
+                             p=get_heavy_tailed_probabilities(rng, n_rings, tail_exponent))
+    n_cycles = np.searchsorted(np.cumsum(ring_sizes[cycle_rings]), wash_share * n_trades)
+    cycle_rings = cycle_rings[:n_cycles]
+    cycle_lengths = ring_sizes[cycle_rings]
+    n_wash = int(cycle_lengths.sum())
+
+    wash_ring = np.repeat(cycle_rings, cycle_lengths)
+    wash_cycle = np.repeat(np.arange(n_cycles), cycle_lengths)
+    wash_step = np.arange(n_wash) - np.repeat(np.cumsum(cycle_lengths) - cycle_lengths, cycle_lengths)
+    wash_buyer = ring_members[wash_ring, wash_step]
+    wash_seller = ring_members[wash_ring, (wash_step + 1) % ring_sizes[wash_ring]]
+    wash_timestamp = rng.integers(0, days * 86400, n_cycles)[wash_cycle] + wash_step * rng.integers(1, 300, n_wash)
+    wash_amount = np.round(rng.pareto(tail_exponent, n_cycles) * 100 + 1, 4)[wash_cycle]
+
+    # background trades, self-trades have the same buyer and seller
+    n_other = n_trades - n_wash
+    other_buyer = rng.choice(n_traders, n_other, p=trader_p)
+    other_seller = rng.choice(n_traders, n_other, p=trader_p)
+    self_trades = rng.random(n_other) < self_trade_share
+    other_seller = np.where(self_trades, other_buyer,
+                            np.where(other_seller == other_buyer, (other_seller + 1) % n_traders, other_seller))
+
+    eth_buyer = np.concatenate([wash_buyer, other_buyer])
+    eth_seller = np.concatenate([wash_seller, other_seller])
+    token = np.concatenate([ring_tokens[wash_ring], rng.choice(n_tokens, n_other, p=token_p)])
+    timestamp = START_TIMESTAMP + np.concatenate([wash_timestamp, rng.integers(0, days * 86400, n_other)])
+    amount_token = np.concatenate([wash_amount, np.round(rng.pareto(tail_exponent, n_other) * 100 + 0.01, 4)])
+    amount_eth = amount_token * np.exp(rng.normal(-7, 2, n_tokens))[token]
+
+    # the ether buyer is the maker if the maker buys ether, the taker otherwise
+    buy_eth = rng.random(n_trades) < 0.5
+    order = np.argsort(timestamp, kind='stable')
+    eth_buyer, eth_seller, token, timestamp = eth_buyer[order], eth_seller[order], token[order], timestamp[order]
+    amount_token, amount_eth = amount_token[order], amount_eth[order]
+
+    token_address = tokens[token]
+    amount_bought = np.where(buy_eth, amount_eth, amount_token)
+    amount_sold = np.where(buy_eth, amount_token, amount_eth)
+
+    return pd.DataFrame({
+        'blockNumber': 5000000 + (timestamp - START_TIMESTAMP) // SECONDS_PER_BLOCK,
+        'timestamp': timestamp,
+        'transactionHash': [f"0x{i:064x}" for i in rng.permutation(n_trades)],
+        'status': np.where(rng.random(n_trades) < failed_share, 0, 1),
+        'maker': np.where(buy_eth, traders[eth_buyer], traders[eth_seller]),
+        'taker': np.where(buy_eth, traders[eth_seller], traders[eth_buyer]),
+        'tokenBuy': np.where(buy_eth, utils.global_ether_id, token_address),
+        'tokenSell': np.where(buy_eth, token_address, utils.global_ether_id),
+        'amountBuyReal': amount_bought,
+        'amountBoughtReal': amount_bought,
+        'amountSellReal': amount_sold,
+        'amountSoldReal': amount_sold,
+        'price': amount_sold / amount_bought,
+        'feeMake': 0.001,
+        'feeTake': 0.002,
+        'gas': 250000,
+        'gasPrice': 1e9,
+        'nonce': 1,
+        'tradeNonce': 1,
+        'expires': 10000,
+    })
+
+
+def generate_prices(days=365, seed=0):
+    # daily Ether/USD prices in the format of EtherDollarPrice.csv, covering the trades and one day after
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(pd.to_datetime(START_TIMESTAMP, unit='s') - pd.Timedelta(days=1), periods=days + 3)
+    return pd.DataFrame({
+        'Date(UTC)': dates.strftime('%m/%d/%Y'),
+        'UnixTimeStamp': dates.values.astype('datetime64[s]').astype(np.int64),
+        'Value': np.round(500 * np.exp(np.cumsum(rng.normal(0, 0.03, len(dates)))), 2),
+    })
+
+
+def write_synthetic_data(trades_file, prices_file, n_trades, seed=0, **options):
+    # trades in the format given by the file extension, prices as csv
+    trades = generate_trades(n_trades, seed=seed, **options)
+    folder, filename = os.path.split(os.path.abspath(trades_file))
+    os.makedirs(folder, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(prices_file)), exist_ok=True)
+    trades_file = table_io.write_table(trades, folder, filename, table_io.get_file_format(trades_file))
+    generate_prices(options.get('days', 365), seed).to_csv(prices_file, index=False)
+    print(f"Info: wrote {len(trades)} synthetic trades to {trades_file} and prices to {prices_file}.")
+    return trades_file
+
+
+def main():
+
+    args = parse_synthetic_arguments()
+
+    write_synthetic_data(args.trades, args.prices, args.n_trades, seed=args.seed, n_traders=args.traders,
+                         n_tokens=args.tokens, wash_share=args.wash_share, tail_exponent=args.tail_exponent,
+                         days=args.days)
+
+
+if __name__ == "__main__":
+    main()
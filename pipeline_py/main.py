@@ -1,10 +1,23 @@
 import os
+import sys
+
 import pandas as pd
+import polars as pl
 
+import profiling
+import run_state
+import scc
+import scc_registry
+import shards
+import stage_cache
+import table_io
+import trade_store
+import trader_registry
 import utils
 from args import parse_arguments
 from scc import detect_scc_for_tokens_layered, get_relevant_scc_by_threshold
-from wtd import detect_and_label_wash_trades_for_scc_using_multiple_passes, get_summary_of_wash_trades_per_scc_and_timewindow
+from wtd import (detect_and_label_wash_trades_for_scc_using_multiple_passes, detect_and_label_wash_trades_in_store,
+                 get_summary_of_wash_trades_per_scc_and_timewindow, get_windows_per_window_size)
 
 
 global_ether_id = "0x0000000000000000000000000000000000000000"
@@ -20,14 +33,91 @@ def main():
     if args.washwindowsizesecondspass3 is not None:
         wash_window_sizes_args.append(int(args.washwindowsizesecondspass3))
 
-    pipeline(trades_file=args.trades,
-                        prices_file=args.prices,
-                        dex_type=args.dex,
-                        output_folder=args.output,
-                        scc_threshold_rank=args.sccthresholdrank,
-                        wash_trade_detection_ether=args.washdetectionether,
-                        wash_trade_detection_margin=args.margin,
-                        wash_window_sizes_seconds=wash_window_sizes_args)
+    # Record the stages, tokens and SCCs of the run, see profiling.py
+    if args.profile is not None:
+        profiling.start()
+    try:
+        with profiling.span("pipeline", memory=True):
+            pipeline(trades_file=args.trades,
+                     prices_file=args.prices,
+                     dex_type=args.dex,
+                     output_folder=args.output,
+                     scc_threshold_rank=args.sccthresholdrank,
+                     wash_trade_detection_ether=args.washdetectionether,
+                     wash_trade_detection_margin=args.margin,
+                     wash_window_sizes_seconds=wash_window_sizes_args,
+                     window_stride=args.window_stride,
+                     workers=args.workers,
+                     graph_backend=args.graph_backend,
+                     file_format=args.format,
+                     front_end=args.front_end,
+                     state_folder=args.state,
+                     registry_folder=args.trader_registry,
+                     store_folder=args.store,
+                     store_by_month=args.store_by_month,
+                     cache_folder=args.cache,
+                     cache_size_gb=args.cache_size_gb,
+                     shard=shards.parse_shard(args.shard) if args.shard is not None else None,
+                     shard_timeout=args.shard_timeout)
+    finally:
+        if args.profile is not None:
+            profiling.save(args.profile, profiling.stop())
+
+
+
+def get_trades_code_key():
+    # code of the trades stage: prepare_trades in this module and the modules it runs
+    return stage_cache.get_code_key(sys.modules[__name__], utils, table_io, trader_registry)
+
+
+def get_scc_code_key():
+    # code of the scc stage: scc and the modules it runs; the numba kernels only if numba is installed
+    return stage_cache.get_code_key(scc, scc_registry, scc.numba_kernels, run_state, trade_store, table_io)
+
+
+def prepare_trades(trades_file, prices_file, dex_type, output_folder, file_format, global_trader_hashes,
+                   registry=None, registry_folder=None, front_end="pandas"):
+
+    if front_end == "polars":
+        # Load, filter and merge with USD price as one lazy polars plan, the trades stay polars from here on
+        with profiling.span("price_merge", memory=True) as record:
+            trades = utils.load_priced_trades(trades_file, prices_file, dex_type)
+            record['rows'] = len(trades)
+    else:
+        # Load and prepare trades
+        with profiling.span("load", memory=True) as record:
+            trades = utils.load_trades(trades_file, utils.IDEX_TRADES_COLUMNS if dex_type == "IDEX" else utils.EtherDelta_TRADES_COLUMNS)
+            record['rows'] = len(trades)
+
+        # Merge with USD price
+        with profiling.span("price_merge", memory=True) as record:
+            if dex_type == "IDEX":
+                trades = utils.get_successful_and_complete_trades(trades, 'status', 1)
+                trades = utils.get_ether_token_trades(trades, 'tokenBuy', 'tokenSell')
+                trades = utils.merge_trades_with_daily_usd_price(trades, prices_file)
+            else:  # EtherDelta
+                trades = utils.get_successful_and_complete_trades(trades)
+                trades = utils.get_ether_token_trades(trades, 'tokenBuy', 'tokenSell')
+                trades = utils.merge_EtherDelta_trades_with_daily_usd_price(trades, prices_file)
+            record['rows'] = len(trades)
+
+
+    # Filter self trades
+    with profiling.span("self_trade_filter", memory=True) as record:
+        l = utils.filter_self_trades(trades, True, output_folder, file_format=file_format)
+        utils.summarize_self_trades(l['self_trades'], True, output_folder, file_format=file_format)
+        trades = l['non_self_trades']
+        record.update(rows=len(trades), self_trades=len(l['self_trades']))
+
+
+    # Add trader hashes
+    with profiling.span("add_trader_hashes", memory=True) as record:
+        trades, trader_hashes = utils.add_trader_hashes(trades, global_trader_hashes, registry)
+        if registry is not None:
+            trader_registry.save_registry(registry_folder, registry)
+        record.update(rows=len(trades), traders=len(trader_hashes))
+
+    return trades, trader_hashes
 
 
 
@@ -38,56 +128,152 @@ def pipeline(trades_file,
                       scc_threshold_rank=100,
                       wash_trade_detection_ether=True,
                       wash_trade_detection_margin=0.1,
-                      wash_window_sizes_seconds=[60*60*24*7]):
+                      wash_window_sizes_seconds=[60*60*24*7],
+                      window_stride=None,
+                      workers=1,
+                      graph_backend="networkx",
+                      file_format="csv",
+                      front_end="pandas",
+                      state_folder=None,
+                      registry_folder=None,
+                      store_folder=None,
+                      store_by_month=False,
+                      cache_folder=None,
+                      cache_size_gb=10.0,
+                      shard=None,
+                      shard_timeout=None):
     
     os.makedirs(output_folder, exist_ok=True)
 
-    # Initialize variables
-    global_trader_hashes = pd.DataFrame(columns=['trader_address', 'trader_id'])
-    global_scc_traders_map = {}
+    # A shard (index, number of shards) writes its partial results to its own folder, see shards.py
+    shards_folder = output_folder
+    if shard is not None:
+        if state_folder is not None or registry_folder is not None or store_folder is not None:
+            raise ValueError("Shards cannot be combined with a state, trader registry or store")
+        output_folder = shards.make_shard_folder(shards_folder, *shard)
 
+    # Load the state of the previous run, results for unchanged tokens and windows are reused
+    state = None
+    if state_folder is not None:
+        state_settings = run_state.get_settings(dex_type=dex_type, wash_trade_detection_ether=wash_trade_detection_ether,
+                                                wash_trade_detection_margin=wash_trade_detection_margin,
+                                                graph_backend=graph_backend)
+        state = run_state.load_state(state_folder, state_settings)
 
-    # Load and prepare trades
-    trades = utils.load_trades(trades_file)
+    # Initialize variables
+    global_trader_hashes = pd.DataFrame(columns=['trader_address', 'trader_id'])
+    global_scc_registry = scc_registry.new_registry()
+    registry = trader_registry.load_registry(registry_folder) if registry_folder is not None else None
 
-    # Merge with USD price
-    if dex_type == "IDEX":
-        trades = utils.get_successful_and_complete_trades(trades, 'status', 1)
-        trades = utils.get_ether_token_trades(trades, 'tokenBuy', 'tokenSell')
-        trades = utils.merge_trades_with_daily_usd_price(trades, prices_file)
-    else:  # EtherDelta
-        trades = utils.get_successful_and_complete_trades(trades)
-        trades = utils.get_ether_token_trades(trades, 'tokenBuy', 'tokenSell')
-        trades = utils.merge_EtherDelta_trades_with_daily_usd_price(trades, prices_file)
+    # Stages before wash trade detection are cached by their inputs, parameters and code
+    cache = stage_cache.open_cache(cache_folder, cache_size_gb) if cache_folder is not None else None
+    if cache is not None:
+        trades_key = stage_cache.get_stage_key(
+            'trades', trades=stage_cache.get_file_key(cache, trades_file),
+            prices=stage_cache.get_file_key(cache, prices_file), dex_type=dex_type, file_format=file_format,
+            front_end=front_end,
+            registry=(stage_cache.get_file_key(cache, os.path.join(registry_folder, "addresses.npy"))
+                      if registry is not None and len(registry['addresses']) > 0 else None),
+            code=get_trades_code_key())
+        scc_key = stage_cache.get_stage_key('scc', trades=trades_key, graph_backend=graph_backend,
+                                            file_format=file_format, code=get_scc_code_key())
+    else:
+        trades_key = scc_key = None
 
+    trades, global_trader_hashes = stage_cache.run_stage(
+        cache, 'trades', trades_key,
+        [table_io.get_file_name(output_folder, name, file_format) for name in ["self_trades", "self_trades_summary"]],
+        lambda: prepare_trades(trades_file, prices_file, dex_type, output_folder, file_format,
+                               global_trader_hashes, registry, registry_folder, front_end))
 
-    # Filter self trades
-    l = utils.filter_self_trades(trades, True, output_folder)
-    utils.summarize_self_trades(l['self_trades'], True, output_folder)
-    trades = l['non_self_trades']
+    if shard is not None:
+        run_key = shards.get_run_key(trades_file, prices_file, shard[1], cache=cache, dex_type=dex_type,
+                                     scc_threshold_rank=scc_threshold_rank, ether=wash_trade_detection_ether,
+                                     margin=wash_trade_detection_margin, window_sizes=wash_window_sizes_seconds,
+                                     window_stride=window_stride, graph_backend=graph_backend,
+                                     file_format=file_format, front_end=front_end)
+        shards.run_shard(trades, global_trader_hashes, shards_folder, *shard, run_key,
+                         scc_threshold_rank=scc_threshold_rank, wash_window_sizes_seconds=wash_window_sizes_seconds,
+                         window_stride=window_stride, ether=wash_trade_detection_ether,
+                         margin=wash_trade_detection_margin, workers=workers, graph_backend=graph_backend,
+                         file_format=file_format, timeout=shard_timeout)
+        return
 
+    # With a store, the prepared trades are only kept on disk and the stages below read them per token
+    store = None
+    if store_folder is not None:
+        with profiling.span("store", memory=True):
+            store = trade_store.write_store(trades, store_folder, by_month=store_by_month)
+        trades = store
 
-    # Add trader hashes
-    trades, trader_hashes = utils.add_trader_hashes(trades, global_trader_hashes)
-    global_trader_hashes = trader_hashes
+    if state is not None and state['last_block'] is not None:
+        if store is not None:
+            n_new_trades, n_new_tokens = trade_store.count_new_trades(store, state['last_block'])
+        elif front_end == "polars":
+            new_trades = trades.filter(pl.col('blockNumber') > state['last_block'])
+            n_new_trades, n_new_tokens = len(new_trades), new_trades['token'].n_unique()
+        else:
+            new_trades = trades[trades['blockNumber'] > state['last_block']]
+            n_new_trades, n_new_tokens = len(new_trades), new_trades['token'].nunique()
+        print(f"Info: {n_new_trades} trades in {n_new_tokens} tokens after block {state['last_block']}.")
 
     # Detect SCC
-    scc_dt = detect_scc_for_tokens_layered(trades, global_scc_traders_map, save=True, folder=output_folder)
+    def detect_scc():
+        scc_dt = detect_scc_for_tokens_layered(trades, global_scc_registry, workers=workers, graph_backend=graph_backend,
+                                               save=True, folder=output_folder, file_format=file_format,
+                                               cache=state['scc'] if state is not None else None)
+        return scc_dt, global_scc_registry
+
+    with profiling.span("scc", memory=True) as record:
+        scc_dt, global_scc_registry = stage_cache.run_stage(
+            cache, 'scc', scc_key,
+            [table_io.get_file_name(output_folder, name, file_format) for name in ["scc", "scc-mapping"]],
+            detect_scc)
+        record['sccs'] = len(scc_dt)
+    if state is not None and not state['scc']['current']:
+        # SCCs were taken from the stage cache, the SCCs of the previous run stay in the state
+        state['scc']['current'] = state['scc']['previous']
     relevant_scc_ids = get_relevant_scc_by_threshold(scc_dt, scc_threshold_rank)
 
     # Detect and label wash trades
-    wash_trades, trades_labeled = detect_and_label_wash_trades_for_scc_using_multiple_passes(
-        trades, global_scc_traders_map, relevant_scc_ids, wash_window_sizes_seconds, 
-        ether=wash_trade_detection_ether, margin=wash_trade_detection_margin, 
-        save=True, folder=output_folder)
+    windows_per_window_size = get_windows_per_window_size(trade_store.get_bounds(store) if store is not None else trades,
+                                                          wash_window_sizes_seconds, window_stride=window_stride)
+    with profiling.span("wash_detection", memory=True) as record:
+        if store is not None:
+            wash_trades, _ = detect_and_label_wash_trades_in_store(
+                store, global_scc_registry, relevant_scc_ids, wash_window_sizes_seconds, windows_per_window_size,
+                ether=wash_trade_detection_ether, margin=wash_trade_detection_margin,
+                workers=workers, save=True, folder=output_folder, file_format=file_format,
+                cache=state['wash'] if state is not None else None)
+            record['rows'] = store['n_trades']
+        else:
+            wash_trades, trades_labeled = detect_and_label_wash_trades_for_scc_using_multiple_passes(
+                trades, global_scc_registry, relevant_scc_ids, wash_window_sizes_seconds, 
+                ether=wash_trade_detection_ether, margin=wash_trade_detection_margin, 
+                workers=workers, save=True, folder=output_folder, file_format=file_format,
+                cache=state['wash'] if state is not None else None, windows_per_window_size=windows_per_window_size)
+            record['rows'] = len(trades_labeled)
+        record['relevant_sccs'] = len(relevant_scc_ids)
     
     # Summarize wash trades (only for EtherDelta in the original, but can be useful for both)
-    wash_trades_multiple_passes_summary = get_summary_of_wash_trades_per_scc_and_timewindow(
-        wash_trades, 'multiple_windows', multiple_passes=True, save=True, folder=output_folder)
+    with profiling.span("summary", memory=True) as record:
+        wash_trades_multiple_passes_summary = get_summary_of_wash_trades_per_scc_and_timewindow(
+            wash_trades, 'multiple_windows', multiple_passes=True, save=True, folder=output_folder, file_format=file_format,
+            windows_per_window_size=windows_per_window_size)
+        record['rows'] = len(wash_trades_multiple_passes_summary)
 
     # Get address clusters
-    utils.get_address_clusters(trades, global_scc_traders_map, global_trader_hashes, relevant_scc_ids, 
-                         save=True, folder=output_folder)
+    with profiling.span("address_clusters"):
+        utils.get_address_clusters(trades, global_scc_registry, global_trader_hashes, relevant_scc_ids, 
+                             save=True, folder=output_folder)
+
+    # Save the state for the next run
+    if state is not None:
+        n_trades = store['n_trades'] if store is not None else len(trades)
+        last_block = trade_store.get_last_block(store) if store is not None else trades['blockNumber'].max()
+        state['last_block'] = int(last_block) if n_trades > 0 else state['last_block']
+        state['traders'] = global_trader_hashes
+        run_state.save_state(state_folder, state, state_settings)
 
 
 
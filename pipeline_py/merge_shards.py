@@ -0,0 +1,18 @@
+# utils imports main, so it has to be imported first
+import utils
+from args import parse_merge_shards_arguments
+from shards import merge_shards
+
+
+# Combines the partial results of the shards of a run (main.py --shard i/N) into the outputs of a single run.
+
+
+def main():
+
+    args = parse_merge_shards_arguments()
+
+    merge_shards(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import numba
+import numpy as np
+
+
+# Numba versions of the inner loops of wash trade and SCC detection, on integer-encoded NumPy arrays. They
+# are used when numba is installed (see wtd.py and scc.py) and give the same results as the Python versions:
+# floating point operations are done in the same order, and means are summed pairwise as numpy does.
+
+
+@numba.njit(cache=True)
+def _pairwise_sum(values, start, end):
+    # sum of values[start:end] in the order of np.sum: blocks of up to 128 values are summed in 8 partial
+    # sums, longer ranges are split in halves
+    n = end - start
+    if n < 8:
+        total = 0.0
+        for i in range(start, end):
+            total += values[i]
+        return total
+    if n <= 128:
+        partial = values[start:start + 8].copy()
+        i = start + 8
+        while i < end - n % 8:
+            for j in range(8):
+                partial[j] += values[i + j]
+            i += 8
+        total = ((partial[0] + partial[1]) + (partial[2] + partial[3])) + ((partial[4] + partial[5]) + (partial[6] + partial[7]))
+        for i in range(end - n % 8, end):
+            total += values[i]
+        return total
+    half = n // 2
+    half -= half % 8
+    return _pairwise_sum(values, start, start + half) + _pairwise_sum(values, start + half, end)
+
+
+@numba.njit(cache=True)
+def _get_max(abs_balances, traders):
+    # first of the largest balances of the given traders, as max() and list.index() of the Python version
+    max_balance, max_trader = abs_balances[traders[0]], traders[0]
+    for trader in traders[1:]:
+        if abs_balances[trader] > max_balance:
+            max_balance, max_trader = abs_balances[trader], trader
+    return max_balance, max_trader
+
+
+@numba.njit(cache=True)
+def detect_wash_trade_prefixes(buyer_codes, seller_codes, amounts, group_offsets, n_traders, margin, mean_rtol):
+    # see wtd.detect_wash_trade_prefixes_batched
+    n_groups = len(group_offsets) - 1
+    prefix_lengths = np.zeros(n_groups, dtype=np.int64)
+    balances = np.zeros(n_traders)
+    abs_balances = np.zeros(n_traders)
+    in_group = np.zeros(n_traders, dtype=np.bool_)
+    group_traders = np.empty(n_traders, dtype=np.int64)
+
+    for g in range(n_groups):
+        start, end = group_offsets[g], group_offsets[g + 1]
+        if end - start < 2:
+            continue
+
+        # balances after all trades of the group, buyer first, then seller
+        n_group_traders = 0
+        for idx in range(start, end):
+            for trader in (buyer_codes[idx], seller_codes[idx]):
+                if not in_group[trader]:
+                    in_group[trader] = True
+                    group_traders[n_group_traders] = trader
+                    n_group_traders += 1
+            balances[buyer_codes[idx]] += amounts[idx]
+            balances[seller_codes[idx]] += -amounts[idx]
+        traders = np.sort(group_traders[:n_group_traders])
+        for trader in traders:
+            abs_balances[trader] = abs(balances[trader])
+        max_balance, max_trader = _get_max(abs_balances, traders)
+
+        prefix_sums = np.cumsum(amounts[start:end])
+
+        for idx in range(end - 1, start, -1):
+            n = idx - start + 1
+            mean_trade_vol = abs(prefix_sums[n - 1] / n)
+
+            decided = True
+            is_wash = False
+            if max_balance == 0:
+                is_wash = margin >= 0
+            elif mean_trade_vol == 0:
+                decided = False
+            else:
+                ratio = max_balance / mean_trade_vol
+                if abs(ratio - margin) > ratio * mean_rtol:
+                    is_wash = ratio <= margin
+                else:
+                    decided = False
+
+            if not decided:
+                mean_trade_vol = _pairwise_sum(amounts, start, idx + 1) / n
+                if mean_trade_vol == 0:
+                    mean_trade_vol = 1.0
+                is_wash = max_balance / abs(mean_trade_vol) <= margin
+
+            if is_wash:
+                prefix_lengths[g] = n
+                break
+
+            # revert trade idx: buyer first, then seller
+            amount = amounts[idx]
+            for trader, delta in ((buyer_codes[idx], amount), (seller_codes[idx], -amount)):
+                balances[trader] -= delta
+                abs_balance = abs(balances[trader])
+                abs_balances[trader] = abs_balance
+                if abs_balance >= max_balance:
+                    max_balance, max_trader = abs_balance, trader
+                elif trader == max_trader:
+                    max_balance, max_trader = _get_max(abs_balances, traders)
+
+        for trader in traders:
+            balances[trader] = 0.0
+            abs_balances[trader] = 0.0
+            in_group[trader] = False
+
+    return prefix_lengths
+
+
+@numba.njit(cache=True)
+def _get_window_test(buyer_codes, seller_codes, amounts, lo, hi, max_balance, amount_sum, margin, mean_rtol):
+    # see wtd.get_window_test
+    n = hi - lo
+    mean_trade_vol = abs(amount_sum / n)
+    if max_balance == 0:
+        return margin >= 0
+    if mean_trade_vol != 0 and max_balance > mean_trade_vol * mean_rtol:
+        ratio = max_balance / mean_trade_vol
+        if abs(ratio - margin) > ratio * mean_rtol:
+            return ratio <= margin
+
+    exact_balances = np.zeros(max(buyer_codes[lo:hi].max(), seller_codes[lo:hi].max()) + 1)
+    for idx in range(lo, hi):
+        exact_balances[buyer_codes[idx]] += amounts[idx]
+        exact_balances[seller_codes[idx]] += -amounts[idx]
+    mean_trade_vol = _pairwise_sum(amounts, lo, hi) / n
+    if mean_trade_vol == 0:
+        mean_trade_vol = 1.0
+    return np.abs(exact_balances).max() / abs(mean_trade_vol) <= margin
+
+
+@numba.njit(cache=True)
+def detect_wash_trades_sliding(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders, margin,
+                               window_start, window_size, window_stride, mean_rtol):
+    # see wtd.detect_wash_trades_sliding, returns the marks of the tested windows: +1 at the first and -1
+    # after the last trade of every window of wash trades
+    marks = np.zeros(len(amounts) + 1, dtype=np.int64)
+
+    for g in range(len(group_offsets) - 1):
+        start, end = group_offsets[g], group_offsets[g + 1]
+        if end - start < 2:
+            continue
+
+        balances = np.zeros(n_traders)
+        abs_balances = np.zeros(n_traders)
+        window_trades = np.zeros(n_traders, dtype=np.int64)
+        all_traders = np.arange(n_traders)
+        max_balance, max_trader = 0.0, 0
+        amount_sum = 0.0
+
+        lo = hi = start
+        k = int(np.floor((timestamps[start] - window_start - window_size) / window_stride)) + 1
+        while True:
+            window_lo = window_start + k * window_stride
+            window_hi = window_lo + window_size
+
+            while True:
+                if lo < hi and timestamps[lo] < window_lo:
+                    idx, sign = lo, -1
+                    lo += 1
+                elif hi < end and timestamps[hi] < window_hi:
+                    idx, sign = hi, 1
+                    hi += 1
+                else:
+                    break
+
+                # buyer first, then seller
+                amount = amounts[idx]
+                amount_sum = amount_sum + sign * amount if hi > lo else 0.0
+                for trader, delta in ((buyer_codes[idx], sign * amount), (seller_codes[idx], -sign * amount)):
+                    window_trades[trader] += sign
+                    balances[trader] = balances[trader] + delta if window_trades[trader] > 0 else 0.0
+                    abs_balance = abs(balances[trader])
+                    abs_balances[trader] = abs_balance
+                    if abs_balance >= max_balance:
+                        max_balance, max_trader = abs_balance, trader
+                    elif trader == max_trader:
+                        max_balance, max_trader = _get_max(abs_balances, all_traders)
+
+                if hi - lo >= 2 and _get_window_test(buyer_codes, seller_codes, amounts, lo, hi, max_balance,
+                                                     amount_sum, margin, mean_rtol):
+                    marks[lo] += 1
+                    marks[hi] -= 1
+
+            # next window position whose trades differ: the oldest trade leaves or the next trade enters
+            if lo >= hi and hi >= end:
+                break
+            if lo < hi:
+                next_k = int(np.floor((timestamps[lo] - window_start) / window_stride)) + 1
+            if hi < end:
+                entering_k = int(np.floor((timestamps[hi] - window_start - window_size) / window_stride)) + 1
+                next_k = entering_k if lo >= hi else min(next_k, entering_k)
+            k = max(k + 1, next_k)
+
+    return marks
+
+
+@numba.njit(cache=True)
+def _get_strong_components(n_traders, src, dst):
+    # labels of the strongly connected components, from an iterative Tarjan on the edges in CSR form
+    indptr = np.zeros(n_traders + 1, dtype=np.int64)
+    for e in range(len(src)):
+        indptr[src[e] + 1] += 1
+    indptr = np.cumsum(indptr)
+    adjacent = np.empty(len(src), dtype=np.int64)
+    fill = indptr[:-1].copy()
+    for e in range(len(src)):
+        adjacent[fill[src[e]]] = dst[e]
+        fill[src[e]] += 1
+
+    index = np.full(n_traders, -1, dtype=np.int64)
+    low = np.zeros(n_traders, dtype=np.int64)
+    on_stack = np.zeros(n_traders, dtype=np.bool_)
+    stack = np.empty(n_traders, dtype=np.int64)
+    call_vertices = np.empty(n_traders, dtype=np.int64)
+    call_edges = np.empty(n_traders, dtype=np.int64)
+    labels = np.full(n_traders, -1, dtype=np.int64)
+    n_labels = 0
+    counter = 0
+    stack_size = 0
+
+    for root in range(n_traders):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack[stack_size] = root
+        stack_size += 1
+        on_stack[root] = True
+        call_vertices[0], call_edges[0] = root, indptr[root]
+        depth = 1
+
+        while depth > 0:
+            v, e = call_vertices[depth - 1], call_edges[depth - 1]
+            if e < indptr[v + 1]:
+                call_edges[depth - 1] = e + 1
+                w = adjacent[e]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack[stack_size] = w
+                    stack_size += 1
+                    on_stack[w] = True
+                    call_vertices[depth], call_edges[depth] = w, indptr[w]
+                    depth += 1
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+            else:
+                depth -= 1
+                if low[v] == index[v]:
+                    while True:
+                        stack_size -= 1
+                        w = stack[stack_size]
+                        on_stack[w] = False
+                        labels[w] = n_labels
+                        if w == v:
+                            break
+                    n_labels += 1
+                if depth > 0:
+                    u = call_vertices[depth - 1]
+                    low[u] = min(low[u], low[v])
+
+    return labels, n_labels
+
+
+@numba.njit(cache=True)
+def detect_scc_layers(src, dst, weights, n_traders):
+    # see scc.detect_scc_layers_by_threshold_sweep_csr. Returns the thresholds of the layers with an SCC,
+    # for each layer the first SCC and the number of SCCs if they were determined anew (first SCC -1 if
+    # the SCCs of the previous layer are kept), and the members of the SCCs, a slice of members per SCC
+    # given by scc_offsets. Members are sorted and the SCCs of a layer are ordered by their first member.
+    thresholds = np.unique(weights)
+    layer_first_scc = np.full(len(thresholds), -1, dtype=np.int64)
+    layer_n_sccs = np.zeros(len(thresholds), dtype=np.int64)
+    members = []
+    scc_offsets = [0]
+    n_layers = 0
+    n_sccs = -1
+
+    for i in range(len(thresholds)):
+        # drop the edges that do not reach this threshold
+        keep = weights >= thresholds[i]
+        if n_sccs == -1 or not keep.all():
+            src, dst, weights = src[keep], dst[keep], weights[keep]
+
+            # Find strongly connected components, only edges within an SCC are kept
+            labels, n_labels = _get_strong_components(n_traders, src, dst)
+            sizes = np.bincount(labels, minlength=n_labels)
+            within_scc = (labels[src] == labels[dst]) & (sizes[labels[src]] > 1)
+            src, dst, weights = src[within_scc], dst[within_scc], weights[within_scc]
+
+            scc_of_label = np.full(n_labels, -1, dtype=np.int64)
+            n_sccs = 0
+            for trader in range(n_traders):
+                if sizes[labels[trader]] > 1 and scc_of_label[labels[trader]] == -1:
+                    scc_of_label[labels[trader]] = n_sccs
+                    n_sccs += 1
+            scc_sizes = np.zeros(n_sccs, dtype=np.int64)
+            for label in range(n_labels):
+                if scc_of_label[label] >= 0:
+                    scc_sizes[scc_of_label[label]] = sizes[label]
+            first_member = len(members)
+            fill = np.cumsum(scc_sizes) - scc_sizes + first_member
+            for _ in range(scc_sizes.sum()):
+                members.append(0)
+            for trader in range(n_traders):
+                scc = scc_of_label[labels[trader]]
+                if sizes[labels[trader]] > 1:
+                    members[fill[scc]] = trader
+                    fill[scc] += 1
+            layer_first_scc[i] = len(scc_offsets) - 1
+            layer_n_sccs[i] = n_sccs
+            for size in scc_sizes:
+                scc_offsets.append(scc_offsets[-1] + size)
+
+        if n_sccs == 0:
+            break
+        n_layers = i + 1
+
+    return (thresholds[:n_layers], layer_first_scc[:n_layers], layer_n_sccs[:n_layers],
+            np.array(scc_offsets, dtype=np.int64), np.array(members, dtype=np.int64))
@@ -0,0 +1,104 @@
+import contextlib
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is not recorded there
+    resource = None
+
+
+# Spans of the pipeline stages, tokens and SCCs, in the Chrome trace event format (complete events, with
+# timestamps and durations in microseconds). Profiling is off unless started, then span() returns a shared
+# no-op context and annotate() returns at once. Worker processes start their own profile and return their
+# events, which are added to the profile of the main process.
+
+_events = None
+_open_spans = []
+_DISABLED = contextlib.nullcontext({})
+
+
+def is_enabled():
+    return _events is not None
+
+
+def start():
+    global _events
+    _events = []
+
+
+def stop():
+    global _events
+    events, _events = _events, None
+    _open_spans.clear()
+    return events or []
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def span(name, category="stage", memory=False, **args):
+    # records the wall and CPU time of the with block, and peak memory if asked; the yielded args can be
+    # extended in the block, e.g. with row counts
+    if _events is None:
+        return _DISABLED
+    return _span(name, category, memory, args)
+
+
+@contextlib.contextmanager
+def _span(name, category, memory, args):
+    start_ns = time.time_ns()
+    cpu_start_ns = time.process_time_ns()
+    _open_spans.append(args)
+    try:
+        yield args
+    finally:
+        _open_spans.pop()
+        args['cpu_ms'] = (time.process_time_ns() - cpu_start_ns) / 1e6
+        if memory:
+            args.update(get_peak_rss_mb() or {})
+        add_event(name, category, start_ns, time.time_ns() - start_ns, args)
+
+
+def annotate(**args):
+    # adds args to the innermost open span
+    if _events is not None and _open_spans:
+        _open_spans[-1].update(args)
+
+
+def add_event(name, category, start_ns, duration_ns, args, pid=None):
+    if _events is None:
+        return
+    _events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start_ns / 1000, 'dur': duration_ns / 1000,
+                    'pid': pid or os.getpid(), 'tid': 0, 'args': args})
+
+
+def add_events(events):
+    if _events is not None:
+        _events.extend(events)
+
+
+def timed_call(function, *args, **kwargs):
+    # calls function, also in a worker process, and returns its result with start, duration and CPU time
+    start_ns = time.time_ns()
+    cpu_start_ns = time.process_time_ns()
+    result = function(*args, **kwargs)
+    return result, (start_ns, time.time_ns() - start_ns, (time.process_time_ns() - cpu_start_ns) / 1e6, os.getpid())
+
+
+def save(file, events):
+    # a .json file is written as Chrome trace (chrome://tracing, Perfetto), any other file as JSON lines
+    events = sorted(events, key=lambda event: event['ts'])
+    with open(file, "w") as outfile:
+        if file.endswith(".json"):
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outfile)
+        else:
+            for event in events:
+                outfile.write(json.dumps(event) + "\n")
+    print(f"Info: saved {len(events)} profile events to {file}.")
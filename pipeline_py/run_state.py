@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+
+# State of an incremental run, kept in a folder between runs:
+# - state.json: settings of the run and the last processed block
+# - traders: trader registry (trader_address, trader_id) of the run
+# - scc_cache: SCCs per token, keyed by the content of the token's trade graph
+# - wash_cache: wash trade prefix length per window, keyed by the content of the window
+# Results are only reused for content that is unchanged, so an incremental run gives the same output as
+# a full run. Changed settings (or a different polars version, whose row hashes are used) start over.
+
+STATE_VERSION = 1
+
+# seeds of the row hashes and multipliers for combining them, one per half of a content key
+_KEY_SEEDS = [(11, 0x9E3779B97F4A7C15), (23, 0xC2B2AE3D27D4EB4F)]
+
+
+def get_group_keys(rows, group_offsets):
+    # Order-sensitive content key of every group of consecutive rows of the polars DataFrame rows,
+    # groups are given as slices group_offsets[g]:group_offsets[g+1]. Returns a list of (int, int).
+    group_offsets = np.asarray(group_offsets, dtype=np.int64)
+    lengths = np.diff(group_offsets)
+    if len(lengths) == 0:
+        return []
+    position = np.arange(len(rows)) - np.repeat(group_offsets[:-1], lengths)
+
+    halves = []
+    for seed, multiplier in _KEY_SEEDS:
+        # polynomial hash of the row hashes, arithmetic modulo 2^64
+        powers = np.cumprod(np.full(max(lengths.max(), 1), multiplier, dtype=np.uint64))
+        terms = np.append(rows.hash_rows(seed=seed).to_numpy() * powers[position], np.uint64(0))
+        sums = np.add.reduceat(terms, group_offsets[:-1])
+        sums[lengths == 0] = 0
+        halves.append((sums + lengths.astype(np.uint64)).tolist())
+
+    return list(zip(*halves))
+
+
+def new_cache(previous=None):
+    # results of the previous run, and the ones looked up or computed in this run
+    return {'previous': previous or {}, 'current': {}}
+
+
+def get_cached(cache, key):
+    value = cache['current'].get(key)
+    if value is None:
+        value = cache['previous'].get(key)
+        if value is not None:
+            cache['current'][key] = value
+    return value
+
+
+def set_cached(cache, key, value):
+    cache['current'][key] = value
+
+
+def get_settings(**settings):
+    return dict(settings, state_version=STATE_VERSION, polars_version=pl.__version__)
+
+
+def load_state(folder, settings):
+    state = {'last_block': None, 'traders': None, 'scc': new_cache(), 'wash': new_cache()}
+
+    state_file = os.path.join(folder, "state.json")
+    if not os.path.exists(state_file):
+        print(f"Info: no state in {folder}, running on all trades.")
+        return state
+
+    with open(state_file) as infile:
+        saved = json.load(infile)
+    if saved['settings'] != settings:
+        print(f"Info: settings differ from the state in {folder}, running on all trades.")
+        return state
+
+    state['last_block'] = saved['last_block']
+    state['traders'] = pd.read_parquet(os.path.join(folder, "traders.parquet"))
+    address_of_id = dict(zip(state['traders']['trader_id'].tolist(), state['traders']['trader_address'].tolist()))
+
+    # SCCs per token as (trader addresses, occurrence) in the order of the SCC map, ids of the saved run
+    # are only valid with its registry
+    scc_cache = {}
+    for row in (pl.read_parquet(os.path.join(folder, "scc_cache.parquet"))
+                .group_by(['key_hi', 'key_lo', 'scc'], maintain_order=True)
+                .agg(pl.col('occurrence').first(), pl.col('trader_id'))
+                .iter_rows()):
+        key_hi, key_lo, scc, occurrence, trader_ids = row
+        sccs = scc_cache.setdefault((key_hi, key_lo), [])
+        if scc >= 0:
+            sccs.append((tuple(address_of_id[t] for t in trader_ids), occurrence))
+    state['scc'] = new_cache(scc_cache)
+
+    wash_cache = pl.read_parquet(os.path.join(folder, "wash_cache.parquet"))
+    state['wash'] = new_cache(dict(zip(zip(wash_cache['key_hi'].to_list(), wash_cache['key_lo'].to_list()),
+                                       wash_cache['prefix_length'].to_list())))
+
+    print(f"Info: loaded state from {folder} up to block {state['last_block']}, "
+          f"{len(scc_cache)} token graphs and {len(wash_cache)} windows.")
+    return state
+
+
+def save_state(folder, state, settings):
+    os.makedirs(folder, exist_ok=True)
+
+    # state.json is written last, a run that fails in between leaves no state rather than a mixed one
+    state_file = os.path.join(folder, "state.json")
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+    state['traders'].to_parquet(os.path.join(folder, "traders.parquet"), index=False)
+    trader_ids = dict(zip(state['traders']['trader_address'].tolist(), state['traders']['trader_id'].tolist()))
+
+    # one row per SCC member, tokens without SCC get a single row with scc -1
+    rows = []
+    for (key_hi, key_lo), sccs in state['scc']['current'].items():
+        if len(sccs) == 0:
+            rows.append((key_hi, key_lo, -1, 0, None))
+        for scc, (addresses, occurrence) in enumerate(sccs):
+            rows.extend((key_hi, key_lo, scc, occurrence, trader_ids[a]) for a in addresses)
+    pl.DataFrame(rows, schema={'key_hi': pl.UInt64, 'key_lo': pl.UInt64, 'scc': pl.Int32,
+                               'occurrence': pl.Int64, 'trader_id': pl.Int64},
+                 orient='row').write_parquet(os.path.join(folder, "scc_cache.parquet"))
+
+    wash_cache = state['wash']['current']
+    pl.DataFrame({'key_hi': [key[0] for key in wash_cache], 'key_lo': [key[1] for key in wash_cache],
+                  'prefix_length': list(wash_cache.values())},
+                 schema={'key_hi': pl.UInt64, 'key_lo': pl.UInt64, 'prefix_length': pl.Int64}
+                 ).write_parquet(os.path.join(folder, "wash_cache.parquet"))
+
+    with open(state_file, "w") as outfile:
+        json.dump({'settings': settings, 'last_block': state['last_block']}, outfile)
+
+    print(f"Info: saved state to {folder} up to block {state['last_block']}.")
@@ -1,70 +1,285 @@
 from collections import Counter
+from functools import partial
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import polars as pl
 import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from tqdm import tqdm
-import hashlib
 
-def detect_scc_for_tokens_layered(trades, global_scc_traders_map, save=True, folder="output", filename="scc"):
+import profiling
+import run_state
+import scc_registry
+import table_io
+import trade_store
 
-    # convert trades to polars
-    trades = pl.from_pandas(trades)
+try:
+    import numba_kernels
+except ImportError:  # numba is not installed, SciPy finds the SCCs of the csr backend
+    numba_kernels = None
 
-    # Get unique tokens
-    token_vector = trades['token'].unique()
-    results = []
-    
-    # Iterate through each token
-    for token in tqdm(token_vector, desc="Processing tokens"):
-        token_trades = trades.filter(pl.col('token') == token)
+def detect_scc_layers_by_threshold_sweep(g, registry, occurrences):
+    # Layer k of the weighted graph g contains the edges with weight >= k, layers are peeled until no
+    # SCC with more than one trader is left. All layers between two distinct edge weights have the same
+    # graph, so the SCCs are only determined once per distinct weight and counted for every layer they
+    # span. If none of the edges dropped at a threshold lies within an SCC, the SCCs are reused as is.
+    # SCCs are added to the registry (see scc_registry.py), occurrences are counted per SCC id.
+    edges_by_weight = {}
+    for u, v, w in g.edges(data='weight'):
+        edges_by_weight.setdefault(w, []).append((u, v))
+
+    previous_threshold = 0
+    sccs = None
+    scc_of_trader = {}
+
+    for threshold in sorted(edges_by_weight):
+        # drop the edges that do not reach this threshold
+        dropped_edges = edges_by_weight.get(previous_threshold, [])
+        if dropped_edges:
+            g.remove_edges_from(dropped_edges)
+            g.remove_nodes_from(list(nx.isolates(g)))
+
+        if sccs is None or any(scc_of_trader.get(u, -1) == scc_of_trader.get(v, -2) for u, v in dropped_edges):
+            # Find strongly connected components
+            sccs = [sorted(comp) for comp in nx.strongly_connected_components(g) if len(comp) > 1]
+            scc_of_trader = {trader: i for i, scc in enumerate(sccs) for trader in scc}
+            scc_ids = [scc_registry.add_scc(registry, sorted_members) for sorted_members in sccs]
+
+        if len(sccs) == 0:
+            break
+
+        for scc_id in scc_ids:
+            occurrences[scc_id] += threshold - previous_threshold
+
+        previous_threshold = threshold
+
+
+
+def detect_scc_layers_by_threshold_sweep_csr(buyer_ids, seller_ids, weights, registry, occurrences, jit=None):
+    # Same layers as detect_scc_layers_by_threshold_sweep on a compressed sparse row graph. Edges are
+    # masked by weight for each threshold, and only edges within an SCC are kept for the next one,
+    # as no other edge can be part of an SCC in a higher layer. SCCs of a layer are ordered by their
+    # smallest trader id. jit selects the numba kernel, by default if numba is installed.
+    trader_ids, codes = np.unique(np.concatenate([buyer_ids, seller_ids]), return_inverse=True)
+    n_traders = len(trader_ids)
+    if numba_kernels is not None if jit is None else jit:
+        detect_scc_layers_jit(trader_ids, codes[:len(buyer_ids)], codes[len(buyer_ids):], weights, registry,
+                              occurrences)
+        return
+    src = codes[:len(buyer_ids)].astype(np.int32)
+    dst = codes[len(buyer_ids):].astype(np.int32)
+    weights = np.asarray(weights, dtype=np.int32)
+
+    previous_threshold = 0
+    sccs = None
+
+    for threshold in np.unique(weights).tolist():
+        # drop the edges that do not reach this threshold
+        keep = weights >= threshold
+        if sccs is None or not keep.all():
+            src, dst, weights = src[keep], dst[keep], weights[keep]
+
+            # Find strongly connected components
+            graph = csr_matrix((np.ones(len(src), dtype=np.int32), (src, dst)), shape=(n_traders, n_traders))
+            _, labels = connected_components(graph, directed=True, connection='strong')
+            sizes = np.bincount(labels)
+
+            within_scc = (labels[src] == labels[dst]) & (sizes[labels[src]] > 1)
+            src, dst, weights = src[within_scc], dst[within_scc], weights[within_scc]
+
+            members = np.flatnonzero(sizes[labels] > 1)
+            members = members[np.argsort(labels[members], kind='stable')]
+            splits = np.flatnonzero(np.diff(labels[members])) + 1
+            sccs = sorted((trader_ids[scc] for scc in np.split(members, splits) if len(scc) > 0),
+                          key=lambda sorted_members: sorted_members[0])
+            scc_ids = [scc_registry.add_scc(registry, sorted_members) for sorted_members in sccs]
+
+        if len(sccs) == 0:
+            break
+
+        for scc_id in scc_ids:
+            occurrences[scc_id] += threshold - previous_threshold
+
+        previous_threshold = threshold
+
+
+def detect_scc_layers_jit(trader_ids, src, dst, weights, registry, occurrences):
+    # detect_scc_layers_by_threshold_sweep_csr with the layers of numba_kernels.detect_scc_layers
+    thresholds, layer_first_scc, layer_n_sccs, scc_offsets, members = numba_kernels.detect_scc_layers(
+        np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64), np.asarray(weights, dtype=np.int64),
+        len(trader_ids))
+    scc_offsets = scc_offsets.tolist()
+
+    previous_threshold = 0
+    for threshold, first_scc, n_sccs in zip(thresholds.tolist(), layer_first_scc.tolist(), layer_n_sccs.tolist()):
+        if first_scc >= 0:
+            scc_ids = [scc_registry.add_scc(registry, trader_ids[members[scc_offsets[i]:scc_offsets[i + 1]]])
+                       for i in range(first_scc, first_scc + n_sccs)]
+
+        for scc_id in scc_ids:
+            occurrences[scc_id] += threshold - previous_threshold
+
+        previous_threshold = threshold
+
+
+
+def get_token_edges(trades):
+    # one pass over all trades: weighted buyer -> seller edges per token, in order of first appearance
+    edges = (trades
+             .group_by(['token', 'eth_buyer_id', 'eth_seller_id'], maintain_order=True)
+             .agg(pl.len().alias('weight'), pl.col('eth_buyer').first(), pl.col('eth_seller').first()))
+    return edges.partition_by('token', maintain_order=True, include_key=False, as_dict=True)
 
-        edges = Counter((row['eth_buyer_id'], row['eth_seller_id']) for row in token_trades.select(['eth_buyer_id', 'eth_seller_id']).to_dicts())
-        
+
+def get_token_edges_keys(token_edges):
+    # content key of every token's graph, on trader addresses, which unlike trader ids are stable across runs
+    if len(token_edges) == 0:
+        return []
+    edges = pl.concat([edges.select(['eth_buyer', 'eth_seller', 'weight']) for edges in token_edges.values()])
+    group_offsets = np.concatenate([[0], np.cumsum([len(edges) for edges in token_edges.values()])])
+    return run_state.get_group_keys(edges, group_offsets)
+
+
+def sccs_to_addresses(members, offsets, occurrences, address_of_id):
+    return [(tuple(address_of_id[t] for t in members[offsets[i]:offsets[i + 1]].tolist()), occurrence)
+            for i, occurrence in enumerate(occurrences.tolist())]
+
+
+def sccs_from_addresses(sccs, trader_ids):
+    registry = scc_registry.new_registry()
+    occurrences = Counter()
+    for addresses, occurrence in sccs:
+        occurrences[scc_registry.add_scc(registry, sorted(trader_ids[a] for a in addresses))] += occurrence
+    return get_token_sccs(registry, occurrences)
+
+
+def get_token_sccs(registry, occurrences):
+    # SCCs of a token as members, offsets (see scc_registry.get_sccs) and occurrences, in order of detection
+    members, offsets = scc_registry.get_sccs(registry)
+    return members, offsets, np.array([occurrences[i] for i in range(len(offsets) - 1)], dtype=np.int64)
+
+
+def detect_scc_for_token_edges(buyer_ids, seller_ids, weights, graph_backend="networkx"):
+    registry = scc_registry.new_registry()
+    occurrences = Counter()
+
+    if graph_backend == "csr":
+        detect_scc_layers_by_threshold_sweep_csr(np.asarray(buyer_ids), np.asarray(seller_ids), weights,
+                                                 registry, occurrences)
+    elif graph_backend == "networkx":
         g = nx.DiGraph()
-        for (u, v), w in edges.items(): 
+        for u, v, w in zip(buyer_ids, seller_ids, weights):
             g.add_edge(u, v, weight=w)
+        detect_scc_layers_by_threshold_sweep(g, registry, occurrences)
+    else:
+        raise ValueError(f"Unknown graph backend '{graph_backend}', must be either 'networkx' or 'csr'")
 
-        while g.number_of_nodes() > 0:
-            # Find strongly connected components
-            sccs = [list(comp) for comp in nx.strongly_connected_components(g) if len(comp) > 1]
-
-            if len(sccs) == 0:
-                break
-            
-            for scc in sccs:
-                sorted_members = sorted(scc)
-                c_hash = hashlib.md5(','.join(str(sorted_members)).encode()).hexdigest()
-                global_scc_traders_map[c_hash] = sorted_members
-                results.append(c_hash)
-
-            # Decrease weights by one
-            zero_weight_edges = []
-            for u, v, d in g.edges(data=True):
-                d['weight'] -= 1
-                if d['weight'] == 0:
-                    zero_weight_edges.append((u, v))
-            
-            # Remove zero-weight edges and isolated nodes
-            g.remove_edges_from(zero_weight_edges)
-            g.remove_nodes_from(list(nx.isolates(g)))
+    return get_token_sccs(registry, occurrences)
 
-    
-    # Create DataFrame for results
-    scc_df = pd.DataFrame({'scc_hash': results})
-    scc_summary = scc_df.groupby('scc_hash').size().reset_index(name='occurrence')
-    scc_summary['num_traders'] = scc_summary['scc_hash'].apply(lambda x: len(global_scc_traders_map[x]))
-    
+
+def detect_scc_for_tokens_layered(trades, registry, workers=1, graph_backend="networkx",
+                                  save=True, folder="output", filename="scc", file_format="csv", cache=None,
+                                  first_tokens=None):
+
+    # Get edges per token; trades are a pandas or polars DataFrame or a trade store (see trade_store.py),
+    # which is read one token group at a time. The SCCs of all tokens are added to the registry, see
+    # scc_registry.py.
+    if isinstance(trades, dict):
+        token_edges = {}
+        for tokens in tqdm(trades['token_groups'], desc="Reading tokens"):
+            token_edges.update(get_token_edges(trade_store.read_tokens(
+                trades, tokens, ['token', 'eth_buyer_id', 'eth_seller_id', 'eth_buyer', 'eth_seller'])))
+        token_edges = {(token,): token_edges[(token,)] for token in trades['tokens']}
+    else:
+        token_edges = get_token_edges(trades if isinstance(trades, pl.DataFrame) else pl.from_pandas(trades))
+    tasks = [(edges['eth_buyer_id'].to_list(), edges['eth_seller_id'].to_list(), edges['weight'].to_list())
+             for edges in token_edges.values()]
+
+    # with a cache, only tokens whose graph changed since the previous run are processed
+    results = [None] * len(tasks)
+    if cache is not None:
+        keys = get_token_edges_keys(token_edges)
+        trader_ids = {}
+        for edges in token_edges.values():
+            trader_ids.update(zip(edges['eth_buyer'].to_list(), edges['eth_buyer_id'].to_list()))
+            trader_ids.update(zip(edges['eth_seller'].to_list(), edges['eth_seller_id'].to_list()))
+        address_of_id = {trader_id: address for address, trader_id in trader_ids.items()}
+        for i, key in enumerate(keys):
+            sccs = run_state.get_cached(cache, key)
+            if sccs is not None:
+                results[i] = sccs_from_addresses(sccs, trader_ids)
+    todo = [i for i, result in enumerate(results) if result is None]
+    if cache is not None:
+        print(f"Info: reusing the SCCs of {len(tasks) - len(todo)} unchanged tokens, detecting SCCs for {len(todo)} tokens.")
+
+    # Iterate through each token, with the time of every token if profiling
+    detect = partial(detect_scc_for_token_edges, graph_backend=graph_backend)
+    if profiling.is_enabled():
+        detect = partial(profiling.timed_call, detect)
+    if workers <= 1:
+        computed = [detect(*tasks[i]) for i in tqdm(todo, desc="Processing tokens")]
+    elif len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunksize = max(1, len(todo) // (workers * 4))
+            computed = list(tqdm(executor.map(detect, *zip(*[tasks[i] for i in todo]), chunksize=chunksize),
+                                 total=len(todo), desc="Processing tokens"))
+    else:
+        computed = []
+
+    if profiling.is_enabled():
+        tokens = list(token_edges.keys())
+        for i, (result, (start_ns, duration_ns, cpu_ms, pid)) in zip(todo, computed):
+            profiling.add_event(f"token {tokens[i][0]}", "scc_token", start_ns, duration_ns,
+                                {'token': tokens[i][0], 'edges': len(tasks[i][0]), 'sccs': len(result[2]),
+                                 'cpu_ms': cpu_ms}, pid=pid)
+        computed = [result for result, _ in computed]
+
+    for i, result in zip(todo, computed):
+        results[i] = result
+        if cache is not None:
+            run_state.set_cached(cache, keys[i], sccs_to_addresses(*result, address_of_id))
+
+    # merge in token order, so that SCCs are registered in the order of a serial run; first_tokens, if
+    # given, is filled with the token in which every SCC was found first
+    occurrences = Counter()
+    for (token,), (members, offsets, token_occurrences) in zip(token_edges.keys(), results):
+        scc_ids = scc_registry.add_sccs(registry, members, offsets).tolist()
+        occurrences.update(dict(zip(scc_ids, token_occurrences.tolist())))
+        if first_tokens is not None:
+            for scc_id in scc_ids:
+                first_tokens.setdefault(scc_id, token)
+
+    scc_summary = get_scc_summary(occurrences, registry)
     if save:
-        # Save the results
-        scc_summary.to_csv(f"{folder}/{filename}.csv", index=False)
-        
-        mapping = pd.DataFrame([(k, v) for k, values in global_scc_traders_map.items() for v in values], columns=['hash', 'trader_id'])
-        mapping.to_csv(f"{folder}/{filename}-mapping.csv", index=False)
+        save_scc(scc_summary, registry, folder, filename, file_format)
     
     return scc_summary
 
 
+def get_scc_summary(occurrences, registry):
+    # Create DataFrame for results, occurrences are given per SCC id
+    scc_summary = pd.DataFrame({'scc_hash': scc_registry.get_hashes(registry),
+                                'occurrence': [occurrences[i] for i in range(scc_registry.get_n_sccs(registry))],
+                                'num_traders': scc_registry.get_sizes(registry)},
+                               columns=['scc_hash', 'occurrence', 'num_traders'])
+    scc_summary = scc_summary.sort_values('scc_hash').reset_index(drop=True)
+    return scc_summary
+
+
+def save_scc(scc_summary, registry, folder="output", filename="scc", file_format="csv"):
+    # Save the results
+    table_io.write_table(scc_summary, folder, filename, file_format)
+
+    members, offsets = scc_registry.get_sccs(registry)
+    mapping = pd.DataFrame({'hash': np.repeat(np.array(scc_registry.get_hashes(registry), dtype=object), np.diff(offsets)),
+                            'trader_id': members.astype(np.int64)}, columns=['hash', 'trader_id'])
+    table_io.write_table(mapping, folder, f"{filename}-mapping", file_format)
+
+
 
 def get_relevant_scc_by_threshold(scc_df, threshold):
     relevant_sccs = scc_df[scc_df['occurrence'] >= threshold]
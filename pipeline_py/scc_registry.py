@@ -0,0 +1,145 @@
+import hashlib
+
+import numpy as np
+
+
+# Interned SCC memberships, kept in a dict:
+# - members: sorted int32 trader ids of all SCCs in one buffer, SCC i (in order of registration) has
+#   members[offsets[i]:offsets[i + 1]]; both arrays grow by doubling, only the first n_sccs SCCs are valid
+# - lookup: SCC id per 64-bit hash (blake2b) of the members, so that an SCC found in many layers and
+#   tokens is stored once; hash collisions are resolved by comparing the members
+# - hashes, ids: md5 hashes of the outputs ("scc_hash") and their SCC ids, made once per SCC on export
+# - trader_index: SCCs of every trader id (reverse index), made when first needed
+# Functions outside of this module refer to SCCs by their md5 hash, as the outputs do.
+
+def new_registry():
+    return {'members': np.empty(64, dtype=np.int32), 'offsets': np.zeros(17, dtype=np.int64), 'n_sccs': 0,
+            'lookup': {}, 'hashes': [], 'ids': {}, 'trader_index': None}
+
+
+def get_n_sccs(registry):
+    return registry['n_sccs']
+
+
+def get_sizes(registry):
+    return np.diff(registry['offsets'][:registry['n_sccs'] + 1])
+
+
+def get_members_of(registry, i):
+    # members of the SCC with id i, a view of the buffer
+    return registry['members'][registry['offsets'][i]:registry['offsets'][i + 1]]
+
+
+def get_members(registry, c_hash):
+    return get_members_of(registry, get_id(registry, c_hash))
+
+
+def _get_key(members):
+    return hashlib.blake2b(members.tobytes(), digest_size=8).digest()
+
+
+def add_scc(registry, members):
+    # id of the SCC with the given sorted members, which are registered if new
+    members = np.asarray(members, dtype=np.int32)
+    key = _get_key(members)
+    i = registry['lookup'].get(key)
+    if i is not None and not np.array_equal(get_members_of(registry, i), members):
+        # hash collision, the SCC is looked up by its members instead
+        key = ('members', members.tobytes())
+        i = registry['lookup'].get(key)
+    if i is not None:
+        return i
+
+    i = registry['n_sccs']
+    start = registry['offsets'][i]
+    end = start + len(members)
+    if end > len(registry['members']):
+        registry['members'] = np.resize(registry['members'], max(end, 2 * len(registry['members'])))
+    if i + 2 > len(registry['offsets']):
+        registry['offsets'] = np.resize(registry['offsets'], 2 * len(registry['offsets']))
+    registry['members'][start:end] = members
+    registry['offsets'][i + 1] = end
+    registry['n_sccs'] = i + 1
+    registry['lookup'][key] = i
+    registry['trader_index'] = None
+    return i
+
+
+def get_sccs(registry):
+    # members and offsets of all SCCs, trimmed to their size
+    offsets = registry['offsets'][:registry['n_sccs'] + 1]
+    return registry['members'][:offsets[-1]].copy(), offsets.copy()
+
+
+def add_sccs(registry, members, offsets):
+    # ids of the SCCs given as members and offsets (see get_sccs), which are registered if new
+    return np.array([add_scc(registry, members[offsets[j]:offsets[j + 1]]) for j in range(len(offsets) - 1)],
+                    dtype=np.int64)
+
+
+def get_hashes(registry):
+    # md5 hashes of all SCCs, of their members as formatted by earlier versions
+    for i in range(len(registry['hashes']), registry['n_sccs']):
+        c_hash = hashlib.md5(','.join(str(get_members_of(registry, i).tolist())).encode()).hexdigest()
+        registry['hashes'].append(c_hash)
+        registry['ids'][c_hash] = i
+    return registry['hashes']
+
+
+def get_id(registry, c_hash):
+    if len(registry['hashes']) < registry['n_sccs']:
+        get_hashes(registry)
+    return registry['ids'][c_hash]
+
+
+def get_subset(registry, c_hashes):
+    # new registry with the given SCCs only, in the given order, e.g. to pass the relevant SCCs to workers
+    subset = new_registry()
+    for c_hash in c_hashes:
+        add_scc(subset, get_members(registry, c_hash))
+    subset['hashes'] = list(c_hashes)
+    subset['ids'] = {c_hash: i for i, c_hash in enumerate(c_hashes)}
+    return subset
+
+
+def get_trader_index(registry):
+    # reverse index: the SCC ids of trader t are sccs[offsets[t]:offsets[t + 1]], in increasing order
+    if registry['trader_index'] is None:
+        members, offsets = get_sccs(registry)
+        scc_of_member = np.repeat(np.arange(registry['n_sccs'], dtype=np.int64), np.diff(offsets))
+        order = np.argsort(members, kind='stable')
+        counts = np.bincount(members, minlength=1)
+        registry['trader_index'] = (np.concatenate([[0], np.cumsum(counts)]), scc_of_member[order])
+    return registry['trader_index']
+
+
+def get_member_trades(registry, buyer_ids, seller_ids, c_hashes):
+    # (trade, SCC) pairs of the trades whose buyer and seller are both members of one of the given SCCs,
+    # as row positions in buyer_ids/seller_ids and positions in c_hashes, ordered by SCC, then row
+    offsets, sccs = get_trader_index(registry)
+    position = np.full(registry['n_sccs'], -1, dtype=np.int64)
+    position[[get_id(registry, c_hash) for c_hash in c_hashes]] = np.arange(len(c_hashes))
+    buyer_ids = np.asarray(buyer_ids, dtype=np.int64)
+    seller_ids = np.asarray(seller_ids, dtype=np.int64)
+
+    # every trade with each SCC of its buyer, traders without SCC have no entry in the index
+    known = (buyer_ids >= 0) & (buyer_ids < len(offsets) - 1)
+    counts = np.where(known, np.diff(offsets)[np.where(known, buyer_ids, 0)], 0)
+    rows = np.repeat(np.arange(len(buyer_ids), dtype=np.int64), counts)
+    firsts = np.repeat(offsets[:-1][np.where(known, buyer_ids, 0)] - np.cumsum(counts) + counts, counts)
+    candidates = sccs[firsts + np.arange(len(rows), dtype=np.int64)]
+    wanted = position[candidates] >= 0
+    rows, candidates = rows[wanted], candidates[wanted]
+
+    # keep the trades whose seller is a member too: (SCC, trader) keys of the buffer are sorted, as the
+    # SCCs are stored one after the other with sorted members
+    members, scc_offsets = get_sccs(registry)
+    n_keys = max(int(members.max()) if len(members) > 0 else 0, int(seller_ids.max()) if len(seller_ids) > 0 else 0) + 1
+    keys = np.repeat(np.arange(registry['n_sccs'], dtype=np.int64), np.diff(scc_offsets)) * n_keys + members
+    seller_keys = candidates * n_keys + seller_ids[rows]
+    found = np.searchsorted(keys, seller_keys)
+    is_member = (found < len(keys)) & (keys[np.minimum(found, len(keys) - 1)] == seller_keys)
+    rows, positions = rows[is_member], position[candidates[is_member]]
+
+    order = np.lexsort([rows, positions])
+    return rows[order], positions[order]
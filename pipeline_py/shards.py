@@ -0,0 +1,250 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+import scc
+import scc_registry
+import stage_cache
+import table_io
+import trade_store
+import utils
+import wtd
+from scc import detect_scc_for_tokens_layered, get_relevant_scc_by_threshold
+from wtd import (add_wash_label_index, detect_and_label_wash_trades_for_scc_using_multiple_passes,
+                 get_summary_of_wash_trades_per_scc_and_timewindow, get_windows_per_window_size)
+
+
+# Runs of the pipeline on a shard of the tokens, "--shard i/N", and the merge of their results. Every shard
+# prepares all trades, keeps the groups of tokens that share transactions (see trade_store.get_token_groups)
+# whose first token hashes to the shard, and writes its partial results to <output>/shard-<i>-of-<N>.
+# Relevant SCCs depend on the occurrences in all tokens, so shards wait for the SCCs of each other before
+# detecting wash trades. merge_shards combines the partial results into the outputs of a single run: SCCs
+# in the order of the token they were found in first, trades and checked trades by their row in all trades.
+# Partial results are parquet, whatever the format of the run, so that no value changes on the way.
+
+SCC_FILE = "scc.json"
+SHARD_FILE = "shard.json"
+
+
+def parse_shard(shard):
+    match = re.fullmatch(r"(\d+)/(\d+)", shard)
+    if match is None or int(match.group(1)) >= int(match.group(2)):
+        raise ValueError(f"Invalid shard '{shard}', must be i/N with 0 <= i < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_shard_folder(output_folder, shard, n_shards):
+    return os.path.join(output_folder, f"shard-{shard}-of-{n_shards}")
+
+
+def make_shard_folder(output_folder, shard, n_shards):
+    # results of an earlier run of the shard are removed, so that other shards never read them
+    folder = get_shard_folder(output_folder, shard, n_shards)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    return folder
+
+
+def get_shard_of_tokens(tokens, n_shards):
+    return int(hashlib.md5(tokens[0].encode()).hexdigest(), 16) % n_shards
+
+
+def get_run_key(trades_file, prices_file, n_shards, cache=None, **settings):
+    # shards only combine results of the same inputs, settings and code; inputs are keyed by their content,
+    # so that shards on nodes with their own copies of the inputs agree (see stage_cache.get_file_key)
+    files = {name: stage_cache.get_file_key(cache, file) if cache is not None else stage_cache.get_content_key(file)
+             for name, file in [('trades', trades_file), ('prices', prices_file)]}
+    return stage_cache.get_stage_key('shards', files=files, n_shards=n_shards, **settings,
+                                     code=stage_cache.get_code_key(utils, table_io, scc, scc_registry, wtd, trade_store))
+
+
+def write_marker(folder, name, content):
+    # written to a temporary file first, a marker is only seen complete
+    file = os.path.join(folder, name)
+    with open(f"{file}.tmp", "w") as outfile:
+        json.dump(content, outfile)
+    os.replace(f"{file}.tmp", file)
+
+
+def read_marker(folder, name):
+    file = os.path.join(folder, name)
+    if not os.path.exists(file):
+        return None
+    with open(file) as infile:
+        return json.load(infile)
+
+
+def wait_for_shards(output_folder, n_shards, name, run_key, timeout=None, poll_seconds=1.0):
+    # folders of all shards once each has written the marker of this run; a shard that crashed or never
+    # started raises TimeoutError after timeout seconds, or is waited for forever if timeout is None
+    folders = [get_shard_folder(output_folder, shard, n_shards) for shard in range(n_shards)]
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    waiting = True
+    while True:
+        missing = [shard for shard, folder in enumerate(folders)
+                   if (read_marker(folder, name) or {}).get('run_key') != run_key]
+        if not missing:
+            return folders
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(f"Shards {', '.join(f'{shard}/{n_shards}' for shard in missing)} did not write "
+                               f"{name} in {output_folder} within {timeout} seconds")
+        if waiting:
+            print(f"Info: waiting for {len(missing)} of {n_shards} shards to write {name}.")
+            waiting = False
+        time.sleep(poll_seconds)
+
+
+def merge_scc(folders):
+    # occurrences are summed over the shards; every SCC keeps its members and place from the shard with
+    # the first token it was found in, which gives the order in which a single run registers the SCCs
+    occurrences = Counter()
+    first = {}
+    for folder in folders:
+        occurrences.update(dict(pl.read_parquet(os.path.join(folder, "scc.parquet"))
+                                .select('scc_hash', 'occurrence').iter_rows()))
+        mapping = (pl.read_parquet(os.path.join(folder, "scc-mapping.parquet"))
+                   .group_by('hash', maintain_order=True)
+                   .agg(pl.col('token_index').first(), pl.col('trader_id')))
+        for position, (c_hash, token_index, members) in enumerate(mapping.iter_rows()):
+            if c_hash not in first or token_index < first[c_hash][0]:
+                first[c_hash] = (token_index, position, members)
+
+    registry = scc_registry.new_registry()
+    for c_hash in sorted(first, key=lambda c_hash: first[c_hash][:2]):
+        scc_registry.add_scc(registry, first[c_hash][2])
+    return (scc.get_scc_summary({scc_registry.get_id(registry, c_hash): occurrence
+                                 for c_hash, occurrence in occurrences.items()}, registry), registry)
+
+
+def run_shard(trades, trader_hashes, output_folder, shard, n_shards, run_key, scc_threshold_rank=100,
+              wash_window_sizes_seconds=[60*60*24*7], window_stride=None, ether=True, margin=0.1, workers=1,
+              graph_backend="networkx", file_format="csv", timeout=None):
+    folder = get_shard_folder(output_folder, shard, n_shards)
+    trades = trades if isinstance(trades, pl.DataFrame) else pl.from_pandas(trades)
+
+    # windows and the order of tokens are those of all trades
+    windows_per_window_size = get_windows_per_window_size(trades, wash_window_sizes_seconds,
+                                                          window_stride=window_stride)
+    tokens = trades['token'].cast(pl.String).unique(maintain_order=True).to_list()
+    token_index = {token: i for i, token in enumerate(tokens)}
+    token_groups = trade_store.get_token_groups(
+        add_wash_label_index(trades.select(pl.col('token').cast(pl.String), 'transactionHash')))
+    shard_tokens = [token for tokens in token_groups if get_shard_of_tokens(tokens, n_shards) == shard
+                    for token in tokens]
+    trades = (trades
+              .with_columns(pl.int_range(pl.len(), dtype=pl.Int64).alias('row'))
+              .filter(pl.col('token').cast(pl.String).is_in(shard_tokens)))
+    print(f"Info: shard {shard}/{n_shards} has {len(trades)} trades in {len(shard_tokens)} tokens.")
+
+    # SCCs of the tokens of the shard, with the token each was found in first
+    registry, first_tokens = scc_registry.new_registry(), {}
+    scc_dt = detect_scc_for_tokens_layered(trades, registry, workers=workers, graph_backend=graph_backend,
+                                           save=False, first_tokens=first_tokens)
+    members, offsets = scc_registry.get_sccs(registry)
+    sizes = np.diff(offsets)
+    mapping = pl.DataFrame({'hash': np.repeat(np.array(scc_registry.get_hashes(registry), dtype=object), sizes),
+                            'trader_id': members.astype(np.int64),
+                            'token_index': np.repeat([token_index[str(first_tokens[i])] for i in range(len(sizes))],
+                                                     sizes).astype(np.int64)},
+                           schema={'hash': pl.String, 'trader_id': pl.Int64, 'token_index': pl.Int64})
+    table_io.write_table(pl.from_pandas(scc_dt[['scc_hash', 'occurrence']]), folder, "scc", "parquet")
+    table_io.write_table(mapping, folder, "scc-mapping", "parquet")
+    write_marker(folder, SCC_FILE, {'run_key': run_key})
+
+    # relevant SCCs by their occurrences in all shards
+    scc_dt, registry = merge_scc(wait_for_shards(output_folder, n_shards, SCC_FILE, run_key, timeout=timeout))
+    relevant_scc_ids = get_relevant_scc_by_threshold(scc_dt, scc_threshold_rank)
+
+    wash_trades, trades_labeled = detect_and_label_wash_trades_for_scc_using_multiple_passes(
+        trades, registry, relevant_scc_ids, wash_window_sizes_seconds, ether=ether, margin=margin,
+        workers=workers, save=False, windows_per_window_size=windows_per_window_size)
+    if 'row' not in wash_trades.columns:
+        wash_trades = wash_trades.with_columns(pl.lit(None, pl.Int64).alias('row'))
+
+    table_io.write_table(trades_labeled, folder, "trades_labeled", "parquet")
+    table_io.write_table(wash_trades, folder, "wash_trades", "parquet")
+    table_io.write_table(trader_hashes, folder, "traders", "parquet")
+    get_summary_of_wash_trades_per_scc_and_timewindow(
+        wash_trades.drop('row'), 'multiple_windows', multiple_passes=True, save=True, folder=folder,
+        file_format=file_format, windows_per_window_size=windows_per_window_size)
+
+    write_marker(folder, SHARD_FILE, {'run_key': run_key, 'shard': shard, 'n_shards': n_shards,
+                                      'scc_threshold_rank': scc_threshold_rank,
+                                      'window_sizes': wash_window_sizes_seconds,
+                                      'windows_per_window_size': {str(window_size): [int(value) for value in windows]
+                                                                  for window_size, windows in windows_per_window_size.items()},
+                                      'file_format': file_format})
+    print(f"Info: saved the results of shard {shard}/{n_shards} to {folder}.")
+
+
+def get_shard_folders(output_folder):
+    # folders of all shards of one complete run, ordered by shard
+    folders = glob.glob(os.path.join(output_folder, "shard-*-of-*"))
+    markers = {folder: read_marker(folder, SHARD_FILE) for folder in folders}
+    runs = {(marker['run_key'], marker['n_shards']) for marker in markers.values() if marker is not None}
+    if len(runs) != 1:
+        raise ValueError(f"Expected the shards of one complete run in {output_folder}, found {len(runs)} runs")
+    run_key, n_shards = runs.pop()
+
+    shards = {marker['shard']: folder for folder, marker in markers.items()
+              if marker is not None and marker['run_key'] == run_key}
+    missing = [shard for shard in range(n_shards) if shard not in shards]
+    if missing:
+        raise ValueError(f"Shards {', '.join(f'{shard}/{n_shards}' for shard in missing)} are missing or "
+                         f"incomplete in {output_folder}")
+    return [shards[shard] for shard in range(n_shards)], markers[shards[0]]
+
+
+def merge_shards(output_folder):
+    folders, settings = get_shard_folders(output_folder)
+    file_format = settings['file_format']
+    window_sizes = settings['window_sizes']
+    windows_per_window_size = {int(window_size): tuple(windows)
+                               for window_size, windows in settings['windows_per_window_size'].items()}
+    print(f"Info: merging {len(folders)} shards in {output_folder}.")
+
+    scc_dt, registry = merge_scc(folders)
+    scc.save_scc(scc_dt, registry, output_folder, file_format=file_format)
+    relevant_scc_ids = get_relevant_scc_by_threshold(scc_dt, settings['scc_threshold_rank'])
+
+    trades_labeled = (pl.concat([pl.read_parquet(os.path.join(folder, "trades_labeled.parquet")) for folder in folders],
+                                how='vertical_relaxed')
+                      .sort('row')
+                      .drop('row'))
+    table_io.write_table(trades_labeled, output_folder, "trades_labeled", file_format)
+
+    # checked trades in the order of a single run: passes, then SCCs in relevant order, then the windows
+    # (or tokens, if windows slide) of an SCC by their first trade, with their trades in order
+    sliding = [str(window_size) for window_size, (_, _, step) in windows_per_window_size.items() if step < window_size]
+    window_group = pl.when(pl.col('window_size').is_in(sliding)).then(pl.lit(None, pl.Int64)).otherwise(pl.col('window'))
+    wash_trades = (pl.concat([pl.read_parquet(os.path.join(folder, "wash_trades.parquet")) for folder in folders],
+                             how='vertical_relaxed')
+                   .with_columns(pl.col('window_size').replace_strict({str(window_size): i for i, window_size in enumerate(window_sizes)},
+                                                                      return_dtype=pl.Int64).alias('pass_order'),
+                                 pl.col('scc_hash').replace_strict({scc_id: i for i, scc_id in enumerate(relevant_scc_ids)},
+                                                                   return_dtype=pl.Int64).alias('scc_order'),
+                                 pl.col('row').min().over(['scc_hash', 'window_size', 'token', window_group])
+                                 .alias('group_order'))
+                   .sort(['pass_order', 'scc_order', 'group_order', 'row'])
+                   .drop('pass_order', 'scc_order', 'group_order', 'row'))
+    get_summary_of_wash_trades_per_scc_and_timewindow(
+        wash_trades, 'multiple_windows', multiple_passes=True, save=True, folder=output_folder,
+        file_format=file_format, windows_per_window_size=windows_per_window_size)
+
+    # every shard prepared all trades, so self-trades and trader ids are taken from the first
+    trader_hashes = pd.read_parquet(os.path.join(folders[0], "traders.parquet"))
+    utils.get_address_clusters(None, registry, trader_hashes, relevant_scc_ids, save=True, folder=output_folder)
+    for name in ["self_trades", "self_trades_summary"]:
+        shutil.copyfile(table_io.get_file_name(folders[0], name, file_format),
+                        table_io.get_file_name(output_folder, name, file_format))
+
+    print(f"Info: saved the merged results of {len(folders)} shards to {output_folder}.")
@@ -0,0 +1,110 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+
+
+# Cache of pipeline stage results, kept in a folder:
+# - <key>/values.pkl: the values returned by the stage
+# - <key>/files/: the files the stage wrote to the output folder
+# - file_keys.json: content keys of input files by path, size and modification time
+# The key of a stage is a hash of its inputs, parameters and the source of the modules it runs, so a
+# changed input or code reruns the stage and every stage after it. Entries that were not used for the
+# longest time are removed once the cache is larger than its maximum size.
+
+def open_cache(folder, max_size_gb=10.0):
+    os.makedirs(folder, exist_ok=True)
+    return {'folder': folder, 'max_bytes': int(max_size_gb * 1024**3)}
+
+
+def get_content_key(file):
+    md5 = hashlib.md5()
+    with open(file, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 24), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_file_key(cache, file):
+    # md5 of the content, remembered as long as path, size and modification time stay the same
+    stat = os.stat(file)
+    file_id = f"{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}"
+    keys_file = os.path.join(cache['folder'], "file_keys.json")
+    file_keys = {}
+    if os.path.exists(keys_file):
+        with open(keys_file) as infile:
+            file_keys = json.load(infile)
+
+    if file_id not in file_keys:
+        file_keys[file_id] = get_content_key(file)
+        with open(keys_file, "w") as outfile:
+            json.dump(file_keys, outfile)
+
+    return file_keys[file_id]
+
+
+def get_code_key(*modules):
+    # modules that are None, like optional modules that are not installed, are skipped
+    md5 = hashlib.md5()
+    for module in modules:
+        if module is not None:
+            md5.update(inspect.getsource(module).encode())
+    return md5.hexdigest()
+
+
+def get_stage_key(stage, **inputs):
+    return hashlib.md5(json.dumps({'stage': stage, **inputs}, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def run_stage(cache, stage, key, files, compute):
+    # Returns compute(), or the values of an earlier run with the same key, in which case the files the
+    # stage writes are restored from the cache. Without a cache, compute() is always run.
+    if cache is None:
+        return compute()
+
+    entry = os.path.join(cache['folder'], key)
+    if os.path.exists(os.path.join(entry, "values.pkl")):
+        for file in files:
+            shutil.copyfile(os.path.join(entry, "files", os.path.basename(file)), file)
+        with open(os.path.join(entry, "values.pkl"), "rb") as infile:
+            values = pickle.load(infile)
+        os.utime(entry)
+        print(f"Info: reused cached results of stage '{stage}'.")
+        evict(cache)
+        return values
+
+    values = compute()
+
+    # the entry is written to a temporary folder first, so that an entry is either complete or missing
+    temp_entry = f"{entry}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_entry, ignore_errors=True)
+    os.makedirs(os.path.join(temp_entry, "files"))
+    for file in files:
+        shutil.copyfile(file, os.path.join(temp_entry, "files", os.path.basename(file)))
+    with open(os.path.join(temp_entry, "values.pkl"), "wb") as outfile:
+        pickle.dump(values, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(temp_entry, entry)
+
+    evict(cache)
+    return values
+
+
+def get_entry_size(entry):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(entry) for f in files)
+
+
+def evict(cache):
+    # removes the least recently used entries until the cache fits its maximum size
+    entries = [os.path.join(cache['folder'], name) for name in os.listdir(cache['folder'])]
+    entries = [(os.path.getmtime(entry), get_entry_size(entry), entry) for entry in entries
+               if os.path.isdir(entry) and not entry.endswith(".tmp")]
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_size <= cache['max_bytes']:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= size
+        print(f"Info: removed cache entry {os.path.basename(entry)} ({size / 1024**2:.1f} MB) from {cache['folder']}.")
@@ -0,0 +1,129 @@
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import polars as pl
+from tqdm import tqdm
+
+# utils imports main, so it has to be imported first
+import utils
+import scc_registry
+import table_io
+from args import parse_sweep_arguments
+from main import prepare_trades
+from scc import detect_scc_for_tokens_layered, get_relevant_scc_by_threshold
+from wtd import (add_wash_label_index, detect_and_label_wash_trades_for_scc_group,
+                 get_summary_of_wash_trades_per_scc_and_timewindow, get_trades_per_scc, get_wash_trades_frame,
+                 get_windows_per_window_size, new_wash_labels)
+
+
+# Parameter sweep: trades, SCCs, the trades of every SCC and the windows are computed once, then wash
+# trades are detected for every combination of SCC threshold, margin and window schedule. The wash trade
+# summaries of all combinations are written to one table, with the parameters as leading columns.
+
+# data shared by all combinations, set once per worker process
+_sweep_data = None
+
+
+def _init_sweep_worker(sweep_data):
+    global _sweep_data
+    _sweep_data = sweep_data
+
+
+def run_sweep_combination(combination):
+    scc_threshold_rank, margin, window_sizes, relevant_scc = combination
+    trades, registry, trades_per_scc, windows_per_window_size, ether = _sweep_data
+
+    labels = new_wash_labels(trades)
+    wash_trades = detect_and_label_wash_trades_for_scc_group(
+        trades, labels, registry, relevant_scc, window_sizes, windows_per_window_size,
+        ether=ether, margin=margin, progress=False, trades_per_scc=trades_per_scc)
+    summary = get_summary_of_wash_trades_per_scc_and_timewindow(get_wash_trades_frame(wash_trades), 'multiple_windows',
+                                                                multiple_passes=True, save=False,
+                                                                windows_per_window_size=windows_per_window_size)
+
+    return summary.select(
+        pl.lit(scc_threshold_rank).alias('scc_threshold_rank'),
+        pl.lit(margin).alias('margin'),
+        pl.lit(','.join(str(window_size) for window_size in window_sizes)).alias('window_sizes'),
+        pl.all()
+    ) if len(summary) > 0 else pl.DataFrame({'scc_threshold_rank': [], 'margin': [], 'window_sizes': []},
+                                            schema={'scc_threshold_rank': pl.Int64, 'margin': pl.Float64,
+                                                    'window_sizes': pl.String})
+
+
+def sweep(trades_file,
+          prices_file,
+          dex_type,
+          output_folder,
+          scc_threshold_ranks=[100],
+          margins=[0.1],
+          window_schedules=[[60*60*24*7]],
+          wash_trade_detection_ether=True,
+          workers=1,
+          graph_backend="networkx",
+          file_format="csv",
+          filename="sweep_results"):
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Trades and SCCs, once for all combinations
+    global_scc_registry = scc_registry.new_registry()
+    trades, _ = prepare_trades(trades_file, prices_file, dex_type, output_folder, file_format,
+                               pd.DataFrame(columns=['trader_address', 'trader_id']))
+    scc_dt = detect_scc_for_tokens_layered(trades, global_scc_registry, workers=workers, graph_backend=graph_backend,
+                                           save=True, folder=output_folder, file_format=file_format)
+    relevant_scc_per_threshold = {threshold: get_relevant_scc_by_threshold(scc_dt, threshold)
+                                  for threshold in scc_threshold_ranks}
+
+    # Trades of every relevant SCC and windows of every window size, once for all combinations
+    trades = add_wash_label_index(pl.from_pandas(trades))
+    relevant_scc = relevant_scc_per_threshold[min(scc_threshold_ranks)]
+    trades_per_scc = get_trades_per_scc(trades, global_scc_registry, relevant_scc)
+    window_sizes = sorted({window_size for window_sizes in window_schedules for window_size in window_sizes})
+    windows_per_window_size = get_windows_per_window_size(trades, window_sizes)
+    sweep_data = (trades, scc_registry.get_subset(global_scc_registry, relevant_scc), trades_per_scc,
+                  windows_per_window_size, wash_trade_detection_ether)
+
+    combinations = [(threshold, margin, window_sizes, relevant_scc_per_threshold[threshold])
+                    for threshold, margin, window_sizes in itertools.product(scc_threshold_ranks, margins, window_schedules)]
+    print(f"Info: detecting wash trades for {len(combinations)} parameter combinations.")
+
+    if workers <= 1:
+        _init_sweep_worker(sweep_data)
+        results = [run_sweep_combination(combination) for combination in tqdm(combinations, desc="Processing combinations")]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_sweep_worker, initargs=(sweep_data,)) as executor:
+            results = list(tqdm(executor.map(run_sweep_combination, combinations), total=len(combinations),
+                                desc="Processing combinations"))
+
+    sweep_results = pl.concat(results, how='diagonal')
+    table_io.write_table(sweep_results, output_folder, filename, file_format)
+    print(f"Info: saved {len(sweep_results)} rows of wash trade summaries to {output_folder}.")
+
+    return sweep_results
+
+
+def main():
+
+    args = parse_sweep_arguments()
+
+    sweep(trades_file=args.trades,
+          prices_file=args.prices,
+          dex_type=args.dex,
+          output_folder=args.output,
+          scc_threshold_ranks=args.sccthresholdranks,
+          margins=args.margins,
+          window_schedules=[[int(window_size) for window_size in schedule.split(',')]
+                            for schedule in args.window_schedules],
+          wash_trade_detection_ether=args.washdetectionether,
+          workers=args.workers,
+          graph_backend=args.graph_backend,
+          file_format=args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import os
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+FILE_FORMATS = ['csv', 'parquet', 'arrow']
+
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# address and token columns repeat few distinct 42 character values, they are read dictionary-encoded
+DICTIONARY_COLUMNS = ['maker', 'taker', 'tokenBuy', 'tokenSell']
+
+
+def get_file_format(file):
+    extension = os.path.splitext(file)[1].lower()
+    if extension in ('.arrow', '.feather', '.ipc'):
+        return 'arrow'
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    return 'csv'
+
+
+def get_file_name(folder, filename, file_format="csv"):
+    filename = filename.split('.')[0]
+    return os.path.join(folder, f"{filename}{FILE_EXTENSIONS[file_format]}")
+
+
+def _get_columns_with_nulls(table_or_file, columns, file_format):
+    # columns that have missing values according to the file metadata, unknown counts are treated as nulls
+    if file_format == 'arrow':
+        return [c for c in columns if table_or_file.column(c).null_count > 0]
+
+    metadata = table_or_file.metadata
+    names = table_or_file.schema_arrow.names
+    columns_with_nulls = []
+    for c in columns:
+        i = names.index(c)
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(i).statistics
+            if statistics is None or not statistics.has_null_count or statistics.null_count > 0:
+                columns_with_nulls.append(c)
+                break
+    return columns_with_nulls
+
+
+def read_table(file, columns=None, file_format=None):
+    # Reads a table as pandas DataFrame. Parquet and Arrow reads are projected to the given columns, plus
+    # any other column that has missing values, so dropping incomplete rows gives the same result as on
+    # the full table. Address and token columns are returned as categoricals with shared categories.
+    file_format = file_format or get_file_format(file)
+
+    if file_format == 'csv':
+        return pd.read_csv(file)
+
+    if file_format == 'parquet':
+        source = pq.ParquetFile(file)
+        names = source.schema_arrow.names
+    else:
+        source = feather.read_table(file, memory_map=True)
+        names = source.column_names
+
+    if columns is not None:
+        other_columns = [c for c in names if c not in columns]
+        projection = [c for c in names if c in columns or c in _get_columns_with_nulls(source, other_columns, file_format)]
+    else:
+        projection = names
+
+    dictionary_columns = [c for c in DICTIONARY_COLUMNS if c in projection]
+    if file_format == 'parquet':
+        table = pq.read_table(file, columns=projection, read_dictionary=dictionary_columns)
+    else:
+        table = source.select(projection)
+        for c in dictionary_columns:
+            if not pa.types.is_dictionary(table.schema.field(c).type):
+                table = table.set_column(table.schema.get_field_index(c), c, table.column(c).dictionary_encode())
+
+    df = table.to_pandas()
+
+    # share categories so that address and token columns can be compared with each other
+    if dictionary_columns:
+        categories = pd.api.types.union_categoricals([df[c] for c in dictionary_columns]).categories
+        for c in dictionary_columns:
+            df[c] = df[c].cat.set_categories(categories)
+
+    return df
+
+
+# strings read as missing values by pandas.read_csv
+CSV_NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+                   'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+# powers of ten as C reads them, see parse_csv_floats
+_POWERS_OF_TEN = np.array([float(f"1e{i}") for i in range(309)])
+
+_CSV_FLOAT_PATTERN = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+
+def _parse_long_csv_floats(strings):
+    parts = strings.str.replace('E', 'e', literal=True).str.split_exact('e', 1).struct.unnest()
+    mantissa = parts['field_0'].str.strip_chars_start('+-')
+    digits = mantissa.str.replace('.', '', literal=True)
+    n_digits = digits.str.len_bytes().cast(pl.Int64).to_numpy()
+    integer_digits = mantissa.str.find('.', literal=True).fill_null(pl.Series(n_digits)).cast(pl.Int64).to_numpy()
+    n_digits = np.minimum(n_digits, 17)
+
+    # the first 15 digits are exact in a double, the 16th and 17th are added one at a time
+    number = digits.str.slice(0, 15).cast(pl.Int64).cast(pl.Float64).to_numpy()
+    for i in (15, 16):
+        digit = digits.str.slice(i, 1).cast(pl.Float64, strict=False).fill_null(0).to_numpy()
+        number = np.where(n_digits > i, number * 10. + digit, number)
+    number = np.where(parts['field_0'].str.starts_with('-').to_numpy(), -number, number)
+
+    # integer digits after the 17th scale up, taken decimals scale down
+    exponent = (integer_digits - np.minimum(integer_digits, 17) - np.maximum(n_digits - integer_digits, 0)
+                + parts['field_1'].cast(pl.Int64).fill_null(0).to_numpy())
+    with np.errstate(over='ignore'):
+        scaled = np.where(exponent > 0, number * _POWERS_OF_TEN[np.clip(exponent, 0, 308)],
+                          number / _POWERS_OF_TEN[np.clip(-exponent, 0, 308)])
+    subnormal = number / _POWERS_OF_TEN[np.clip(-308 - exponent, 0, 308)] / _POWERS_OF_TEN[308]
+    return np.select([exponent > 308, exponent < -616, exponent < -308],
+                     [np.copysign(np.inf, number), number * 0., subnormal], scaled)
+
+
+def parse_csv_floats(strings):
+    # Parses a string Series as pandas.read_csv does: its default parser keeps the first 17 digits and scales
+    # them by a power of ten, which can differ from the correctly rounded value of polars in the last bit.
+    # Decimals of up to 15 characters without exponent are exact in both, only longer ones are parsed here.
+    values = strings.cast(pl.Float64, strict=False)
+    long = ((strings.str.len_bytes() > 15) | strings.str.contains('e', literal=True) |
+            strings.str.contains('E', literal=True))
+    rows = long.fill_null(False).arg_true()
+    rows = rows.filter(strings.gather(rows).str.contains(_CSV_FLOAT_PATTERN))
+    if len(rows) > 0:
+        values = values.scatter(rows, _parse_long_csv_floats(strings.gather(rows)))
+    return values
+
+
+def get_csv_types(strings):
+    # types pandas reads string columns as: integers if all values are integers, floats if all values are
+    # numbers (also integers with missing values), strings otherwise
+    counts = strings.select(
+        *[pl.col(c).null_count().alias(f"{c}_null") for c in strings.columns],
+        *[pl.col(c).cast(pl.Int64, strict=False).null_count().alias(f"{c}_int") for c in strings.columns],
+        *[pl.col(c).cast(pl.Float64, strict=False).null_count().alias(f"{c}_float") for c in strings.columns]
+    ).row(0, named=True)
+
+    types = {}
+    for c in strings.columns:
+        if counts[f"{c}_int"] == counts[f"{c}_null"] == 0:
+            types[c] = pl.Int64
+        elif counts[f"{c}_float"] == counts[f"{c}_null"]:
+            types[c] = pl.Float64
+        else:
+            types[c] = pl.String
+    return types
+
+
+def scan_table(file, columns=None, file_format=None):
+    # Polars version of read_table, as LazyFrame with the same columns and types: csv is read with the
+    # missing values, types and float parsing of pandas, and integer columns with missing values are floats.
+    # Address and token columns are strings.
+    file_format = file_format or get_file_format(file)
+
+    if file_format == 'csv':
+        # pandas types columns by all their values, so the columns are read once as strings and typed in
+        # memory; other columns are only read for their missing values, rows with missing values are dropped
+        values = pl.scan_csv(file, null_values=CSV_NULL_VALUES, infer_schema=False)
+        names = values.collect_schema().names()
+        other_columns = [c for c in names if columns is not None and c not in columns]
+        strings = values.select(
+            *[c for c in names if c not in other_columns],
+            pl.all_horizontal(pl.lit(True), *[pl.col(c).is_not_null() for c in other_columns]).alias('_complete')
+        ).collect()
+        types = get_csv_types(strings.drop('_complete'))
+        return (strings.lazy()
+                .filter('_complete')
+                .drop('_complete')
+                .with_columns(
+                    *[pl.col(c).cast(pl.Int64) for c, dtype in types.items() if dtype == pl.Int64],
+                    pl.col([c for c, dtype in types.items() if dtype == pl.Float64]).map_batches(
+                        parse_csv_floats, return_dtype=pl.Float64)))
+
+    if file_format == 'parquet':
+        source = pq.ParquetFile(file)
+        names = source.schema_arrow.names
+        trades = pl.scan_parquet(file)
+    else:
+        source = feather.read_table(file, memory_map=True)
+        names = source.column_names
+        trades = pl.scan_ipc(file)
+
+    if columns is not None:
+        other_columns = [c for c in names if c not in columns]
+        projection = [c for c in names if c in columns or c in _get_columns_with_nulls(source, other_columns, file_format)]
+        trades = trades.select(projection)
+
+    schema = trades.collect_schema()
+    integer_columns = [c for c in schema.names() if schema[c].is_integer()]
+    return trades.with_columns(pl.col(pl.Categorical).cast(pl.String),
+                               pl.col(_get_columns_with_nulls(source, integer_columns, file_format)).cast(pl.Float64))
+
+
+def write_table(df, folder, filename, file_format="csv"):
+    # writes a pandas or polars DataFrame to folder/filename with the extension of the format
+    file = get_file_name(folder, filename, file_format)
+
+    if isinstance(df, pl.DataFrame):
+        if file_format == 'parquet':
+            df.write_parquet(file)
+        elif file_format == 'arrow':
+            df.write_ipc(file, compression='uncompressed')
+        else:
+            df.write_csv(file)
+    else:
+        if file_format == 'parquet':
+            df.to_parquet(file, index=False)
+        elif file_format == 'arrow':
+            feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), file, compression='uncompressed')
+        else:
+            df.to_csv(file, index=False)
+
+    return file
@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+
+import polars as pl
+
+import table_io
+
+
+# On-disk store of the prepared trades, for trade sets larger than memory. Trades are written as parquet
+# files partitioned by token, and optionally by month: <folder>/token=<token>/[month=<yyyy-mm>/]*.parquet.
+# store.json holds the columns of the trades, the tokens in order of first appearance and the groups of
+# tokens that share transactions, with their number of trades. Every trade keeps its row in the prepared trades ('row') and its
+# transaction id ('tx_id', see wtd.add_wash_label_index), so that stages can read one token group at a
+# time and results can be put back into the order of the trades.
+
+STORE_FILE = "store.json"
+
+
+def get_token_groups(trades):
+    # tokens that share a transaction end up in the same group, as wash labels are set per transaction
+    token_tx = trades.select('token', 'tx_id').unique()
+    shared = token_tx.filter(pl.col('tx_id').is_duplicated())
+    tokens = trades['token'].unique(maintain_order=True).to_list()
+    parent = {token: token for token in tokens}
+
+    def find(token):
+        while parent[token] != token:
+            parent[token] = parent[parent[token]]
+            token = parent[token]
+        return token
+
+    for tx_tokens in shared.group_by('tx_id').agg('token')['token'].to_list():
+        for token in tx_tokens[1:]:
+            root_a, root_b = find(tx_tokens[0]), find(token)
+            if root_a != root_b:
+                parent[root_b] = root_a
+
+    # groups keep the order of the tokens, both among and within groups
+    groups = {}
+    for token in tokens:
+        groups.setdefault(find(token), []).append(token)
+    return list(groups.values())
+
+
+def write_store(trades, folder, by_month=False):
+    # writes pandas or polars trades to a new store in folder and returns the opened store
+    trades = trades if isinstance(trades, pl.DataFrame) else pl.from_pandas(trades)
+    columns = trades.columns
+    trades = trades.with_columns(
+        pl.int_range(pl.len(), dtype=pl.Int64).alias('row'),
+        (pl.col('transactionHash').rank('dense') - 1).cast(pl.Int64).alias('tx_id'),
+        pl.col('token').cast(pl.String)
+    )
+    partitions = ['token']
+    if by_month:
+        trades = trades.with_columns(pl.from_epoch('timestamp').dt.strftime('%Y-%m').alias('month'))
+        partitions.append('month')
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    trades.write_parquet(folder, partition_by=partitions)
+
+    token_groups = get_token_groups(trades)
+    trades_per_token = dict(trades['token'].value_counts().iter_rows())
+    with open(os.path.join(folder, STORE_FILE), "w") as outfile:
+        json.dump({'columns': columns, 'partitions': partitions, 'n_trades': len(trades),
+                   'n_transactions': int(trades['tx_id'].max()) + 1 if len(trades) > 0 else 0,
+                   'tokens': trades['token'].unique(maintain_order=True).to_list(),
+                   'token_groups': token_groups,
+                   'token_group_trades': [sum(trades_per_token[token] for token in tokens) for tokens in token_groups]},
+                  outfile)
+    print(f"Info: wrote {len(trades)} trades in {trades['token'].n_unique()} tokens to the store in {folder}.")
+
+    return open_store(folder)
+
+
+def open_store(folder):
+    with open(os.path.join(folder, STORE_FILE)) as infile:
+        store = json.load(infile)
+    store['folder'] = folder
+    return store
+
+
+def scan_store(store):
+    # all trades of the store, with the row and tx_id columns, in no particular order
+    return pl.scan_parquet(os.path.join(store['folder'], "**", "*.parquet"), hive_partitioning=True,
+                           hive_schema={partition: pl.String for partition in store['partitions']})
+
+
+def read_tokens(store, tokens, columns=None):
+    # trades of the given tokens in the order of the prepared trades, with tx_id unless columns are given;
+    # only their partitions and columns are read
+    return (scan_store(store)
+            .filter(pl.col('token').is_in(tokens))
+            .sort('row')
+            .select(columns or store['columns'] + ['tx_id'])
+            .collect())
+
+
+def get_bounds(store):
+    # first window start and last timestamp of the trades, see wtd.get_windows_per_window_size
+    return scan_store(store).select(pl.col('cut').min(), pl.col('timestamp').max()).collect()
+
+
+def get_last_block(store):
+    return scan_store(store).select(pl.col('blockNumber').max()).collect().item()
+
+
+def count_new_trades(store, last_block):
+    # number of trades and tokens after the given block
+    new_trades = (scan_store(store)
+                  .filter(pl.col('blockNumber') > last_block)
+                  .select(pl.len(), pl.col('token').n_unique())
+                  .collect())
+    return new_trades.row(0)
+
+
+def write_trades(store, folder, filename, file_format="csv", **columns):
+    # the trades of the store in their prepared order, with the given extra columns (expressions that may
+    # use row and tx_id), streamed to folder/filename without collecting the trades
+    file = table_io.get_file_name(folder, filename, file_format)
+    trades = (scan_store(store)
+              .sort('row')
+              .with_columns(**columns)
+              .select(store['columns'] + list(columns.keys())))
+    if file_format == 'parquet':
+        trades.sink_parquet(file)
+    elif file_format == 'arrow':
+        trades.sink_ipc(file, compression=None)
+    else:
+        trades.sink_csv(file)
+    return file
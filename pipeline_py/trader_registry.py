@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+
+
+# Persistent trader registry, kept in a folder that can be shared by runs on different DEXs:
+# - addresses.npy: trader addresses in id order, trader id = position + 1
+# - sorted_addresses.npy, sorted_ids.npy: the addresses in sorted order with their ids, for lookups
+# - registry.json: number of traders
+# Ids are only ever appended, an address keeps its id in every later run. The arrays are memory-mapped,
+# lookups are binary searches of the unique addresses of a run in the sorted addresses.
+
+def _to_bytes(addresses):
+    return np.asarray(addresses, dtype=object).astype('S')
+
+
+def new_registry():
+    return {'addresses': np.empty(0, dtype='S1'), 'sorted_addresses': np.empty(0, dtype='S1'),
+            'sorted_ids': np.empty(0, dtype=np.int64)}
+
+
+def load_registry(folder):
+    meta_file = os.path.join(folder, "registry.json")
+    if not os.path.exists(meta_file):
+        print(f"Info: no trader registry in {folder}, starting a new one.")
+        return new_registry()
+
+    with open(meta_file) as infile:
+        n_traders = json.load(infile)['n_traders']
+    registry = {name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode='r')[:n_traders]
+                for name in ['addresses', 'sorted_addresses', 'sorted_ids']}
+    print(f"Info: loaded trader registry from {folder} with {n_traders} traders.")
+    return registry
+
+
+def save_registry(folder, registry):
+    os.makedirs(folder, exist_ok=True)
+
+    # arrays are replaced atomically, registry.json is written last and gives the number of valid traders
+    for name in ['addresses', 'sorted_addresses', 'sorted_ids']:
+        temp_file = os.path.join(folder, f"{name}.tmp.npy")
+        np.save(temp_file, registry[name])
+        os.replace(temp_file, os.path.join(folder, f"{name}.npy"))
+    with open(os.path.join(folder, "registry.json"), "w") as outfile:
+        json.dump({'n_traders': len(registry['addresses'])}, outfile)
+
+
+def find_addresses(registry, addresses):
+    # ids of the unique addresses (bytes), 0 for addresses not in the registry
+    sorted_addresses = registry['sorted_addresses']
+    if len(sorted_addresses) == 0:
+        return np.zeros(len(addresses), dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_addresses, addresses), len(sorted_addresses) - 1)
+    found = sorted_addresses[positions] == addresses
+    return np.where(found, registry['sorted_ids'][positions], 0).astype(np.int64)
+
+
+def add_addresses(registry, addresses):
+    # ids of the unique addresses, addresses not in the registry are appended to it in sorted order
+    addresses = _to_bytes(addresses)
+    ids = find_addresses(registry, addresses)
+
+    new = ids == 0
+    if new.any():
+        new_addresses = np.sort(addresses[new])
+        n_old = len(registry['addresses'])
+        new_ids = np.arange(n_old + 1, n_old + len(new_addresses) + 1, dtype=np.int64)
+
+        # widen the stored addresses if new ones are longer, numpy would truncate them otherwise
+        dtype = np.promote_types(registry['addresses'].dtype, new_addresses.dtype)
+        sorted_addresses = np.asarray(registry['sorted_addresses'], dtype=dtype)
+        positions = np.searchsorted(sorted_addresses, new_addresses)
+        registry.update({'addresses': np.concatenate([np.asarray(registry['addresses'], dtype=dtype), new_addresses]),
+                         'sorted_addresses': np.insert(sorted_addresses, positions, new_addresses),
+                         'sorted_ids': np.insert(np.asarray(registry['sorted_ids']), positions, new_ids)})
+        ids = find_addresses(registry, addresses)
+
+    return ids
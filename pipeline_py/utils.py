@@ -1,14 +1,27 @@
+import numpy as np
 import pandas as pd
+import polars as pl
 from collections import defaultdict
 import json
 
+import scc_registry
+import table_io
+import trader_registry
 from main import global_ether_id
 
 
 # LOAD DATA
 
-def load_trades(file_csv):
-    trades = pd.read_csv(file_csv)
+# columns of the preprocessed trades used by the pipeline
+IDEX_TRADES_COLUMNS = ['blockNumber', 'timestamp', 'transactionHash', 'status', 'maker', 'taker', 'tokenBuy', 'tokenSell',
+                       'amountBoughtReal', 'amountSoldReal', 'price', 'feeMake', 'feeTake']
+
+EtherDelta_TRADES_COLUMNS = ['blockNumber', 'timestamp', 'transactionHash', 'maker', 'taker', 'tokenBuy', 'tokenSell',
+                             'amountBoughtReal', 'amountSoldReal', 'price']
+
+
+def load_trades(file_csv, columns=None):
+    trades = table_io.read_table(file_csv, columns)
     print(f"Info: read file {file_csv} as DataFrame with {len(trades)} rows.")
     print(f"Columns are: {', '.join(trades.columns)}")
     return trades
@@ -31,141 +44,176 @@ def get_ether_token_trades(trades, token_column1, token_column2):
     return trades
 
 
-def merge_trades_with_daily_usd_price(trades, price_file_csv="data/EtherDollarPrice.csv"):
+IDEX_PRICED_TRADES_COLUMNS = ['date', 'cut', 'blockNumber', 'timestamp', 'transactionHash', 'eth_buyer', 'eth_seller',
+                              'ether', 'token', 'trade_amount_eth', 'trade_amount_token', 'price', 'fee_eth_buyer',
+                              'fee_eth_seller', 'eth_price', 'trade_amount_dollar', 'token_price_in_eth']
+
+EtherDelta_PRICED_TRADES_COLUMNS = ['date', 'cut', 'blockNumber', 'timestamp', 'transactionHash', 'eth_buyer', 'eth_seller',
+                                    'ether', 'token', 'trade_amount_eth', 'trade_amount_dollar', 'trade_amount_token',
+                                    'token_price_in_eth']
+
+
+def merge_trades_with_usd_price(trades, price_file_csv="data/EtherDollarPrice.csv", columns=IDEX_PRICED_TRADES_COLUMNS,
+                                date_format='%m/%d/%Y'):
     ether_dollar = pd.read_csv(price_file_csv)
     ether_dollar.columns = ["date", "timestamp", "dollar"]
-    ether_dollar['date'] = pd.to_datetime(ether_dollar['date'], format='%m/%d/%Y')
-
-    # Add timestamp of date to trades for merging
-    min_trades_timestamp = trades['timestamp'].min()
-    max_trades_timestamp = trades['timestamp'].max()
+    ether_dollar['date'] = pd.to_datetime(ether_dollar['date'], format=date_format)
+    ether_dollar = ether_dollar.sort_values('timestamp', kind='stable')
+    price_timestamps = ether_dollar['timestamp'].to_numpy()
 
     # Get greatest Dollar timestamp that is smaller-equal than the smallest trades timestamp
-    min_dollar_timestamp = ether_dollar[ether_dollar['timestamp'] <= min_trades_timestamp].sort_values('timestamp').iloc[-1]['timestamp']
+    first_price = np.searchsorted(price_timestamps, trades['timestamp'].min(), side='right') - 1
 
     # Get smallest Dollar timestamp that is greater-equal than the greatest trades timestamp
-    max_dollar_timestamp = ether_dollar[ether_dollar['timestamp'] >= max_trades_timestamp].iloc[0]['timestamp']
-
-    # Get left sides of intervals
-    intervals_left = ether_dollar[(ether_dollar['timestamp'] >= min_dollar_timestamp) & 
-                                  (ether_dollar['timestamp'] <= max_dollar_timestamp)]['timestamp']
-
-    # Cut IDEX timestamps based on intervals
-    trades['cut'] = pd.cut(trades['timestamp'], bins=intervals_left, labels=intervals_left[:-1], 
-                           include_lowest=True, right=False)
-    trades['cut'] = trades['cut'].astype(float)
-
-    # Merge buy eth trades with eth-dollar price
-    trades_buyeth = trades[trades['tokenBuy'] == global_ether_id]
-    trades_buyeth = pd.merge(trades_buyeth, ether_dollar[['timestamp', 'dollar', 'date']], 
-                             left_on='cut', right_on='timestamp', suffixes=('', '_y'))
-    trades_buyeth = trades_buyeth.rename(columns={'dollar': 'eth_price'})
-    trades_buyeth = trades_buyeth[['date', 'cut', 'blockNumber', 'timestamp', 'transactionHash',
-                                   'maker', 'taker', 'tokenBuy', 'tokenSell', 'amountBoughtReal',
-                                   'amountSoldReal', 'price', 'feeMake', 'feeTake', 'eth_price']]
-    trades_buyeth = trades_buyeth.rename(columns={
-        'maker': 'eth_buyer', 'taker': 'eth_seller', 'tokenBuy': 'ether', 'tokenSell': 'token',
-        'amountBoughtReal': 'trade_amount_eth', 'amountSoldReal': 'trade_amount_token',
-        'feeMake': 'fee_eth_buyer', 'feeTake': 'fee_eth_seller'
-    })
-    trades_buyeth['trade_amount_dollar'] = trades_buyeth['trade_amount_eth'] * trades_buyeth['eth_price']
-    trades_buyeth['token_price_in_eth'] = 1 / trades_buyeth['price']
-
-    # Merge sell eth trades with eth-dollar price
-    trades_selleth = trades[trades['tokenSell'] == global_ether_id]
-    trades_selleth = pd.merge(trades_selleth, ether_dollar[['timestamp', 'dollar', 'date']], 
-                              left_on='cut', right_on='timestamp', suffixes=('', '_y'))
-    trades_selleth = trades_selleth.rename(columns={'dollar': 'eth_price'})
-    trades_selleth = trades_selleth[['date', 'cut', 'blockNumber', 'timestamp', 'transactionHash',
-                                     'maker', 'taker', 'tokenSell', 'tokenBuy', 'amountSoldReal',
-                                     'amountBoughtReal', 'price', 'feeMake', 'feeTake', 'eth_price']]
-    trades_selleth = trades_selleth.rename(columns={
-        'taker': 'eth_buyer', 'maker': 'eth_seller', 'tokenSell': 'ether', 'tokenBuy': 'token',
-        'amountSoldReal': 'trade_amount_eth', 'amountBoughtReal': 'trade_amount_token',
-        'feeTake': 'fee_eth_buyer', 'feeMake': 'fee_eth_seller'
+    last_price = np.searchsorted(price_timestamps, trades['timestamp'].max(), side='left')
+
+    if first_price < 0 or last_price == len(price_timestamps):
+        raise ValueError(f"Prices in {price_file_csv} do not cover the time range of the trades.")
+
+    # As-of join: each trade gets the latest price at or before its timestamp. Any price resolution works,
+    # the last price only closes the final interval, trades at exactly that timestamp are dropped.
+    price_index = np.searchsorted(price_timestamps, trades['timestamp'].to_numpy(), side='right') - 1
+    priced = price_index < last_price
+
+    # buy eth trades first, then sell eth trades
+    buy_eth = (trades['tokenBuy'] == global_ether_id).to_numpy()
+    sell_eth = (trades['tokenSell'] == global_ether_id).to_numpy()
+    rows = np.concatenate([np.flatnonzero(buy_eth & priced), np.flatnonzero(sell_eth & priced)])
+    buy_eth = buy_eth[rows]
+    price_index = price_index[rows]
+
+    def column(name):
+        return trades[name].to_numpy()[rows]
+
+    # the ether buyer is the maker of buy eth trades and the taker of sell eth trades
+    trades_eth = pd.DataFrame({
+        'date': ether_dollar['date'].to_numpy()[price_index],
+        'cut': price_timestamps[price_index].astype(float),
+        'blockNumber': column('blockNumber'),
+        'timestamp': column('timestamp'),
+        'transactionHash': column('transactionHash'),
+        'eth_buyer': np.where(buy_eth, column('maker'), column('taker')),
+        'eth_seller': np.where(buy_eth, column('taker'), column('maker')),
+        'ether': np.where(buy_eth, column('tokenBuy'), column('tokenSell')),
+        'token': np.where(buy_eth, column('tokenSell'), column('tokenBuy')),
+        'trade_amount_eth': np.where(buy_eth, column('amountBoughtReal'), column('amountSoldReal')),
+        'trade_amount_token': np.where(buy_eth, column('amountSoldReal'), column('amountBoughtReal')),
+        'price': column('price'),
+        'eth_price': ether_dollar['dollar'].to_numpy()[price_index],
     })
-    trades_selleth['trade_amount_dollar'] = trades_selleth['trade_amount_eth'] * trades_selleth['eth_price']
-    trades_selleth['token_price_in_eth'] = trades_selleth['price']
+    if 'fee_eth_buyer' in columns:
+        trades_eth['fee_eth_buyer'] = np.where(buy_eth, column('feeMake'), column('feeTake'))
+        trades_eth['fee_eth_seller'] = np.where(buy_eth, column('feeTake'), column('feeMake'))
+    trades_eth['trade_amount_dollar'] = trades_eth['trade_amount_eth'] * trades_eth['eth_price']
+    trades_eth['token_price_in_eth'] = trades_eth['price'].rdiv(1).where(buy_eth, trades_eth['price'])
 
-    # Concatenate and sort
-    trades_eth = pd.concat([trades_buyeth, trades_selleth]).sort_values('blockNumber')
+    # Sort and select columns
+    trades_eth = trades_eth.sort_values('blockNumber')[columns]
 
     return trades_eth
 
 
+def merge_trades_with_daily_usd_price(trades, price_file_csv="data/EtherDollarPrice.csv"):
+    return merge_trades_with_usd_price(trades, price_file_csv, IDEX_PRICED_TRADES_COLUMNS)
 
-def merge_EtherDelta_trades_with_daily_usd_price(trades, price_file_csv="data/EtherDollarPrice.csv"):
-    ether_dollar = pd.read_csv(price_file_csv)
-    ether_dollar.columns = ["date", "timestamp", "dollar"]
-    ether_dollar['date'] = pd.to_datetime(ether_dollar['date'], format="%m/%d/%Y")
-
-    # Add timestamp of date to trades for merging
-    min_trades_timestamp = trades['timestamp'].min()
-    max_trades_timestamp = trades['timestamp'].max()
 
-    # Get greatest Dollar timestamp that is smaller-equal than the smallest trades timestamp
-    min_dollar_timestamp = ether_dollar[ether_dollar['timestamp'] <= min_trades_timestamp].sort_values('timestamp').iloc[-1]['timestamp']
+def merge_EtherDelta_trades_with_daily_usd_price(trades, price_file_csv="data/EtherDollarPrice.csv"):
+    return merge_trades_with_usd_price(trades, price_file_csv, EtherDelta_PRICED_TRADES_COLUMNS)
 
-    # Get smallest Dollar timestamp that is greater-equal than the greatest trades timestamp
-    max_dollar_timestamp = ether_dollar[ether_dollar['timestamp'] >= max_trades_timestamp].iloc[0]['timestamp']
-
-    # Get left sides of intervals
-    intervals_left = ether_dollar[(ether_dollar['timestamp'] >= min_dollar_timestamp) & 
-                                  (ether_dollar['timestamp'] <= max_dollar_timestamp)]['timestamp']
-
-    # Cut IDEX timestamps based on intervals
-    trades['cut'] = pd.cut(trades['timestamp'], bins=intervals_left, labels=intervals_left[:-1], include_lowest=True, right=False)
-    trades['cut'] = trades['cut'].astype(float)
-
-    # Merge buy eth trades with eth-dollar price
-    trades_buyeth = trades[trades['tokenBuy'] == global_ether_id].merge(
-        ether_dollar[['timestamp', 'dollar', 'date']].rename(columns={'dollar': 'eth_price'}),
-        left_on='cut', right_on='timestamp', suffixes=('', '_y')
-    )
-    trades_buyeth = trades_buyeth.rename(columns={
-        'maker': 'eth_buyer', 'taker': 'eth_seller', 'tokenBuy': 'ether', 'tokenSell': 'token',
-        'amountBoughtReal': 'trade_amount_eth', 'amountSoldReal': 'trade_amount_token'
-    })
-    trades_buyeth['trade_amount_dollar'] = trades_buyeth['trade_amount_eth'] * trades_buyeth['eth_price']
-    trades_buyeth['token_price_in_eth'] = 1 / trades_buyeth['price']
-
-    # Merge sell eth trades with eth-dollar price
-    trades_selleth = trades[trades['tokenSell'] == global_ether_id].merge(
-        ether_dollar[['timestamp', 'dollar', 'date']].rename(columns={'dollar': 'eth_price'}),
-        left_on='cut', right_on='timestamp', suffixes=('', '_y')
-    )
-    trades_selleth = trades_selleth.rename(columns={
-        'taker': 'eth_buyer', 'maker': 'eth_seller', 'tokenSell': 'ether', 'tokenBuy': 'token',
-        'amountSoldReal': 'trade_amount_eth', 'amountBoughtReal': 'trade_amount_token'
-    })
-    trades_selleth['trade_amount_dollar'] = trades_selleth['trade_amount_eth'] * trades_selleth['eth_price']
-    trades_selleth['token_price_in_eth'] = trades_selleth['price']
 
-    # Concatenate and sort
-    trades_eth = pd.concat([trades_buyeth, trades_selleth]).sort_values('blockNumber')
+# POLARS FRONT END
 
-    # Select and reorder columns
-    columns = ['date', 'cut', 'blockNumber', 'timestamp', 'transactionHash', 'eth_buyer', 'eth_seller', 
-               'ether', 'token', 'trade_amount_eth', 'trade_amount_dollar', 'trade_amount_token', 'token_price_in_eth']
-    trades_eth = trades_eth[columns]
+def scan_priced_trades(file, prices_file, dex_type, date_format='%m/%d/%Y'):
+    # Polars version of load_trades, get_successful_and_complete_trades, get_ether_token_trades and
+    # merge_trades_with_usd_price as one lazy plan, so that only the needed columns and rows are read. Gives
+    # the same trades in the same order as the pandas functions.
+    columns = IDEX_TRADES_COLUMNS if dex_type == "IDEX" else EtherDelta_TRADES_COLUMNS
+    priced_columns = IDEX_PRICED_TRADES_COLUMNS if dex_type == "IDEX" else EtherDelta_PRICED_TRADES_COLUMNS
 
-    return trades_eth
+    ether_dollar = pl.read_csv(prices_file)
+    ether_dollar.columns = ["date", "timestamp", "dollar"]
+    ether_dollar = (ether_dollar
+                    .with_columns(pl.col('date').str.strptime(pl.Datetime('ns'), date_format))
+                    .sort('timestamp', maintain_order=True))
+    price_timestamps = ether_dollar['timestamp'].to_numpy()
+
+    # rows with missing values in any column (as dropna) and, for IDEX, unsuccessful trades are dropped;
+    # float NaN values are missing values to pandas
+    trades = table_io.scan_table(file, columns)
+    complete = pl.all_horizontal(pl.all().is_not_null(), pl.col(pl.Float32, pl.Float64).is_not_nan())
+    if dex_type == "IDEX":
+        complete = complete & (pl.col('status') == 1)
+    trades = (trades
+              .filter(complete)
+              .filter(((pl.col('tokenBuy') == global_ether_id) | (pl.col('tokenSell') == global_ether_id)) &
+                      (pl.col('tokenBuy') != pl.col('tokenSell')))
+              .with_columns(pl.col('timestamp').map_batches(
+                  lambda timestamps: pl.Series(np.searchsorted(price_timestamps, timestamps.to_numpy(), side='right') - 1),
+                  return_dtype=pl.Int64).alias('price_index'))
+              .select([c for c in columns if c != 'status'] + ['price_index']))
+
+    # the ether buyer is the maker of buy eth trades and the taker of sell eth trades
+    buy_eth = pl.col('tokenBuy') == global_ether_id
+
+    def by_side(buy_eth_column, sell_eth_column):
+        return pl.when(buy_eth).then(pl.col(buy_eth_column)).otherwise(pl.col(sell_eth_column))
+
+    return trades.select(
+        'price_index',
+        pl.lit(ether_dollar['date']).gather(pl.col('price_index')).alias('date'),
+        pl.lit(ether_dollar['timestamp']).gather(pl.col('price_index')).cast(pl.Float64).alias('cut'),
+        'blockNumber', 'timestamp', 'transactionHash',
+        by_side('maker', 'taker').alias('eth_buyer'),
+        by_side('taker', 'maker').alias('eth_seller'),
+        by_side('tokenBuy', 'tokenSell').alias('ether'),
+        by_side('tokenSell', 'tokenBuy').alias('token'),
+        by_side('amountBoughtReal', 'amountSoldReal').alias('trade_amount_eth'),
+        by_side('amountSoldReal', 'amountBoughtReal').alias('trade_amount_token'),
+        'price',
+        pl.lit(ether_dollar['dollar']).gather(pl.col('price_index')).alias('eth_price'),
+        *([by_side('feeMake', 'feeTake').alias('fee_eth_buyer'), by_side('feeTake', 'feeMake').alias('fee_eth_seller')]
+          if 'fee_eth_buyer' in priced_columns else []),
+        buy_eth.alias('buy_eth'),
+    ).with_columns(
+        (pl.col('trade_amount_eth') * pl.col('eth_price')).alias('trade_amount_dollar'),
+        pl.when(pl.col('buy_eth')).then(1 / pl.col('price')).otherwise(pl.col('price')).alias('token_price_in_eth')
+    ), price_timestamps, priced_columns
+
+
+def load_priced_trades(file, prices_file, dex_type):
+    # runs the plan of scan_priced_trades and puts the trades in the order of merge_trades_with_usd_price
+    trades, price_timestamps, priced_columns = scan_priced_trades(file, prices_file, dex_type)
+    trades = trades.collect()
+    print(f"Info: read file {file} with {len(trades)} complete trades of Ether and a token.")
+
+    if len(trades) == 0 or trades['price_index'].min() < 0 or trades['timestamp'].max() > price_timestamps[-1]:
+        raise ValueError(f"Prices in {prices_file} do not cover the time range of the trades.")
+
+    # trades at the timestamp of the price after the last trade are dropped, buy eth trades come first, then
+    # sell eth trades, sorted by block as pandas does (quicksort, which is not stable)
+    last_price = np.searchsorted(price_timestamps, trades['timestamp'].max(), side='left')
+    trades = trades.filter(pl.col('price_index') < last_price).sort('buy_eth', descending=True, maintain_order=True)
+    return trades[np.argsort(trades['blockNumber'].to_numpy(), kind='quicksort')].select(priced_columns)
 
 
 # SELF TRADES
 
-def filter_self_trades(trades, save=True, folder="output", filename="self_trades"):
-    self_trades = trades[trades['eth_buyer'] == trades['eth_seller']]
-    non_self_trades = trades[trades['eth_buyer'] != trades['eth_seller']]
+def filter_self_trades(trades, save=True, folder="output", filename="self_trades", file_format="csv"):
+    if isinstance(trades, pl.DataFrame):
+        # the few self-trades are returned (and written) as pandas DataFrame, as summarize_self_trades needs
+        self_trades = trades.filter(pl.col('eth_buyer') == pl.col('eth_seller')).to_pandas()
+        non_self_trades = trades.filter(pl.col('eth_buyer') != pl.col('eth_seller'))
+    else:
+        self_trades = trades[trades['eth_buyer'] == trades['eth_seller']]
+        non_self_trades = trades[trades['eth_buyer'] != trades['eth_seller']]
     print(f"Info: filtered {len(self_trades)} self-trades. {len(non_self_trades)} non-self-trades remaining.")
     if save:
-        filename = filename.split(".")[0] 
-        self_trades.to_csv(f"{folder}/{filename}.csv", index=False)
+        table_io.write_table(self_trades, folder, filename, file_format)
     return {'self_trades': self_trades, 'non_self_trades': non_self_trades}
 
 
 
-def summarize_self_trades(self_trades, save=True, folder="output", filename="self_trades_summary"):
+def summarize_self_trades(self_trades, save=True, folder="output", filename="self_trades_summary", file_format="csv"):
     summary = self_trades.groupby(['eth_buyer', 'token']).agg({
         'trade_amount_eth': 'sum',
         'trade_amount_dollar': 'sum',
@@ -176,42 +224,66 @@ def summarize_self_trades(self_trades, save=True, folder="output", filename="sel
     summary = summary.sort_values([('date', 'min')]).reset_index()
     summary.columns = ['trader', 'token', 'tx_sum_eth', 'tx_sum_dollar', 'tx_sum_token', 'start_date', 'end_date', 'tx_count']
     if save:
-        filename = filename.split(".")[0] 
-        summary.to_csv(f"{folder}/{filename}.csv", index=False)
+        table_io.write_table(summary, folder, filename, file_format)
     return summary
 
 
-def add_trader_hashes(trades, trader_hashes):
+def add_trader_hashes(trades, trader_hashes, registry=None):
+    # buyers and sellers are encoded as codes of their unique addresses, only the unique addresses are
+    # looked up; with a registry, ids are taken from (and new traders appended to) the persistent registry.
+    # Trades are a pandas or polars DataFrame.
+    n = len(trades)
+    if isinstance(trades, pl.DataFrame):
+        traders = pl.concat([trades['eth_buyer'], trades['eth_seller']])
+        addresses = traders.unique(maintain_order=True)
+        codes = traders.cast(pl.Enum(addresses)).to_physical().to_numpy()
+        addresses = addresses.to_numpy().astype(object)
+    else:
+        codes, addresses = pd.factorize(pd.concat([trades['eth_buyer'], trades['eth_seller']], ignore_index=True))
+        addresses = np.asarray(addresses, dtype=object)
 
-    if trader_hashes.empty:
-        trader_addresses = sorted(set(trades['eth_buyer']).union(set(trades['eth_seller'])))
-        trader_hashes = pd.DataFrame({
-            'trader_address': trader_addresses,
-            'trader_id': range(1, len(trader_addresses) + 1)
-        })
+    if registry is not None:
+        ids = trader_registry.add_addresses(registry, addresses)
+        order = np.argsort(ids)
+        trader_hashes = pd.DataFrame({'trader_address': addresses[order], 'trader_id': ids[order]})
     else:
-        additional_traders = set(trades['eth_buyer']).union(set(trades['eth_seller'])) - set(trader_hashes['trader_address'])
-        if additional_traders:
+        if trader_hashes.empty:
+            ids = np.zeros(len(addresses), dtype=np.int64)
+        else:
+            positions = pd.Index(trader_hashes['trader_address']).get_indexer(addresses)
+            ids = np.where(positions >= 0, trader_hashes['trader_id'].to_numpy()[positions], 0).astype(np.int64)
+
+        new = ids == 0
+        if new.any():
             n_old = len(trader_hashes)
+            new_order = np.argsort(addresses[new].astype(str), kind='stable')
+            new_ids = np.empty(new.sum(), dtype=np.int64)
+            new_ids[new_order] = np.arange(n_old + 1, n_old + new.sum() + 1)
+            ids[new] = new_ids
             new_traders = pd.DataFrame({
-                'trader_address': sorted(additional_traders),
-                'trader_id': range(n_old + 1, n_old + len(additional_traders) + 1)
+                'trader_address': addresses[new][new_order],
+                'trader_id': new_ids[new_order]
             })
-            trader_hashes = pd.concat([trader_hashes, new_traders], ignore_index=True)
-    
-    trades = trades.merge(trader_hashes.rename(columns={'trader_address': 'eth_buyer', 'trader_id': 'eth_buyer_id'}), on='eth_buyer', how='left')
-    trades = trades.merge(trader_hashes.rename(columns={'trader_address': 'eth_seller', 'trader_id': 'eth_seller_id'}), on='eth_seller', how='left')
-    trades = trades.sort_values('timestamp')
+            trader_hashes = new_traders if trader_hashes.empty else pd.concat([trader_hashes, new_traders], ignore_index=True)
+
+    trader_ids = ids[codes]
+    if isinstance(trades, pl.DataFrame):
+        # sorted by timestamp as pandas does (quicksort, which is not stable)
+        trades = trades.with_columns(pl.Series('eth_buyer_id', trader_ids[:n]), pl.Series('eth_seller_id', trader_ids[n:]))
+        trades = trades[np.argsort(trades['timestamp'].to_numpy(), kind='quicksort')]
+    else:
+        trades = trades.reset_index(drop=True).assign(eth_buyer_id=trader_ids[:n], eth_seller_id=trader_ids[n:])
+        trades = trades.sort_values('timestamp')
     return trades, trader_hashes
 
 
 
-def get_address_clusters(trades, global_scc_traders_map, global_trader_hashes, scc_ids, save=True, folder="output", filename="address_clusters"):
+def get_address_clusters(trades, global_scc_registry, global_trader_hashes, scc_ids, save=True, folder="output", filename="address_clusters"):
     address_clusters = {}
 
     # for each SCC
     for scc_id in scc_ids:
-        scc_traders = global_scc_traders_map.get(scc_id, []) 
+        scc_traders = scc_registry.get_members(global_scc_registry, scc_id)
         trader_addresses = global_trader_hashes[global_trader_hashes['trader_id'].isin(scc_traders)]['trader_address'].tolist()
         address_clusters[str(scc_id)] = trader_addresses
 
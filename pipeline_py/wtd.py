@@ -1,230 +1,789 @@
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import polars as pl
 import numpy as np
 from tqdm import tqdm
 
+import profiling
+import run_state
+import scc_registry
+import table_io
+import trade_store
+
+try:
+    import numba_kernels
+except ImportError:  # numba is not installed, the Python kernels below are used
+    numba_kernels = None
+
+
+# relative tolerance under which the running-sum mean is not trusted to decide the margin test;
+# covers the rounding drift of a sequential prefix sum for any realistic window length
+_MEAN_RTOL = 1e-6
+
+
+def encode_traders(buyers, sellers):
+    # map arbitrary trader keys to 0..n_traders-1 so balances can live in integer-indexed arrays
+    n = len(buyers)
+    keys, codes = np.unique(np.concatenate([np.asarray(buyers), np.asarray(sellers)]), return_inverse=True)
+    codes = codes.astype(np.int64)
+    return codes[:n], codes[n:], len(keys)
+
+
+def get_wash_trade_prefix_length(buyers, sellers, amounts, margin=0.1):
+    # single group version of detect_wash_trade_prefixes_batched
+    buyer_codes, seller_codes, n_traders = encode_traders(buyers, sellers)
+    return int(detect_wash_trade_prefixes_batched(buyer_codes, seller_codes, amounts,
+                                                   np.array([0, len(buyer_codes)]), n_traders, margin)[0])
+
+
+def detect_wash_trade_prefixes_batched(buyer_codes, seller_codes, amounts, group_offsets, n_traders, margin=0.1,
+                                       jit=None):
+    # Incremental balance-tracking kernel for many groups at once.
+    # Groups are given as consecutive slices group_offsets[g]:group_offsets[g+1] of the trade arrays,
+    # trader codes must be in 0..n_traders-1. For every group the length of the longest prefix
+    # (of at least two trades) in which all traders' positions are within margin of the mean trade
+    # amount is returned, 0 if there is none. Matches detect_label_wash_trades exactly: balances
+    # are built and reverted with the same floating point operations in the same order, the mean is
+    # kept as a running prefix sum and only recomputed with np.mean when the test is too close to call.
+    # jit selects the numba kernel, by default if numba is installed.
+    buyer_codes = np.asarray(buyer_codes, dtype=np.int64)
+    seller_codes = np.asarray(seller_codes, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    group_offsets = np.asarray(group_offsets, dtype=np.int64)
+    if numba_kernels is not None if jit is None else jit:
+        return numba_kernels.detect_wash_trade_prefixes(buyer_codes, seller_codes, amounts, group_offsets,
+                                                        n_traders, margin, _MEAN_RTOL)
+    n_groups = len(group_offsets) - 1
+    prefix_lengths = np.zeros(n_groups, dtype=np.int64)
+
+    if len(amounts) == 0:
+        return prefix_lengths
+
+    # forward pass for all groups in one go: one balance slot per (group, trader),
+    # np.add.at applies the interleaved buyer/seller updates sequentially in trade order
+    group_of_trade = np.repeat(np.arange(n_groups, dtype=np.int64), np.diff(group_offsets))
+    slots = np.empty(2 * len(amounts), dtype=np.int64)
+    slots[0::2] = group_of_trade * n_traders + buyer_codes
+    slots[1::2] = group_of_trade * n_traders + seller_codes
+    deltas = np.empty(2 * len(amounts), dtype=np.float64)
+    deltas[0::2] = amounts
+    deltas[1::2] = -amounts
+    slot_keys, slot_codes = np.unique(slots, return_inverse=True)
+    final_balances = np.zeros(len(slot_keys), dtype=np.float64)
+    np.add.at(final_balances, slot_codes, deltas)
+
+    slot_codes = slot_codes.tolist()
+    final_balances = final_balances.tolist()
+    amounts_list = amounts.tolist()
+    offsets_list = group_offsets.tolist()
+
+    for g in range(n_groups):
+        start, end = offsets_list[g], offsets_list[g + 1]
+        if end - start < 2:
+            continue
+
+        # balances of this group are indexed by the slot codes of its trades
+        lo = min(slot_codes[2 * start:2 * end])
+        hi = max(slot_codes[2 * start:2 * end]) + 1
+        balances = final_balances[lo:hi]
+        abs_balances = [abs(b) for b in balances]
+        max_balance = max(abs_balances)
+        max_trader = abs_balances.index(max_balance)
+
+        # running sum of trade amounts for the mean
+        prefix_sums = np.cumsum(amounts[start:end]).tolist()
+
+        for idx in range(end - 1, start, -1):
+            n = idx - start + 1
+            mean_trade_vol = abs(prefix_sums[n - 1] / n)
+
+            if max_balance == 0:
+                is_wash = margin >= 0
+            elif mean_trade_vol == 0:
+                is_wash = None
+            else:
+                ratio = max_balance / mean_trade_vol
+                is_wash = ratio <= margin if abs(ratio - margin) > ratio * _MEAN_RTOL else None
+
+            if is_wash is None:
+                # too close to call with the running sum, recompute the mean the way numpy does
+                mean_trade_vol = np.mean(amounts[start:idx + 1])
+                if mean_trade_vol == 0:
+                    mean_trade_vol = 1
+                is_wash = max_balance / abs(mean_trade_vol) <= margin
+
+            if is_wash:
+                prefix_lengths[g] = n
+                break
+
+            # revert trade idx: buyer first, then seller
+            amount = amounts_list[idx]
+            for trader, delta in ((slot_codes[2 * idx] - lo, amount), (slot_codes[2 * idx + 1] - lo, -amount)):
+                balances[trader] -= delta
+                abs_balance = abs(balances[trader])
+                abs_balances[trader] = abs_balance
+                if abs_balance >= max_balance:
+                    max_balance, max_trader = abs_balance, trader
+                elif trader == max_trader:
+                    max_balance = max(abs_balances)
+                    max_trader = abs_balances.index(max_balance)
+
+    return prefix_lengths
+
+
+def detect_wash_trade_prefixes_cached(trades, buyer_codes, seller_codes, group_offsets, n_traders, margin, cache):
+    # detect_wash_trade_prefixes_batched for the groups whose trades (buyer, seller and amount, in order)
+    # are not in the cache, prefix lengths of the other groups are taken from the cache
+    keys = run_state.get_group_keys(trades.select(['buyer', 'seller', 'amount']), group_offsets)
+    cached = [run_state.get_cached(cache, key) for key in keys]
+    missing = np.array([prefix_length is None for prefix_length in cached], dtype=bool)
+    prefix_lengths = np.array([-1 if prefix_length is None else prefix_length for prefix_length in cached],
+                              dtype=np.int64)
+
+    if missing.any():
+        group_lengths = np.diff(np.asarray(group_offsets, dtype=np.int64))
+        rows = np.repeat(missing, group_lengths)
+        prefix_lengths[missing] = detect_wash_trade_prefixes_batched(
+            buyer_codes[rows], seller_codes[rows], trades["amount"].to_numpy()[rows],
+            np.concatenate([[0], np.cumsum(group_lengths[missing])]), n_traders, margin)
+        for g in np.flatnonzero(missing).tolist():
+            run_state.set_cached(cache, keys[g], int(prefix_lengths[g]))
+
+    return prefix_lengths
+
+
+def get_window_test(buyer_codes, seller_codes, amounts, max_balance, amount_sum, margin):
+    # balance test of a sliding window with incrementally kept max_balance and amount_sum, recomputed from
+    # the window's trades in trade order when the incremental values are too close to call
+    n = len(amounts)
+    mean_trade_vol = abs(amount_sum / n)
+    if max_balance == 0:
+        return margin >= 0
+    if mean_trade_vol != 0 and max_balance > mean_trade_vol * _MEAN_RTOL:
+        ratio = max_balance / mean_trade_vol
+        if abs(ratio - margin) > ratio * _MEAN_RTOL:
+            return ratio <= margin
+
+    exact_balances = np.zeros(max(buyer_codes.max(), seller_codes.max()) + 1, dtype=np.float64)
+    np.add.at(exact_balances, np.stack([buyer_codes, seller_codes], axis=1).ravel(),
+              np.stack([amounts, -amounts], axis=1).ravel())
+    mean_trade_vol = np.mean(amounts)
+    if mean_trade_vol == 0:
+        mean_trade_vol = 1
+    return np.abs(exact_balances).max() / abs(mean_trade_vol) <= margin
+
+
+def detect_wash_trades_sliding(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders, margin,
+                               window_start, window_size, window_stride, jit=None):
+    # Sliding window version of the balance test. Groups are given as consecutive slices of the trade arrays
+    # as in detect_wash_trade_prefixes_batched, with the trades of a group sorted by timestamp. Windows are
+    # [window_start + k * window_stride, window_start + k * window_stride + window_size) for every integer k.
+    # Two pointers move over the trades of a group, so that every trade enters and leaves the window once and
+    # balances and the sum of amounts are updated incrementally. The trades between the pointers are tested
+    # after every move, window positions whose trades do not differ from the previous position are skipped.
+    # All trades between the pointers, if at least two, in which all traders' positions are within margin of
+    # the mean trade amount are wash trades. jit selects the numba kernel, by default if numba is installed.
+    buyer_codes = np.asarray(buyer_codes, dtype=np.int64)
+    seller_codes = np.asarray(seller_codes, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    group_offsets = np.asarray(group_offsets, dtype=np.int64)
+    if numba_kernels is not None if jit is None else jit:
+        marks = numba_kernels.detect_wash_trades_sliding(
+            buyer_codes, seller_codes, amounts, np.asarray(timestamps, dtype=np.float64), group_offsets, n_traders,
+            margin, window_start, window_size, window_stride, _MEAN_RTOL)
+        return np.cumsum(marks[:-1]) > 0
+    marks = np.zeros(len(amounts) + 1, dtype=np.int64)
+
+    buyers_list = buyer_codes.tolist()
+    sellers_list = seller_codes.tolist()
+    amounts_list = amounts.tolist()
+    timestamps_list = np.asarray(timestamps, dtype=np.float64).tolist()
+    offsets_list = group_offsets.tolist()
+
+    for g in range(len(offsets_list) - 1):
+        start, end = offsets_list[g], offsets_list[g + 1]
+        if end - start < 2:
+            continue
+
+        # balances and number of window trades per trader; a trader without trades in the window has
+        # balance 0 exactly, so that rounding does not carry over to later windows
+        balances = [0.0] * n_traders
+        abs_balances = [0.0] * n_traders
+        window_trades = [0] * n_traders
+        max_balance, max_trader = 0.0, 0
+        amount_sum = 0.0
+
+        lo = hi = start
+        k = int(np.floor((timestamps_list[start] - window_start - window_size) / window_stride)) + 1
+        while True:
+            window_lo = window_start + k * window_stride
+            window_hi = window_lo + window_size
+
+            # trades leave (sign -1) and enter (sign 1) the window one by one, the window is tested after every
+            # move, so that the prefixes of the window are tested as well
+            while True:
+                if lo < hi and timestamps_list[lo] < window_lo:
+                    idx, sign = lo, -1
+                    lo += 1
+                elif hi < end and timestamps_list[hi] < window_hi:
+                    idx, sign = hi, 1
+                    hi += 1
+                else:
+                    break
+
+                # buyer first, then seller
+                amount = amounts_list[idx]
+                amount_sum = amount_sum + sign * amount if hi > lo else 0.0
+                for trader, delta in ((buyers_list[idx], sign * amount), (sellers_list[idx], -sign * amount)):
+                    window_trades[trader] += sign
+                    balances[trader] = balances[trader] + delta if window_trades[trader] > 0 else 0.0
+                    abs_balance = abs(balances[trader])
+                    abs_balances[trader] = abs_balance
+                    if abs_balance >= max_balance:
+                        max_balance, max_trader = abs_balance, trader
+                    elif trader == max_trader:
+                        max_balance = max(abs_balances)
+                        max_trader = abs_balances.index(max_balance)
+
+                if hi - lo >= 2 and get_window_test(buyer_codes[lo:hi], seller_codes[lo:hi], amounts[lo:hi],
+                                                    max_balance, amount_sum, margin):
+                    marks[lo] += 1
+                    marks[hi] -= 1
+
+            # next window position whose trades differ: the oldest trade leaves or the next trade enters
+            next_positions = []
+            if lo < hi:
+                next_positions.append(int(np.floor((timestamps_list[lo] - window_start) / window_stride)) + 1)
+            if hi < end:
+                next_positions.append(
+                    int(np.floor((timestamps_list[hi] - window_start - window_size) / window_stride)) + 1)
+            if not next_positions:
+                break
+            k = max(k + 1, min(next_positions))
+
+    return np.cumsum(marks[:-1]) > 0
+
+
+def label_wash_trades(df: pl.DataFrame, prefix_length: int) -> pl.DataFrame:
+    # the first prefix_length trades are wash trades, the remaining ones are checked
+    if prefix_length == 0:
+        return df
+    return df.with_columns(
+        pl.when(pl.arange(0, len(df)) < prefix_length)
+        .then(pl.lit(True))
+        .otherwise(pl.col('wash_label').fill_null(False))
+        .alias('wash_label')
+    )
 
 
 def detect_label_wash_trades(df: pl.DataFrame, margin: float = 0.1) -> pl.DataFrame:
-    buyers = df['buyer'].to_list()
-    sellers = df['seller'].to_list()
-    amounts = df['amount'].to_list()
-
-    balance_map = {}
-    trade_amounts = []
-
-    for buyer, seller, amount in zip(buyers, sellers, amounts):
-        trade_amounts.append(amount)
-        balance_map[buyer] = balance_map.get(buyer, 0) + amount
-        balance_map[seller] = balance_map.get(seller, 0) - amount
-
-    for idx in range(len(df) - 1, 0, -1):
-        balances = np.array(list(balance_map.values()))
-        mean_trade_vol = np.mean(trade_amounts)
-        if mean_trade_vol == 0:
-            mean_trade_vol = 1
-        balances = np.abs(balances / mean_trade_vol)
-
-        if np.all(balances <= margin):
-            wash_indices = list(range(idx + 1))
-            df = df.with_columns(
-                pl.when(pl.col('wash_label').is_null())
-                .then(pl.lit(False))
-                .otherwise(pl.col('wash_label'))
-                .alias('wash_label')
-            )
-            df = df.with_columns(
-                pl.when(pl.arange(0, len(df)).is_in(wash_indices))
-                .then(pl.lit(True))
-                .otherwise(pl.col('wash_label'))
-                .alias('wash_label')
-            )
-            return df
-
-        amount = amounts[idx]
-        trade_amounts.pop()
-
-        balance_map[buyers[idx]] -= amount
-        balance_map[sellers[idx]] += amount
-
-    return df
+    prefix_length = get_wash_trade_prefix_length(df['buyer'].to_numpy(), df['seller'].to_numpy(),
+                                                 df['amount'].to_numpy(), margin)
+    return label_wash_trades(df, prefix_length)
 
 
 
-def detect_and_label_wash_trades_for_scc_using_multiple_passes(
-    trades, global_scc_traders_map, relevant_scc, window_sizes_in_seconds, window_start=None, 
-    ether=True, margin=0.1, save=True, folder="output", 
-    filename="wash_trades_multiple_windows"
-):   
-    print(f"Starting wash trade labeling with {len(window_sizes_in_seconds)} passes.")
-    
-    checked_trades_hashes = []
-    checked_trades_labels = []
+# wash labels are kept in an int8 vector indexed by tx_id while detection runs
+LABEL_UNCHECKED = -1
+LABEL_NO_WASH = 0
+LABEL_WASH = 1
 
-    # Convert to polars DataFrame
-    trades = pl.from_pandas(trades)
 
-    trades = trades.with_columns(pl.lit(None).alias("wash_label"))
+def add_wash_label_index(trades):
+    # integer id per transaction hash, all trades of a transaction share their wash label
+    return trades.with_columns(
+        (pl.col("transactionHash").rank("dense") - 1).cast(pl.Int64).alias("tx_id")
+    )
 
+
+def new_wash_labels(trades):
+    return np.full(trades["tx_id"].max() + 1 if len(trades) > 0 else 0, LABEL_UNCHECKED, dtype=np.int8)
+
+
+def get_windows_per_window_size(trades, window_sizes_in_seconds, window_start=None, window_stride=None):
     # if window start is not given, take start of first day of given trades
     if window_start is None:
         window_start = trades['cut'].min()
 
-    wash_trades = {}
+    # window start, number of windows and step from start to last timestamp (incl.), in seconds; trades before
+    # the start are in window -1, trades after the last window start in the last window. The step is the
+    # window size, or the window stride if it is smaller, in which case windows slide and overlap; the
+    # windows of the summary are then the steps of the stride.
+    if window_stride is not None and window_stride <= 0:
+        raise ValueError(f"Invalid window stride {window_stride}, must be positive")
+    max_timestamp = trades['timestamp'].max()
+    windows = {}
+    for window_size in window_sizes_in_seconds:
+        step = window_stride if window_stride is not None and window_stride < window_size else window_size
+        windows[window_size] = (window_start, max(0, int(np.ceil((max_timestamp - window_start) / step))), step)
+    return windows
+
+
+def get_window_ids(timestamps, windows):
+    window_start, n_windows, step = windows
+    return ((timestamps - window_start) // step).clip(-1, n_windows - 1).cast(pl.Int64)
+
+
+def get_window_labels(window_ids, windows):
+    # "[start, end)" labels of the given window ids, formatted by pl.cut as in earlier versions: the breaks
+    # next to the windows are cut, so that the labels of the first and last window are open-ended
+    window_start, n_windows, step = windows
+    window_ids = np.asarray(window_ids, dtype=np.int64)
+    starts = window_start + window_ids * step
+    breaks = np.union1d(starts[window_ids >= 0], starts[window_ids + 1 < n_windows] + step)
+    return (pl.Series(np.where(window_ids >= 0, starts, -np.inf), dtype=pl.Float64)
+            .cut(breaks.tolist(), left_closed=True)
+            .cast(pl.String))
+
+
+def get_trades_per_scc(trades, registry, scc_ids):
+    # trades between the traders of each SCC, in the order of trades, from the SCCs of every buyer in the
+    # registry instead of filtering all trades once per SCC
+    rows, positions = scc_registry.get_member_trades(registry, trades['eth_buyer_id'].to_numpy(),
+                                                     trades['eth_seller_id'].to_numpy(), scc_ids)
+    bounds = np.searchsorted(positions, np.arange(len(scc_ids) + 1))
+    return {scc_id: trades[rows[bounds[i]:bounds[i + 1]]] for i, scc_id in enumerate(scc_ids)}
+
+
+def get_ranges(starts, ends):
+    # positions of the ranges [starts[i], ends[i]), one range after the other
+    counts = ends - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum(), dtype=np.int64)
+
+
+def get_pair_index(trades):
+    # rows of the trades per (buyer id, seller id) pair, built once for all SCCs and passes: pairs are
+    # sorted by buyer, then seller, and pair i has the rows rows[offsets[i]:offsets[i + 1]] in increasing order
+    buyer_ids = trades['eth_buyer_id'].to_numpy().astype(np.int64)
+    seller_ids = trades['eth_seller_id'].to_numpy().astype(np.int64)
+    rows = np.lexsort([seller_ids, buyer_ids])
+    buyer_ids, seller_ids = buyer_ids[rows], seller_ids[rows]
+    new_pair = np.ones(len(rows), dtype=bool)
+    new_pair[1:] = (buyer_ids[1:] != buyer_ids[:-1]) | (seller_ids[1:] != seller_ids[:-1])
+    starts = np.flatnonzero(new_pair)
+    return {'buyer_ids': buyer_ids[starts], 'seller_ids': seller_ids[starts],
+            'offsets': np.append(starts, len(rows)), 'rows': rows}
+
+
+def get_pair_rows(pair_index, members):
+    # rows of the trades between the given sorted trader ids, in the order of trades: only the pairs of
+    # the members as buyers are looked up, instead of filtering all trades
+    buyer_ids, seller_ids, offsets = pair_index['buyer_ids'], pair_index['seller_ids'], pair_index['offsets']
+    members = np.asarray(members, dtype=np.int64)
+    if len(members) == 0:
+        return np.empty(0, dtype=np.int64)
+    pairs = get_ranges(np.searchsorted(buyer_ids, members, side='left'),
+                       np.searchsorted(buyer_ids, members, side='right'))
+    found = np.minimum(np.searchsorted(members, seller_ids[pairs]), len(members) - 1)
+    pairs = pairs[members[found] == seller_ids[pairs]]
+    return np.sort(pair_index['rows'][get_ranges(offsets[pairs], offsets[pairs + 1])])
+
+
+def wash_labels_to_series(labels, name="wash_label"):
+    labels = pl.Series(labels, dtype=pl.Int8)
+    return pl.select(
+        pl.when(labels == LABEL_UNCHECKED).then(None)
+        .otherwise(labels == LABEL_WASH)
+        .alias(name)
+    ).to_series()
+
+
+def detect_and_label_wash_trades_for_scc(scc_trades, labels, scc_id, window_size, windows, wash_trades,
+                                         ether=True, margin=0.1, cache=None):
+    # scc_trades are the trades between the traders of the SCC, in the order of trades (see get_pair_rows)
+    scc_labels = labels[scc_trades["tx_id"].to_numpy()]
+    scc_trades = (scc_trades
+                  .with_columns(wash_labels_to_series(scc_labels))
+                  .filter(pl.Series(scc_labels != LABEL_WASH))
+                  .sort("cut", maintain_order=True))
     
+    if len(scc_trades) == 0:
+        # wash_trades[scc_id] = {str(window_size): []}
+        # wash_trades.setdefault(scc_id, {}).setdefault(str(window_size), {})
+        return
+    
+    # label these trades as FALSE to indicate they have been checked
+    labels[scc_trades["tx_id"].to_numpy()] = LABEL_NO_WASH
+
+    # Prepare trades for processing; trades of a shard keep their row in all trades, see shards.py
+    row = ["row"] if "row" in scc_trades.columns else []
+    temp_trades = scc_trades.select([
+        "transactionHash", "token", "date", "timestamp", "trade_amount_dollar", "wash_label",
+        pl.col("eth_buyer" if ether else "eth_seller").alias("buyer"),
+        pl.col("eth_seller" if ether else "eth_buyer").alias("seller"),
+        pl.col("trade_amount_eth" if ether else "trade_amount_token").alias("amount"),
+        *row
+    ])
+
+
+    # Process trades in time windows
+    window_start, _, step = windows
+    sliding = step < window_size
+    temp_trades = temp_trades.with_columns(
+        get_window_ids(pl.col("timestamp"), windows).alias("window")
+    )
+
+    # order trades by window, keeping the time order within each window; sliding windows run over all
+    # trades of a token, sorted by timestamp
+    if sliding:
+        groups = (temp_trades.with_row_index("index")
+                  .group_by('token', maintain_order=True)
+                  .agg(pl.col("index").sort_by("timestamp", maintain_order=True)))
+    else:
+        groups = (temp_trades.with_row_index("index")
+                  .group_by(['token', 'window'], maintain_order=True)
+                  .agg(pl.col("index")))
+    rows = groups["index"].explode().to_numpy()
+    group_lengths = groups["index"].list.len().to_numpy()
+    group_offsets = np.concatenate([[0], np.cumsum(group_lengths)])
+    temp_trades = temp_trades[rows]
+    profiling.annotate(trades=len(temp_trades), windows=len(group_lengths), max_window_trades=int(group_lengths.max()))
+
+    # run the balance-tracking kernel on all windows of this SCC at once
+    buyer_codes, seller_codes, n_traders = encode_traders(
+        scc_trades["eth_buyer_id" if ether else "eth_seller_id"].to_numpy()[rows],
+        scc_trades["eth_seller_id" if ether else "eth_buyer_id"].to_numpy()[rows])
+    # the state only keeps prefix lengths of fixed windows, sliding windows are always detected
+    if sliding:
+        is_wash = detect_wash_trades_sliding(
+            buyer_codes, seller_codes, temp_trades["amount"].to_numpy(), temp_trades["timestamp"].to_numpy(),
+            group_offsets, n_traders, margin, window_start, window_size, step)
+        relabel = is_wash
+    else:
+        if cache is None:
+            prefix_lengths = detect_wash_trade_prefixes_batched(
+                buyer_codes, seller_codes, temp_trades["amount"].to_numpy(), group_offsets, n_traders, margin)
+        else:
+            prefix_lengths = detect_wash_trade_prefixes_cached(
+                temp_trades, buyer_codes, seller_codes, group_offsets, n_traders, margin, cache)
+
+        position_in_group = np.arange(len(temp_trades)) - np.repeat(group_offsets[:-1], group_lengths)
+        is_wash = position_in_group < np.repeat(prefix_lengths, group_lengths)
+        relabel = np.repeat(prefix_lengths > 0, group_lengths)
+    temp_trades = temp_trades.with_columns(
+        pl.when(pl.Series(relabel))
+        .then(pl.Series(is_wash))
+        .otherwise(pl.col('wash_label'))
+        .alias('wash_label')
+    )
+
+    # checked trades of this SCC and pass, windows one after the other, with the columns of the summary
+    wash_trades[(scc_id, window_size)] = temp_trades.select(
+        pl.lit(scc_id).alias('scc_hash'),
+        pl.lit(str(window_size)).alias('window_size'),
+        pl.col('token').cast(pl.String),
+        'window', 'wash_label', 'amount', 'trade_amount_dollar', *row
+    )
+
+    # update labels with the detected wash trades
+    labels[scc_trades["tx_id"].to_numpy()[rows][is_wash]] = LABEL_WASH
+
+
+
+def detect_and_label_wash_trades_for_scc_group(trades, labels, registry, scc_ids, window_sizes_in_seconds,
+                                               windows_per_window_size, ether=True, margin=0.1, progress=True,
+                                               cache=None, trades_per_scc=None):
+    # all passes for the given SCCs, in the order in which they are given; trades_per_scc optionally holds
+    # the trades of every SCC (see get_trades_per_scc), otherwise they are looked up in a pair index of the
+    # trades that all passes share. Returns the checked trades per (SCC, window size), see get_wash_trades_frame.
+    wash_trades = {}
+    pair_index = get_pair_index(trades) if trades_per_scc is None else None
+
     for window_size in window_sizes_in_seconds:
+        windows = windows_per_window_size[window_size]
+
+        for scc_id in tqdm(scc_ids, desc=f"Processing SCCs for window size {window_size}", disable=not progress):
+            with profiling.span(f"scc {scc_id}", "wash_scc", scc=scc_id, window_size=window_size):
+                if trades_per_scc is not None:
+                    scc_trades = trades_per_scc[scc_id]
+                else:
+                    scc_trades = trades[get_pair_rows(pair_index, scc_registry.get_members(registry, scc_id))]
+                detect_and_label_wash_trades_for_scc(scc_trades, labels, scc_id, window_size, windows, wash_trades,
+                                                     ether=ether, margin=margin, cache=cache)
+
+    return wash_trades
+
+
+def _detect_and_label_wash_trades_for_scc_group_worker(trades, n_labels, registry, scc_ids,
+                                                       window_sizes_in_seconds, windows_per_window_size,
+                                                       ether, margin, cache, profile=False):
+    if profile:
+        profiling.start()
+    labels = np.full(n_labels, LABEL_UNCHECKED, dtype=np.int8)
+    wash_trades = detect_and_label_wash_trades_for_scc_group(
+        trades, labels, registry, scc_ids, window_sizes_in_seconds, windows_per_window_size,
+        ether=ether, margin=margin, progress=False, cache=cache)
+    checked = np.flatnonzero(labels != LABEL_UNCHECKED)
+    return (wash_trades, checked, labels[checked], cache['current'] if cache is not None else None,
+            profiling.stop() if profile else [])
+
+
+def get_independent_scc_groups(trades, registry, relevant_scc):
+    # SCCs only interact through the wash labels of the trades they check, which are set per transaction.
+    # Two SCCs end up in the same group if their trades share a transaction.
+    scc_tx_ids = []
+    parent = list(range(len(relevant_scc)))
+    rows, positions = scc_registry.get_member_trades(registry, trades['eth_buyer_id'].to_numpy(),
+                                                     trades['eth_seller_id'].to_numpy(), relevant_scc)
+    bounds = np.searchsorted(positions, np.arange(len(relevant_scc) + 1))
+    tx_ids_of_rows = trades['tx_id'].to_numpy()
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_scc_of_tx = {}
+    for i in range(len(relevant_scc)):
+        tx_ids = np.unique(tx_ids_of_rows[rows[bounds[i]:bounds[i + 1]]]).tolist()
+        scc_tx_ids.append(tx_ids)
+
+        for tx_id in tx_ids:
+            j = first_scc_of_tx.setdefault(tx_id, i)
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    # groups keep the order of relevant_scc, both among and within groups
+    groups = {}
+    for i in range(len(relevant_scc)):
+        group = groups.setdefault(find(i), {'scc_ids': [], 'tx_ids': []})
+        group['scc_ids'].append(relevant_scc[i])
+        group['tx_ids'].extend(scc_tx_ids[i])
+
+    return list(groups.values())
+
+
+def detect_and_label_wash_trades_for_scc_using_multiple_passes(
+    trades, registry, relevant_scc, window_sizes_in_seconds, window_start=None, 
+    ether=True, margin=0.1, workers=1, save=True, folder="output", 
+    filename="wash_trades_multiple_windows", file_format="csv", cache=None, windows_per_window_size=None
+):   
+    print(f"Starting wash trade labeling with {len(window_sizes_in_seconds)} passes.")
+
+    # Convert to polars DataFrame
+    trades = add_wash_label_index(trades if isinstance(trades, pl.DataFrame) else pl.from_pandas(trades))
+    labels = new_wash_labels(trades)
+    if windows_per_window_size is None:
+        windows_per_window_size = get_windows_per_window_size(trades, window_sizes_in_seconds, window_start)
+
+    if workers <= 1:
+        wash_trades = detect_and_label_wash_trades_for_scc_group(
+            trades, labels, registry, relevant_scc, window_sizes_in_seconds, windows_per_window_size,
+            ether=ether, margin=margin, cache=cache)
+    else:
+        wash_trades = _detect_and_label_wash_trades_in_parallel(
+            trades, labels, registry, relevant_scc, window_sizes_in_seconds, windows_per_window_size,
+            ether, margin, workers, cache)
+
+    wash_trades = get_wash_trades_frame(wash_trades)
 
-        # breaks from start to last timestamp (incl.), by given steps in seconds
-        intervals = np.arange(window_start, trades['timestamp'].max(), window_size)
-        
-        for scc_id in tqdm(relevant_scc, desc=f"Processing SCCs for window size {window_size}"):
-
-            scc_traders = global_scc_traders_map[scc_id]
-            
-            # Filter trades for the relevant SCC
-            scc_trades = trades.filter(
-                (pl.col("eth_seller_id").is_in(scc_traders)) & 
-                (pl.col("eth_buyer_id").is_in(scc_traders)) & 
-                ((pl.col("wash_label") == False) | (pl.col("wash_label").is_null()))
-            ).sort("cut")
-            
-            if len(scc_trades) == 0:
-                # wash_trades[scc_id] = {str(window_size): []}
-                # wash_trades.setdefault(scc_id, {}).setdefault(str(window_size), {})
-                continue
-            
-            # label these trades as FALSE in original trade set to indicate they have been checked
-            trades = trades.with_columns(
-                pl.when(pl.col("transactionHash").is_in(scc_trades["transactionHash"]))
-                .then(False)
-                .otherwise(pl.col("wash_label"))
-                .alias("wash_label")
-            )
-
-            # Prepare trades for processing
-            temp_trades = scc_trades.select([
-                "transactionHash", "token", "date", "timestamp", "trade_amount_dollar", "wash_label",
-                pl.col("eth_buyer" if ether else "eth_seller").alias("buyer"),
-                pl.col("eth_seller" if ether else "eth_buyer").alias("seller"),
-                pl.col("trade_amount_eth" if ether else "trade_amount_token").alias("amount")
-            ])
-
-
-            # Process trades in time windows
-            temp_trades = temp_trades.with_columns(
-                pl.col("timestamp").cut(intervals, left_closed=True).alias("interval")
-            )
-
-            for names, data in temp_trades.group_by(['token', 'interval']):
-
-                detected_wash_trades = detect_label_wash_trades(data, margin)
-
-                # copy tx_hash and label to checked_trades
-                checked_trades_hashes.extend(detected_wash_trades['transactionHash'])
-                checked_trades_labels.extend(detected_wash_trades['wash_label'])
- 
-                wash_trades.setdefault(scc_id, {}).setdefault(str(window_size), {})['.'.join(names)] = detected_wash_trades
-
-
-            # update trades with checked_trades
-            # join checked_trades to trades and replace with wash_label from checked_trades
-            checked_trades_df = pl.DataFrame(
-                {"transactionHash": checked_trades_hashes,"wash_label": checked_trades_labels}, 
-                schema={"transactionHash": pl.Utf8, "wash_label": pl.Boolean}
-            )
-            try:
-                tx_hash_true_list = checked_trades_df.filter(checked_trades_df['wash_label'] == True)['transactionHash'].to_list()
-            except Exception as e:
-                tx_hash_true_list = []
-
-            trades = (
-                trades
-                .with_columns(
-                    pl.when(pl.col("transactionHash").is_in(tx_hash_true_list))
-                    .then(True)
-                    .otherwise(pl.col("wash_label"))
-                    .alias("wash_label")
-                )
-            )
-
-            checked_trades_hashes = []
-            checked_trades_labels = []
+    # build the labeled trades once
+    trades = (trades
+              .with_columns(wash_labels_to_series(labels[trades["tx_id"].to_numpy()]))
+              .drop("tx_id"))
 
     if save:
         # Save results
-        filename = filename.split('.')[0]
-        trades.write_csv(os.path.join(folder, "trades_labeled.csv"))
+        table_io.write_table(trades, folder, "trades_labeled", file_format)
     
     return wash_trades, trades
 
 
+def _detect_and_label_wash_trades_in_parallel(trades, labels, registry, relevant_scc, window_sizes_in_seconds,
+                                              windows_per_window_size, ether, margin, workers, cache=None):
+    groups = get_independent_scc_groups(trades, registry, relevant_scc)
+    print(f"Info: split {len(relevant_scc)} SCCs into {len(groups)} independent groups for {workers} workers.")
+
+    # pack groups into tasks of similar size, largest groups first
+    n_tasks = min(len(groups), workers * 4)
+    tasks = [{'scc_ids': [], 'tx_ids': [], 'size': 0} for _ in range(n_tasks)]
+    for group in sorted(groups, key=lambda group: len(group['tx_ids']), reverse=True):
+        task = min(tasks, key=lambda task: task['size'])
+        task['scc_ids'].extend(group['scc_ids'])
+        task['tx_ids'].extend(group['tx_ids'])
+        task['size'] += len(group['tx_ids']) + 1
+
+    scc_order = {scc_id: i for i, scc_id in enumerate(relevant_scc)}
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = []
+        for task in tasks:
+            scc_ids = sorted(task['scc_ids'], key=scc_order.get)
+            futures.append(executor.submit(
+                _detect_and_label_wash_trades_for_scc_group_worker,
+                trades.filter(pl.col("tx_id").is_in(task['tx_ids'])), len(labels),
+                scc_registry.get_subset(registry, scc_ids), scc_ids,
+                window_sizes_in_seconds, windows_per_window_size, ether, margin, cache, profiling.is_enabled()))
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing SCC groups"):
+            results.append(future.result())
+
+    # groups never share a transaction, so their labels can be merged in any order
+    for _, checked, task_labels, task_cache, task_events in results:
+        labels[checked] = task_labels
+        if cache is not None:
+            cache['current'].update(task_cache)
+        profiling.add_events(task_events)
+
+    # rebuild wash_trades in the order a serial run inserts its keys
+    task_wash_trades = {key: frame for result in results for key, frame in result[0].items()}
+    wash_trades = {(scc_id, window_size): task_wash_trades[(scc_id, window_size)]
+                   for window_size in window_sizes_in_seconds for scc_id in relevant_scc
+                   if (scc_id, window_size) in task_wash_trades}
+
+    return wash_trades
+
+
+
+def detect_and_label_wash_trades_for_token_groups(store, token_groups, labels, registry, relevant_scc,
+                                                  window_sizes_in_seconds, windows_per_window_size, ether=True,
+                                                  margin=0.1, progress=True, cache=None):
+    # all passes for the given groups of tokens of a trade store, reading one group at a time; groups never
+    # share a transaction, so they are independent. Returns the checked trades per (SCC, window size) of
+    # every group, see detect_and_label_wash_trades_for_scc_group.
+    wash_trades_per_group = []
+    for tokens in tqdm(token_groups, desc="Processing tokens", disable=not progress):
+        trades = trade_store.read_tokens(store, tokens)
+        trades_per_scc = get_trades_per_scc(trades, registry, relevant_scc)
+        scc_ids = [scc_id for scc_id in relevant_scc if len(trades_per_scc[scc_id]) > 0]
+        with profiling.span(f"tokens {tokens[0]}", "wash_tokens", tokens=len(tokens), trades=len(trades),
+                            sccs=len(scc_ids)):
+            wash_trades_per_group.append(detect_and_label_wash_trades_for_scc_group(
+                trades, labels, registry, scc_ids, window_sizes_in_seconds, windows_per_window_size,
+                ether=ether, margin=margin, progress=False, cache=cache, trades_per_scc=trades_per_scc))
+    return wash_trades_per_group
+
+
+def _detect_and_label_wash_trades_for_token_groups_worker(store, token_groups, registry, relevant_scc,
+                                                          window_sizes_in_seconds, windows_per_window_size,
+                                                          ether, margin, cache, profile=False):
+    if profile:
+        profiling.start()
+    labels = np.full(store['n_transactions'], LABEL_UNCHECKED, dtype=np.int8)
+    wash_trades_per_group = detect_and_label_wash_trades_for_token_groups(
+        store, token_groups, labels, registry, relevant_scc, window_sizes_in_seconds,
+        windows_per_window_size, ether=ether, margin=margin, progress=False, cache=cache)
+    checked = np.flatnonzero(labels != LABEL_UNCHECKED)
+    return (wash_trades_per_group, checked, labels[checked], cache['current'] if cache is not None else None,
+            profiling.stop() if profile else [])
+
+
+def detect_and_label_wash_trades_in_store(
+    store, registry, relevant_scc, window_sizes_in_seconds, windows_per_window_size,
+    ether=True, margin=0.1, workers=1, save=True, folder="output", file_format="csv", cache=None
+):
+    # detect_and_label_wash_trades_for_scc_using_multiple_passes for the trades of a trade store, one group
+    # of tokens at a time, so that memory is bounded by the largest group instead of all trades. Checked
+    # trades are in the order of the token groups, the labeled trades are written from the store.
+    print(f"Starting wash trade labeling with {len(window_sizes_in_seconds)} passes.")
 
-def get_summary_of_wash_trades_per_scc_and_timewindow(wash_trades, window_size_name, multiple_passes=False, 
-                                                      save=True, folder="output", filename="wash_trades_summary"):
-    print("Info: producing wash trading summary...")
+    labels = np.full(store['n_transactions'], LABEL_UNCHECKED, dtype=np.int8)
+    registry = scc_registry.get_subset(registry, relevant_scc)
+    token_groups = store['token_groups']
 
-    rows = []
+    if workers <= 1:
+        wash_trades_per_group = detect_and_label_wash_trades_for_token_groups(
+            store, token_groups, labels, registry, relevant_scc, window_sizes_in_seconds,
+            windows_per_window_size, ether=ether, margin=margin, cache=cache)
+    else:
+        # pack token groups into tasks of similar size, largest groups first; workers read their own groups
+        n_tasks = min(len(token_groups), workers * 4)
+        tasks = [{'groups': [], 'size': 0} for _ in range(n_tasks)]
+        for i in sorted(range(len(token_groups)), key=lambda i: store['token_group_trades'][i], reverse=True):
+            task = min(tasks, key=lambda task: task['size'])
+            task['groups'].append(i)
+            task['size'] += store['token_group_trades'][i] + 1
+
+        wash_trades_per_group = [None] * len(token_groups)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {}
+            for task in tasks:
+                groups = sorted(task['groups'])
+                futures[executor.submit(
+                    _detect_and_label_wash_trades_for_token_groups_worker, store,
+                    [token_groups[i] for i in groups], registry, relevant_scc, window_sizes_in_seconds,
+                    windows_per_window_size, ether, margin, cache, profiling.is_enabled())] = groups
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing token groups"):
+                task_wash_trades, checked, task_labels, task_cache, task_events = future.result()
+                for i, group_wash_trades in zip(futures[future], task_wash_trades):
+                    wash_trades_per_group[i] = group_wash_trades
+                labels[checked] = task_labels
+                if cache is not None:
+                    cache['current'].update(task_cache)
+                profiling.add_events(task_events)
+
+    # checked trades per (SCC, window size) in the order of a run on all trades, groups one after the other
+    wash_trades = {}
+    for window_size in window_sizes_in_seconds:
+        for scc_id in relevant_scc:
+            frames = [group_wash_trades[(scc_id, window_size)] for group_wash_trades in wash_trades_per_group
+                      if (scc_id, window_size) in group_wash_trades]
+            if frames:
+                wash_trades[(scc_id, window_size)] = pl.concat(frames, how='vertical_relaxed')
+    wash_trades = get_wash_trades_frame(wash_trades)
 
-    if multiple_passes:
-        for scc in wash_trades.keys():
-            for window_size in wash_trades[scc].keys():
-                for w in wash_trades[scc][window_size].keys():
+    if save:
+        trade_store.write_trades(store, folder, "trades_labeled", file_format, wash_label=pl.col('tx_id').map_batches(
+            lambda tx_ids: wash_labels_to_series(labels[tx_ids.to_numpy()]), return_dtype=pl.Boolean))
 
-                    temp = w.split('.')
-                    token = temp[0]
-                    window = temp[1]
+    return wash_trades, labels
 
-                    wash_trades_scc_window = wash_trades[scc][window_size][w].with_columns(
-                        pl.col("wash_label").cast(pl.Boolean) # cast wash_label to bool
-                    )
 
-                    num_wash = (wash_trades_scc_window['wash_label'] == True).sum()
-                    num_all = len(wash_trades_scc_window)
-                    amount_wash = wash_trades_scc_window.filter(pl.col.wash_label == True)['amount'].sum()
-                    amount_all = wash_trades_scc_window['amount'].sum()
-                    amount_dollar_wash = wash_trades_scc_window.filter(pl.col.wash_label == True)['trade_amount_dollar'].sum()
-                    amount_dollar_all = wash_trades_scc_window['trade_amount_dollar'].sum()
-                    new_row = {'scc_hash': scc, 'token': token, 'window_size': window_size, 
-                            'time': window, 'num_wash_trades': num_wash, 'num_trades': num_all, 
-                            'total_amount_wash': amount_wash, 'total_amount': amount_all, 
-                            'total_amount_dollar_wash': amount_dollar_wash, 
-                            'total_amount_dollar': amount_dollar_all}
+def get_wash_trades_frame(wash_trades):
+    # one long frame of the checked trades of all SCCs and passes, in the order in which they were checked:
+    # scc_hash, window_size, token, window (id), wash_label, amount and trade_amount_dollar
+    if len(wash_trades) == 0:
+        return pl.DataFrame(schema={'scc_hash': pl.String, 'window_size': pl.String, 'token': pl.String,
+                                    'window': pl.Int64, 'wash_label': pl.Boolean, 'amount': pl.Float64,
+                                    'trade_amount_dollar': pl.Float64})
+    return pl.concat(list(wash_trades.values()), how='vertical_relaxed')
 
-                    rows.append(new_row)
 
-    
-    else:
-        for scc in wash_trades.keys():
-            for w in wash_trades[scc].keys():
-
-                temp = w.split('.')
-                token = temp[0]
-                window = temp[1]
-
-                wash_trades_scc_window = wash_trades[scc][w].with_columns(
-                    pl.col("wash_label").cast(pl.Boolean) # cast wash_label to bool
-                )
-
-                num_wash = (wash_trades_scc_window['wash_label'] == True).sum()
-                num_all = len(wash_trades_scc_window)
-                amount_wash = wash_trades_scc_window.filter(pl.col.wash_label == True)['amount'].sum()
-                amount_all = wash_trades_scc_window['amount'].sum()
-                amount_dollar_wash = wash_trades_scc_window.filter(pl.col.wash_label == True)['trade_amount_dollar'].sum()
-                amount_dollar_all = wash_trades_scc_window['trade_amount_dollar'].sum()
-                new_row = {'scc_hash': scc, 'token': token, #'window_size': window_size, 
-                        'time': window, 'num_wash_trades': num_wash, 'num_trades': num_all, 
-                        'total_amount_wash': amount_wash, 'total_amount': amount_all, 
-                        'total_amount_dollar_wash': amount_dollar_wash, 
-                        'total_amount_dollar': amount_dollar_all}
-
-                rows.append(new_row)
-    
-    wash_trades_dt = pl.DataFrame(rows)
+def add_window_labels(summary, windows_per_window_size):
+    # replaces the window ids with their labels, made once per window of the summary
+    windows = summary.select('window_size', 'window').unique().partition_by('window_size', as_dict=True)
+    if len(windows) == 0:
+        return summary.rename({'window': 'time'}).with_columns(pl.col('time').cast(pl.String))
+    labels = pl.concat([
+        group.with_columns(get_window_labels(group['window'], windows_per_window_size[int(window_size)]).alias('time'))
+        for (window_size,), group in windows.items()
+    ])
+    return (summary
+            .join(labels, on=['window_size', 'window'], how='left', maintain_order='left')
+            .select([column if column != 'window' else 'time' for column in summary.columns]))
+
+
+def get_summary_of_wash_trades_per_scc_and_timewindow(wash_trades, window_size_name, multiple_passes=False, 
+                                                      save=True, folder="output", filename="wash_trades_summary",
+                                                      file_format="csv", windows_per_window_size=None):
+    print("Info: producing wash trading summary...")
 
+    # one row per window, windows of an SCC together in the order in which they were checked; windows are
+    # labeled "[start, end)" if windows_per_window_size is given, otherwise their ids are kept
+    keys = ['scc_hash', 'token', 'window_size', 'window']
+    is_wash = pl.col('wash_label').cast(pl.Boolean).fill_null(False)
+    wash_trades_dt = (wash_trades
+                      .with_columns(pl.int_range(pl.len()).min().over('scc_hash').alias('scc_order'))
+                      .group_by(['scc_order'] + keys, maintain_order=True)
+                      .agg(is_wash.sum().cast(pl.Int64).alias('num_wash_trades'),
+                           pl.len().cast(pl.Int64).alias('num_trades'),
+                           pl.col('amount').filter(is_wash).sum().alias('total_amount_wash'),
+                           pl.col('amount').sum().alias('total_amount'),
+                           pl.col('trade_amount_dollar').filter(is_wash).sum().alias('total_amount_dollar_wash'),
+                           pl.col('trade_amount_dollar').sum().alias('total_amount_dollar'))
+                      .sort('scc_order', maintain_order=True)
+                      .drop('scc_order'))
+
+    if windows_per_window_size is not None:
+        wash_trades_dt = add_window_labels(wash_trades_dt, windows_per_window_size)
+    if not multiple_passes:
+        wash_trades_dt = wash_trades_dt.drop('window_size')
 
     if save:
         filename = os.path.splitext(filename)[0]
-        wash_trades_dt.write_csv(os.path.join(folder, f"{filename}_{window_size_name}.csv"))
+        table_io.write_table(wash_trades_dt, folder, f"{filename}_{window_size_name}", file_format)
     
-    return wash_trades_dt
\ No newline at end of file
+    return wash_trades_dt
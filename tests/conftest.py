@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the pipeline modules import each other by name, as when run from pipeline_py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pipeline_py"))
+
+# utils imports main, so it has to be imported first
+import utils  # noqa: E402,F401
@@ -0,0 +1,141 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import scc
+import scc_registry
+import wtd
+
+# the numba kernels are optional, without numba only the Python kernels run
+pytest.importorskip("numba")
+
+
+def random_groups(rng, n_groups=None, max_group_trades=40):
+    # trades of several groups (windows) between a few traders, with amounts of different shapes
+    n_groups = n_groups if n_groups is not None else int(rng.integers(1, 30))
+    n_traders = int(rng.integers(2, 12))
+    lengths = rng.integers(0, max_group_trades + 1, n_groups)
+    n = int(lengths.sum())
+    buyer_codes = rng.integers(0, n_traders, n)
+    seller_codes = (buyer_codes + rng.integers(1, n_traders, n)) % n_traders
+    kind = rng.integers(0, 4)
+    if kind == 0:
+        amounts = np.round(rng.pareto(1.5, n) * 100, 4)
+    elif kind == 1:
+        # the same amount back and forth, which balances out exactly
+        amounts = np.repeat(np.round(rng.uniform(0.1, 10, (n + 3) // 4), 3), 4)[:n]
+    elif kind == 2:
+        amounts = rng.choice([0.1, 0.2, 0.3, 0.7, 1e-9, 0.0], n)
+    else:
+        amounts = rng.uniform(0, 1, n) * 10 ** rng.uniform(-8, 8, n)
+    group_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return buyer_codes, seller_codes, amounts, group_offsets, n_traders
+
+
+def random_timestamps(rng, group_offsets, span=20000):
+    # timestamps sorted within every group, with repeated timestamps if span is small
+    return np.concatenate([np.sort(rng.integers(0, span, group_offsets[g + 1] - group_offsets[g]))
+                           for g in range(len(group_offsets) - 1)] + [np.zeros(0, dtype=np.int64)])
+
+
+def assert_prefixes_match(buyer_codes, seller_codes, amounts, group_offsets, n_traders, margin):
+    python = wtd.detect_wash_trade_prefixes_batched(buyer_codes, seller_codes, amounts, group_offsets, n_traders,
+                                                    margin, jit=False)
+    jit = wtd.detect_wash_trade_prefixes_batched(buyer_codes, seller_codes, amounts, group_offsets, n_traders,
+                                                 margin, jit=True)
+    np.testing.assert_array_equal(jit, python)
+
+
+def assert_sliding_matches(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders, margin,
+                           window_start, window_size, window_stride):
+    python = wtd.detect_wash_trades_sliding(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders,
+                                            margin, window_start, window_size, window_stride, jit=False)
+    jit = wtd.detect_wash_trades_sliding(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders,
+                                         margin, window_start, window_size, window_stride, jit=True)
+    np.testing.assert_array_equal(jit, python)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_wash_trade_prefixes(seed):
+    rng = np.random.default_rng(seed)
+    margin = float(rng.choice([0.0, 0.01, 0.1, 0.5, 1.0, 2.0]))
+    assert_prefixes_match(*random_groups(rng), margin)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_wash_trades_sliding(seed):
+    rng = np.random.default_rng(seed)
+    buyer_codes, seller_codes, amounts, group_offsets, n_traders = random_groups(rng)
+    timestamps = random_timestamps(rng, group_offsets)
+    assert_sliding_matches(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders,
+                           float(rng.choice([0.0, 0.01, 0.1, 0.5, 2.0])), int(rng.integers(-5000, 5000)),
+                           int(rng.choice([600, 3600, 7200])), int(rng.choice([60, 300, 600])))
+
+
+def test_wash_trades_empty():
+    empty = np.zeros(0, dtype=np.int64)
+    for group_offsets in [np.array([0]), np.array([0, 0, 0])]:
+        assert_prefixes_match(empty, empty, np.zeros(0), group_offsets, 0, 0.1)
+        assert_sliding_matches(empty, empty, np.zeros(0), empty, group_offsets, 0, 0.1, 0, 3600, 600)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_wash_trades_one_trade_per_window(seed):
+    rng = np.random.default_rng(seed)
+    buyer_codes, seller_codes, amounts, group_offsets, n_traders = random_groups(rng, n_groups=50,
+                                                                                 max_group_trades=1)
+    assert_prefixes_match(buyer_codes, seller_codes, amounts, group_offsets, n_traders, 0.1)
+    timestamps = random_timestamps(rng, group_offsets)
+    assert_sliding_matches(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders, 0.1,
+                           0, 3600, 600)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_wash_trades_sliding_equal_timestamps(seed):
+    # all trades of a group at the same time, or at a few times, so that many trades enter a window at once
+    rng = np.random.default_rng(seed)
+    buyer_codes, seller_codes, amounts, group_offsets, n_traders = random_groups(rng)
+    for timestamps in [np.full(len(amounts), 1800), random_timestamps(rng, group_offsets, span=3)]:
+        for window_start in [0, 1800, -3600]:
+            assert_sliding_matches(buyer_codes, seller_codes, amounts, timestamps, group_offsets, n_traders, 0.1,
+                                   window_start, 3600, 600)
+
+
+def detect_scc_layers(buyer_ids, seller_ids, weights, jit):
+    # SCCs in the order of detection and their number of layers
+    registry, occurrences = scc_registry.new_registry(), Counter()
+    buyer_ids, seller_ids = np.asarray(buyer_ids, dtype=np.int64), np.asarray(seller_ids, dtype=np.int64)
+    if jit:
+        trader_ids, codes = np.unique(np.concatenate([buyer_ids, seller_ids]), return_inverse=True)
+        scc.detect_scc_layers_jit(trader_ids, codes[:len(buyer_ids)], codes[len(buyer_ids):], weights, registry,
+                                  occurrences)
+    else:
+        scc.detect_scc_layers_by_threshold_sweep_csr(buyer_ids, seller_ids, weights, registry, occurrences, jit=False)
+    members, offsets = scc_registry.get_sccs(registry)
+    return members.tolist(), offsets.tolist(), [occurrences[i] for i in range(len(offsets) - 1)]
+
+
+def assert_scc_layers_match(buyer_ids, seller_ids, weights):
+    assert (detect_scc_layers(buyer_ids, seller_ids, weights, jit=True) ==
+            detect_scc_layers(buyer_ids, seller_ids, weights, jit=False))
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_scc_layers(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(2, 40))
+    ids = rng.choice(100000, n, replace=False)
+    weights = {}
+    for _ in range(int(rng.integers(1, 200))):
+        u, v = rng.integers(0, n, 2)
+        weights[(int(ids[u]), int(ids[v]))] = int(rng.integers(1, 8))
+    edges = list(weights)
+    assert_scc_layers_match([u for u, _ in edges], [v for _, v in edges], [weights[edge] for edge in edges])
+
+
+def test_scc_layers_edge_cases():
+    assert_scc_layers_match([], [], [])
+    assert_scc_layers_match([1], [2], [3])
+    assert_scc_layers_match([1, 2], [1, 2], [4, 5])
+    assert_scc_layers_match([1, 2], [2, 1], [1, 1])
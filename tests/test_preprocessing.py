@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# more rows than fit into the first block of the streaming csv reader (1 MB)
+N_TRADES = 12000
+ETHER = "0x" + "0" * 40
+TOKENS = [ETHER] + [f"0x{(i + 1) * 7919:040x}" for i in range(8)]
+
+
+def get_amounts(rng, n):
+    return np.char.add(rng.integers(1, 10**9, n).astype(str), rng.integers(10**14, 10**15, n).astype(str))
+
+
+def get_tokens(rng, n):
+    # trades between Ether and another token
+    tokens = np.array(TOKENS)
+    other = tokens[rng.integers(1, len(tokens), n)]
+    buy_ether = rng.random(n) < 0.5
+    return np.where(buy_ether, ETHER, other), np.where(buy_ether, other, ETHER)
+
+
+def get_hashes(n):
+    # transaction hashes that look like integers in the first rows and are hex strings later
+    return np.where(np.arange(n) < 9000, np.arange(n).astype(str), np.char.add("0x", np.arange(n).astype(str)))
+
+
+def write_idex_trades(file, rng):
+    n = N_TRADES
+    token_buy, token_sell = get_tokens(rng, n)
+    trades = pd.DataFrame({
+        'transaction_hash': get_hashes(n), 'status': rng.integers(0, 2, n).astype(float),
+        'block_number': 4000000 + np.arange(n), 'gas': 200000, 'gas_price': 10**9, 'timestamp': 1510000000 + 60 * np.arange(n),
+        'amountBuy': get_amounts(rng, n), 'amountSell': get_amounts(rng, n), 'expires': 10000, 'nonce': np.arange(n),
+        'amount': get_amounts(rng, n), 'tradeNonce': np.arange(n), 'feeMake': 10**15, 'feeTake': 2 * 10**15,
+        'tokenBuy': token_buy, 'tokenSell': token_sell,
+        'maker': [f"0x{i:040x}" for i in rng.integers(1, 50, n)], 'taker': [f"0x{i:040x}" for i in rng.integers(1, 50, n)]})
+    # status is missing in the first rows and in a few late rows, gas prices only in late rows
+    trades.loc[:8000, 'status'] = np.nan
+    trades.loc[10000:10005, 'status'] = np.nan
+    trades['gas_price'] = trades['gas_price'].astype(float)
+    trades.loc[11000:11002, 'gas_price'] = np.nan
+    trades.to_csv(file, index=False, float_format='%.0f')
+
+
+def write_etherdelta_trades(file, rng):
+    n = N_TRADES
+    token_get, token_give = get_tokens(rng, n)
+    trades = pd.DataFrame({
+        'transaction_hash': get_hashes(n), 'block_number': (3000000 + np.arange(n)).astype(float),
+        'timestamp': 1500000000 + 60 * np.arange(n), 'tokenGet': token_get, 'amountGet': get_amounts(rng, n),
+        'tokenGive': token_give, 'amountGive': get_amounts(rng, n),
+        'get': [f"0x{i:040x}" for i in rng.integers(1, 50, n)], 'give': [f"0x{i:040x}" for i in rng.integers(1, 50, n)]})
+    # block numbers are missing in a few late rows
+    trades.loc[10000:10005, 'block_number'] = np.nan
+    trades.to_csv(file, index=False, float_format='%.0f')
+
+
+def run_preprocessing(script, trades_file, decimals_file, output_file, *options):
+    subprocess.run([sys.executable, os.path.join(REPO, script), '-i', trades_file, '-d', decimals_file,
+                    '-o', output_file, *options], check=True, capture_output=True, cwd=REPO)
+    with open(output_file, 'rb') as infile:
+        return infile.read()
+
+
+@pytest.mark.parametrize("script, write_trades", [("IDEXtrades_preprocessing.py", write_idex_trades),
+                                                  ("EtherDeltatrades_preprocessing.py", write_etherdelta_trades)])
+def test_chunked_output_matches_whole_file(tmp_path, script, write_trades):
+    trades_file = str(tmp_path / "trades.csv")
+    decimals_file = str(tmp_path / "decimals.json")
+    write_trades(trades_file, np.random.default_rng(0))
+    with open(decimals_file, "w") as outfile:
+        json.dump({f"k{i}": {'address': token, 'decimals': decimals, 'name': "n", 'slug': "s"}
+                   for i, (token, decimals) in enumerate(zip(TOKENS, [18, 18, 8, 0, 6, 18, 2, 12]))}, outfile)
+
+    whole = run_preprocessing(script, trades_file, decimals_file, str(tmp_path / "whole.csv"))
+    for chunk_rows in ["5000", "3333"]:
+        chunked = run_preprocessing(script, trades_file, decimals_file, str(tmp_path / f"chunked-{chunk_rows}.csv"),
+                                    '-c', chunk_rows)
+        assert chunked == whole
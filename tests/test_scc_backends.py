@@ -0,0 +1,72 @@
+from collections import Counter
+
+import networkx as nx
+import numpy as np
+import pytest
+
+import scc
+import scc_registry
+
+
+def get_layers(registry, occurrences):
+    # SCCs as sorted member tuples with their number of layers, independent of the order of detection
+    return sorted((tuple(scc_registry.get_members_of(registry, i).tolist()), occurrence)
+                  for i, occurrence in occurrences.items())
+
+
+def detect_networkx(buyer_ids, seller_ids, weights):
+    registry, occurrences = scc_registry.new_registry(), Counter()
+    g = nx.DiGraph()
+    for u, v, w in zip(buyer_ids, seller_ids, weights):
+        g.add_edge(u, v, weight=w)
+    scc.detect_scc_layers_by_threshold_sweep(g, registry, occurrences)
+    return get_layers(registry, occurrences)
+
+
+def detect_csr(buyer_ids, seller_ids, weights):
+    registry, occurrences = scc_registry.new_registry(), Counter()
+    scc.detect_scc_layers_by_threshold_sweep_csr(np.asarray(buyer_ids), np.asarray(seller_ids), weights,
+                                                 registry, occurrences, jit=False)
+    return get_layers(registry, occurrences)
+
+
+def random_edges(rng):
+    # weighted buyer -> seller edges as counted from trades (see scc.get_token_edges): several disconnected
+    # parts of random trader ids, with self-loops and pairs traded many times
+    buyer_ids, seller_ids = [], []
+    for _ in range(int(rng.integers(1, 4))):
+        traders = rng.choice(100000, int(rng.integers(2, 15)), replace=False)
+        n_trades = int(rng.integers(1, 150))
+        buyer_ids.extend(rng.choice(traders, n_trades).tolist())
+        seller_ids.extend(rng.choice(traders, n_trades).tolist())
+    weights = Counter(zip(buyer_ids, seller_ids))
+    edges = list(weights)
+    return [u for u, _ in edges], [v for _, v in edges], [weights[edge] for edge in edges]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_csr_matches_networkx(seed):
+    rng = np.random.default_rng(seed)
+    buyer_ids, seller_ids, weights = random_edges(rng)
+    assert detect_csr(buyer_ids, seller_ids, weights) == detect_networkx(buyer_ids, seller_ids, weights)
+
+
+def test_csr_matches_networkx_with_duplicate_edges():
+    # an edge given twice with its weight is the same edge to both backends
+    rng = np.random.default_rng(0)
+    buyer_ids, seller_ids, weights = random_edges(rng)
+    twice = rng.integers(0, len(weights), len(weights) // 2)
+    buyer_ids += [buyer_ids[i] for i in twice]
+    seller_ids += [seller_ids[i] for i in twice]
+    weights += [weights[i] for i in twice]
+    assert detect_csr(buyer_ids, seller_ids, weights) == detect_networkx(buyer_ids, seller_ids, weights)
+
+
+def test_csr_matches_networkx_on_cycles():
+    # two disconnected rings with a self-loop, the heavier ring spans more layers
+    buyer_ids = [1, 2, 3, 10, 11, 11]
+    seller_ids = [2, 3, 1, 11, 10, 11]
+    weights = [2, 2, 3, 5, 7, 9]
+    layers = detect_csr(buyer_ids, seller_ids, weights)
+    assert layers == detect_networkx(buyer_ids, seller_ids, weights)
+    assert layers == [((1, 2, 3), 2), ((10, 11), 5)]
@@ -0,0 +1,48 @@
+import inspect
+
+import pytest
+
+import main
+import stage_cache
+
+TRADES_MODULES = ["main", "utils", "table_io", "trader_registry"]
+SCC_MODULES = ["scc", "scc_registry", "numba_kernels", "run_state", "trade_store", "table_io"]
+
+
+def change_source(monkeypatch, module_name):
+    # the source of the module as if it had been edited
+    get_source = inspect.getsource
+
+    def get_changed_source(module):
+        source = get_source(module)
+        return source + "\n# changed\n" if module.__name__ == module_name else source
+
+    monkeypatch.setattr(stage_cache.inspect, "getsource", get_changed_source)
+
+
+def run_cached_stage(cache, get_code_key, runs):
+    key = stage_cache.get_stage_key('stage', code=get_code_key())
+    return stage_cache.run_stage(cache, 'stage', key, [], lambda: runs.append(1) or len(runs))
+
+
+@pytest.mark.parametrize("get_code_key, module_name",
+                         [(main.get_trades_code_key, name) for name in TRADES_MODULES] +
+                         [(main.get_scc_code_key, name) for name in SCC_MODULES])
+def test_changed_dependency_reruns_stage(tmp_path, monkeypatch, get_code_key, module_name):
+    if module_name == "numba_kernels" and main.scc.numba_kernels is None:
+        pytest.skip("numba is not installed, the scc stage does not run the numba kernels")
+    cache = stage_cache.open_cache(str(tmp_path))
+    runs = []
+    assert run_cached_stage(cache, get_code_key, runs) == 1
+    assert run_cached_stage(cache, get_code_key, runs) == 1
+
+    change_source(monkeypatch, module_name)
+    assert run_cached_stage(cache, get_code_key, runs) == 2
+
+
+def test_unrelated_module_keeps_stage(tmp_path, monkeypatch):
+    cache = stage_cache.open_cache(str(tmp_path))
+    runs = []
+    run_cached_stage(cache, main.get_scc_code_key, runs)
+    change_source(monkeypatch, "trader_registry")
+    assert run_cached_stage(cache, main.get_scc_code_key, runs) == 1
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Token Amounts
+#
+# Decodes raw token amounts, as given in the trade exports, to real values.
+#
+# Raw amounts are unsigned integers of up to 78 digits in the smallest unit of a token. The real value
+# is amount / 10^decimals, returned as the correctly rounded float64 (the same value as
+# float(fractions.Fraction(amount, 10**decimals))), without converting every amount to a Python object.
+#
+# ##### Steps
+# 1. Every digit string gets the exponent -decimals appended, e.g. '123' with 2 decimals becomes '123e-2',
+#    with Arrow string kernels.
+# 2. Arrow casts the strings to float64, which parses the full mantissa and rounds once, correctly.
+# 3. Amounts that are not plain digit strings, like signs, exponents or blanks, are decoded with Python
+#    integers.
+
+from fractions import Fraction
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def _decode_exactly(amount, decimals):
+  return float(Fraction(amount) / 10**int(decimals))
+
+
+def decode_amounts(amounts, decimals):
+  # Returns amounts / 10^decimals as float64 array. amounts is an Arrow string array or chunked array,
+  # or a sequence of amount strings; decimals an integer array of the same length. Missing amounts are NaN.
+  if isinstance(amounts, pa.ChunkedArray):
+    amounts = amounts.combine_chunks()
+  if not isinstance(amounts, pa.Array):
+    amounts = pa.array(amounts, type=pa.string(), from_pandas=True)
+  if not pa.types.is_string(amounts.type):
+    amounts = amounts.cast(pa.string())
+
+  n = len(amounts)
+  decimals = np.asarray(decimals, dtype=np.int64)
+  if n == 0:
+    return np.full(0, np.nan)
+
+  # one exponent string per distinct number of decimals
+  first = int(decimals.min())
+  exponents = pa.array([f"e{-e}" for e in range(first, int(decimals.max()) + 1)]).take(pa.array(decimals - first))
+  plain = pc.fill_null(pc.ascii_is_decimal(amounts), False)
+  numbers = pc.if_else(plain, pc.binary_join_element_wise(amounts, exponents, ""), pa.scalar(None, pa.string()))
+  values = pc.cast(numbers, pa.float64()).to_numpy(zero_copy_only=False)
+
+  not_null = amounts.is_valid().to_numpy(zero_copy_only=False)
+  for row in np.flatnonzero(~plain.to_numpy(zero_copy_only=False) & not_null):
+    values[row] = _decode_exactly(amounts[row].as_py(), decimals[row])
+
+  return values
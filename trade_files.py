@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Trade Files
+#
+# Reads and writes the trade files of the preprocessing scripts, all at once or in chunks of rows, so that
+# peak memory is set by the chunk size rather than by the input size.
+#
+# Inputs are csv, parquet or arrow files, by their file extension. Outputs are csv, parquet or arrow files,
+# written chunk by chunk.
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+
+def read_trades(file, column_types, chunk_rows=None):
+  # yields the trades as Arrow tables of at most chunk_rows rows, or all at once; column_types are the
+  # Arrow types of the csv columns, which should cover every column of the export: the streaming reader
+  # would otherwise infer a type from the first block of the file and fail on later values
+  # the input format is taken from the file extension
+  if file.endswith('.parquet'):
+    if chunk_rows is None:
+      yield pq.read_table(file)
+    else:
+      for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_rows):
+        yield pa.Table.from_batches([batch])
+  elif file.endswith(('.arrow', '.feather')):
+    trades = feather.read_table(file, memory_map=True)
+    if chunk_rows is None:
+      yield trades
+    else:
+      for offset in range(0, trades.num_rows, chunk_rows):
+        yield trades.slice(offset, chunk_rows)
+  else:
+    convert_options = csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+    if chunk_rows is None:
+      yield csv.read_csv(file, convert_options=convert_options)
+    else:
+      # the streaming reader returns batches by size in bytes, regroup them by rows
+      batches = []
+      n_rows = 0
+      for batch in csv.open_csv(file, convert_options=convert_options):
+        batches.append(batch)
+        n_rows += batch.num_rows
+        while n_rows >= chunk_rows:
+          trades = pa.Table.from_batches(batches)
+          yield trades.slice(0, chunk_rows)
+          batches = trades.slice(chunk_rows).to_batches()
+          n_rows -= chunk_rows
+      if n_rows > 0:
+        yield pa.Table.from_batches(batches)
+
+
+def to_pandas(trades):
+  # the same pandas types for every chunk: integer columns become nullable integers, so that a chunk with
+  # missing values is not written as floats while the other chunks are written as integers
+  return trades.to_pandas(types_mapper=lambda arrow_type: pd.Int64Dtype() if pa.types.is_integer(arrow_type) else None)
+
+
+def write_trades(trades, file, file_format, writer=None):
+  # writes or appends a chunk of trades, returns the writer to pass with the next chunk
+  if file_format == 'csv':
+    trades.to_csv(file, index=False, mode='w' if writer is None else 'a', header=writer is None)
+    return file_format
+
+  # later chunks are cast to the schema of the first one
+  table = pa.Table.from_pandas(trades, preserve_index=False)
+  if writer is None:
+    if file_format == 'parquet':
+      writer = (pq.ParquetWriter(file, table.schema), table.schema)
+    else:
+      writer = (pa.ipc.new_file(file, table.schema), table.schema)
+  else:
+    table = table.cast(writer[1])
+  writer[0].write_table(table)
+  return writer
+
+
+def close_trades_writer(writer):
+  if isinstance(writer, tuple):
+    writer[0].close()